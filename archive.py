@@ -0,0 +1,195 @@
+import os
+import re
+from datetime import date, datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+# Archive time in the name of every archived raw export
+ARCHIVED_AT_FORMAT = '%Y%m%dT%H%M%S%fZ'
+ARCHIVED_AT_PATTERN = re.compile(r' (\d{8}T\d{12}Z)\.')
+
+
+def open_filesystem(uri):
+    """Return a (filesystem, path) pair for a local directory or an S3 URI.
+    S3-compatible stores are reached with e.g. s3://bucket/prefix?endpoint_override=localhost:9000&scheme=http"""
+    if '://' not in uri:
+        uri = os.path.abspath(uri)
+    return pafs.FileSystem.from_uri(uri)
+
+
+class ExportArchive:
+    """Keeps every Booker export as a raw CSV plus its parsed frames as Parquet.
+
+    Layout under the archive root:
+        raw/<Type>/<location>/<file> [<date type>] <archived at>.csv  (same tree that BookerScraper.move_file produces)
+        <frame>/location=<location>/date=<YYYY-MM-DD>/<file>-0.parquet
+
+    Rows are partitioned on their own date, so reads by date range only open the matching partitions."""
+    partition_columns = {
+        'appointments': 'start_date_time',
+        'treatments': 'appointment_on',
+        'orders': 'order_date',
+        'customers': None,
+    }
+
+    def __init__(self, uri, compression='zstd'):
+        self.uri = uri
+        self.filesystem, self.root = open_filesystem(uri)
+        self.root = self.root.rstrip('/')
+        self.compression = compression
+        self.partitioning = ds.partitioning(
+            pa.schema([('location', pa.string()), ('date', pa.string())]),
+            flavor='hive'
+        )
+
+    ###############################
+    # UTILITY FUNCTIONS
+    ###############################
+    @staticmethod
+    def get_export_date(file_name):
+        match = re.search(r'\d{4}-\d{2}-\d{2}', file_name)
+        if match is None:
+            return date.today()
+        return date.fromisoformat(match.group())
+
+    @staticmethod
+    def raw_file_name(file_path, date_type=None):
+        """Archived name of a raw export. The date type and archive time keep exports of the same window apart,
+        like the date_on and date_created appointments or the customer exports of one day."""
+        stem, extension = os.path.splitext(os.path.basename(file_path))
+        parts = [stem]
+        if date_type:
+            parts.append(date_type)
+        parts.append(datetime.now(timezone.utc).strftime(ARCHIVED_AT_FORMAT))
+        return ' '.join(parts) + extension
+
+    @staticmethod
+    def archived_at(file_name):
+        """Archive time written into the name by raw_file_name, None for files that weren't archived"""
+        match = ARCHIVED_AT_PATTERN.search(os.path.basename(file_name))
+        return match.group(1) if match else None
+
+    def raw_path(self, type, location, file_name):
+        parts = [self.root, 'raw', type]
+        if location:
+            parts.append(str(location))
+        parts.append(file_name)
+        return '/'.join(parts)
+
+    def frame_path(self, name):
+        return f'{self.root}/{name}'
+
+    ###############################
+    # WRITING
+    ###############################
+    def archive_raw(self, type, location, file_path, date_type=None):
+        dest = self.raw_path(type, location, self.raw_file_name(file_path, date_type))
+        self.filesystem.create_dir(dest.rsplit('/', 1)[0], recursive=True)
+        pafs.copy_files(file_path, dest,
+                        source_filesystem=pafs.LocalFileSystem(),
+                        destination_filesystem=self.filesystem)
+        return dest
+
+    def archive_frame(self, name, df, location, export_date, basename):
+        if df is None or len(df) == 0:
+            return
+        df = df.copy()
+        df['location'] = '' if location is None else str(location)
+
+        date_column = self.partition_columns.get(name)
+        partition_date = pd.Series(export_date.isoformat(), index=df.index)
+        if date_column is not None and date_column in df.columns:
+            row_dates = pd.to_datetime(df[date_column], errors='coerce').dt.strftime('%Y-%m-%d')
+            partition_date = row_dates.fillna(partition_date)
+        df['date'] = partition_date
+
+        # Parsed frames mix '' with numbers in object columns, store those as strings
+        object_columns = df.select_dtypes(include='object').columns
+        df = df.astype({column: 'string' for column in object_columns})
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        ds.write_dataset(
+            table,
+            self.frame_path(name),
+            filesystem=self.filesystem,
+            format='parquet',
+            partitioning=self.partitioning,
+            basename_template=f'{basename}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+            file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+        )
+
+    def archive_frames(self, location, file_path, frames: dict):
+        """Store every parsed frame of a single export file, archiving the same file again overwrites its previous
+        frames. The raw CSV is archived when it is downloaded, see BookerScraper.move_file."""
+        file_name = os.path.basename(file_path)
+        export_date = self.get_export_date(file_name)
+        basename = os.path.splitext(file_name)[0].replace(' ', '_')
+        for name, df in frames.items():
+            self.archive_frame(name, df, location, export_date, basename)
+        print(f'Archived {file_name} to {self.uri}')
+
+    ###############################
+    # READING
+    ###############################
+    def raw_files(self, type):
+        """Archived raw exports of the type in the order they were archived"""
+        selector = pafs.FileSelector(f'{self.root}/raw/{type}', allow_not_found=True, recursive=True)
+        paths = [info.path for info in self.filesystem.get_file_info(selector) if info.type == pafs.FileType.File]
+        return sorted(paths, key=lambda path: (self.archived_at(path) or '', path))
+
+    def stage_raw(self, destination_dir, start_date: date = None, end_date: date = None, types=None):
+        """Copy archived raw exports into destination_dir using the move_file layout so BookerParser can read them.
+        A file is staged when its export window overlaps the date range. Returns the number of files per type."""
+        types = types or ['Appointment', 'Order', 'Customer']
+        staged = {}
+        for type in types:
+            staged[type] = 0
+            for path in self.raw_files(type):
+                dates = re.findall(r'\d{4}-\d{2}-\d{2}', os.path.basename(path))
+                window_start = date.fromisoformat(dates[0]) if dates else None
+                window_end = date.fromisoformat(dates[-1]) if dates else None
+                if start_date is not None and window_end is not None and window_end < start_date:
+                    continue
+                if end_date is not None and window_start is not None and window_start > end_date:
+                    continue
+                self.stage_file(destination_dir, path)
+                staged[type] += 1
+        return staged
+
+    def stage_file(self, destination_dir, path):
+        """Copy one archived raw export into destination_dir using the move_file layout"""
+        prefix = f'{self.root}/raw/'
+        dest = os.path.join(destination_dir, *path[len(prefix):].split('/'))
+        return self.copy_raw(path, dest)
+
+    def copy_raw(self, path, dest):
+        """Copy one archived raw export to a local file"""
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        pafs.copy_files(path, dest,
+                        source_filesystem=self.filesystem,
+                        destination_filesystem=pafs.LocalFileSystem())
+        return dest
+
+    def read(self, name, start_date: date = None, end_date: date = None, locations=None, columns=None):
+        """Read an archived frame, only opening the partitions inside the date range (inclusive)"""
+        dataset = ds.dataset(
+            self.frame_path(name),
+            filesystem=self.filesystem,
+            format='parquet',
+            partitioning=self.partitioning,
+        )
+        expression = None
+        filters = []
+        if start_date is not None:
+            filters.append(ds.field('date') >= start_date.isoformat())
+        if end_date is not None:
+            filters.append(ds.field('date') <= end_date.isoformat())
+        if locations:
+            filters.append(ds.field('location').isin([str(location) for location in locations]))
+        for f in filters:
+            expression = f if expression is None else expression & f
+        return dataset.to_table(filter=expression, columns=columns).to_pandas()
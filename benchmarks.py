@@ -0,0 +1,241 @@
+"""Local benchmarks for the scraper, run with `python benchmarks.py <benchmark> --help`"""
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import statistics
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+from metrics import start_run
+from object_uploader import ObjectUploader
+from parser import BookerParser, ENGINES
+from schema import json_records
+from webdriver_client import chrome_headless, chrome_testing, chrome_rss
+
+logger = logging.getLogger()
+
+
+###############################
+# DRIVER
+###############################
+def benchmark_driver_profile(lean, urls, repeat, headless=True):
+    with TemporaryDirectory() as download_dir:
+        if headless:
+            driver = chrome_headless(logger, download_dir, lean=lean)
+        else:
+            driver = chrome_testing(download_dir, lean=lean)
+        load_times = []
+        peak_rss = chrome_rss(driver)
+        try:
+            for i in range(repeat):
+                for url in urls:
+                    start = perf_counter()
+                    driver.get(url)
+                    load_times.append(perf_counter() - start)
+                    peak_rss = max(peak_rss, chrome_rss(driver))
+        finally:
+            driver.quit()
+    return {
+        'profile': 'lean' if lean else 'default',
+        'loads': len(load_times),
+        'mean_load_s': statistics.mean(load_times),
+        'p95_load_s': statistics.quantiles(load_times, n=20)[-1] if len(load_times) > 1 else load_times[0],
+        'peak_rss_mb': peak_rss / 1024 / 1024,
+    }
+
+
+def benchmark_driver(args):
+    """Compare page load times and Chrome memory of the default and lean driver profiles"""
+    for lean in [False, True]:
+        result = benchmark_driver_profile(lean, args.urls, args.repeat, headless=not args.windowed)
+        print(f"{result['profile']:>8}: {result['loads']} loads, mean {result['mean_load_s']:.2f}s, "
+              f"p95 {result['p95_load_s']:.2f}s, peak Chrome RSS {result['peak_rss_mb']:.0f} MB")
+
+
+###############################
+# PARSER
+###############################
+APPOINTMENT_HEADER = [
+    'Booking Number', 'Date Created', 'Status', 'Type', 'Origin', 'Payment Method', 'Payment Special', 'Created By',
+    'Pre-book / Rebook', 'Start Date/Time', 'End Date/Time', 'Treatment Name', 'Appointment On', 'Category',
+    'Subcategory', 'Staff Name', 'Room', 'Duration', 'Price', 'Staff Requested', 'Tax', 'Total', 'Customer Name',
+    'Customer Email', 'Customer Mobile Phone',
+]
+ORDER_HEADER = [
+    'Order Number', 'Customer ID', 'Status', 'Order Date', 'Total Price', 'Order Items', 'Refund Amount', 'Balance',
+    'Last Refund Date', 'Total Products', 'Total Treatments', 'Total Packages', 'Total Series',
+    'Total Gift Certificate Cards', 'Total Cancellation Fee', 'Total Discount Special', 'Tax', 'Tip', 'Total Tips',
+    'Prepaid Credit', 'Refund', 'Payment Method', 'Created By',
+]
+CUSTOMER_HEADER = [
+    'First Name', 'Last Name', 'Street 1', 'Street 2', 'State', 'City', 'Postal Code', 'Email', 'Primary Phone',
+    'Work Phone', 'Home Phone', 'Mobile Phone', 'Receives Email', 'Receives SMS', 'Status', 'Date Created',
+    'Birthday', 'Login', 'ID(GUID)', 'Customer ID',
+]
+PHONES = ['(208) 555-1234', '', '+1 208 555 9999', '12085551111']
+
+
+def export_date_time(value):
+    return value.strftime('%b %-d, %Y  %-I:%M %p')
+
+
+def export_money(i):
+    return '' if i % 10 == 0 else f'${(i * 37) % 200000 / 100:,.2f}'
+
+
+def write_synthetic_exports(directory, rows, location='36085'):
+    """Appointment, order and customer exports laid out like the scraper downloads them, rows rows each"""
+    start = datetime(2024, 3, 1)
+    for type in ['Appointment', 'Order']:
+        os.makedirs(os.path.join(directory, type, location), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'Customer'), exist_ok=True)
+
+    with open(os.path.join(directory, 'Appointment', location, 'Appointment 2024-03-01-2024-03-10.csv'), 'w',
+              newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(APPOINTMENT_HEADER)
+        for i in range(rows):
+            start_time = start + timedelta(hours=i % 240)
+            writer.writerow([
+                1000 + i, export_date_time(start_time - timedelta(days=3)), ['Booked', 'Completed', 'Cancelled'][i % 3],
+                'Individual', 'Online', ['Visa', ''][i % 2], '', 'Admin', ['', 'Pre-book'][i % 2],
+                export_date_time(start_time), export_date_time(start_time + timedelta(hours=1)), 'Facial',
+                export_date_time(start_time), 'Skin', 'Face', 'Jane', 'Room 1', ['60', ''][i % 2], export_money(i), 'No',
+                export_money(i + 1), export_money(i + 2), f'Customer {i}', f'customer{i}@example.com', PHONES[i % 4],
+            ])
+
+    with open(os.path.join(directory, 'Order', location, 'Order 2024-03-01-2024-03-10.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(ORDER_HEADER)
+        for i in range(rows):
+            order_date = start + timedelta(days=i % 10)
+            writer.writerow([
+                5000 + i, '{ABC-%d}' % i, 'Closed', order_date.strftime('%b %d, %Y'), export_money(i), 'Facial x1',
+                *[export_money(i + j) for j in range(1, 3)], '', *[export_money(i + j) for j in range(3, 14)], 'No',
+                'Visa', 'Admin',
+            ])
+
+    with open(os.path.join(directory, 'Customer', 'Customer 2024-03-01.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CUSTOMER_HEADER)
+        for i in range(rows):
+            writer.writerow([
+                f'First{i}', 'Last', '1 Main', '', 'ID', 'Boise', '83701', f'customer{i}@example.com', PHONES[i % 4], '',
+                PHONES[(i + 1) % 4], PHONES[(i + 2) % 4], ['Yes', 'No'][i % 2], ['Yes', 'No', ''][i % 3], 'Active',
+                'Jan 5, 2024', '', '', '{%08d-AAAA-BBBB-CCCC-DDDDDDDDDDDD}' % i, str(1000 + i),
+            ])
+
+
+def benchmark_parser(args):
+    """Compare the pandas and pyarrow BookerParser engines on synthetic exports"""
+    imports = {
+        'appointments': BookerParser.import_appointments,
+        'orders': BookerParser.import_orders,
+        'customers': BookerParser.parse_customers,
+    }
+    for rows in args.rows:
+        with TemporaryDirectory() as directory:
+            write_synthetic_exports(directory, rows)
+            for name, import_export in imports.items():
+                timings = {}
+                for engine in ENGINES:
+                    parser = BookerParser(directory, typed=args.typed, engine=engine)
+                    start = perf_counter()
+                    import_export(parser)
+                    timings[engine] = perf_counter() - start
+                print(f"{rows:>9} {name:>12}: " + ', '.join(f'{engine} {seconds:.2f}s' for engine, seconds in
+                                                            timings.items())
+                      + f", speedup {timings['pandas'] / timings['pyarrow']:.1f}x")
+
+
+###############################
+# UPLOAD
+###############################
+class ObjectsEndpoint(BaseHTTPRequestHandler):
+    """Local stand-in for the Objects API, reads every batch like the real endpoint would and throttles the
+    transfer to the server's mbps"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.mbps:
+            sleep(len(body) * 8 / (self.server.mbps * 1_000_000))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.objects += len(json.loads(body)['objects'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"success": true}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark_upload(args):
+    """Compare uncompressed and gzip compressed object batches against a local stand-in endpoint"""
+    with TemporaryDirectory() as directory:
+        write_synthetic_exports(directory, args.rows)
+        parser = BookerParser(directory)
+        appointments, treatments = parser.import_appointments()
+        records = {
+            'appointments': [(str(data['booking_number']), data) for data in json_records(appointments, 'appointments')],
+            'orders': [(str(data['order_number']), data) for data in json_records(parser.import_orders(), 'orders')],
+        }
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ObjectsEndpoint)
+    server.mbps = args.mbps
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/v1/set'
+    try:
+        for level in args.levels:
+            server.objects = 0
+            uploads = start_run('upload').uploads
+            uploader = ObjectUploader('benchmark', url=url, compress_level=level, batch_size=args.batch_size)
+            start = perf_counter()
+            for collection, objects in records.items():
+                for object_id, properties in objects:
+                    uploader.object(object_id, collection, properties)
+            uploader.flush()
+            seconds = perf_counter() - start
+            print(f"level {level}: {server.objects} objects in {uploads['batches']} batches, "
+                  f"{uploads['raw_bytes'] / 1024 / 1024:.1f} MB -> {uploads['sent_bytes'] / 1024 / 1024:.1f} MB "
+                  f"({uploads['raw_bytes'] / uploads['sent_bytes']:.1f}x), {seconds:.2f}s, "
+                  f"mean batch {uploads['seconds'] / uploads['batches'] * 1000:.1f} ms")
+    finally:
+        server.shutdown()
+
+
+BENCHMARKS = {
+    'driver': benchmark_driver,
+    'parser': benchmark_parser,
+    'upload': benchmark_upload,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    driver_parser = subparsers.add_parser('driver', help=benchmark_driver.__doc__)
+    driver_parser.add_argument('--urls', nargs='+', default=['https://signin.booker.com/'])
+    driver_parser.add_argument('--repeat', type=int, default=5)
+    driver_parser.add_argument('--windowed', action='store_true', help='Use the local chrome_testing driver')
+
+    parser_parser = subparsers.add_parser('parser', help=benchmark_parser.__doc__)
+    parser_parser.add_argument('--rows', nargs='+', type=int, default=[10_000, 100_000, 1_000_000])
+    parser_parser.add_argument('--typed', action='store_true', help='Also compact the frames to typed columns')
+
+    upload_parser = subparsers.add_parser('upload', help=benchmark_upload.__doc__)
+    upload_parser.add_argument('--rows', type=int, default=10_000)
+    upload_parser.add_argument('--levels', nargs='+', type=int, default=[0, 1, 6, 9])
+    upload_parser.add_argument('--batch-size', type=int, default=100)
+    upload_parser.add_argument('--mbps', type=float, default=50, help='Bandwidth of the stand-in, 0 for unlimited')
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,159 @@
+import fcntl
+import json
+import re
+from urllib.parse import urlparse, parse_qs
+
+import boto3
+from botocore.exceptions import ClientError
+import pyarrow.fs as pafs
+
+from archive import open_filesystem
+
+
+def s3_client(uri):
+    """Client for an S3 URI as open_filesystem reads it, endpoint_override and scheme included"""
+    query = {key: values[0] for key, values in parse_qs(urlparse(uri).query).items()}
+    endpoint_url = None
+    if query.get('endpoint_override'):
+        endpoint_url = f'{query.get("scheme", "https")}://{query["endpoint_override"]}'
+    return boto3.client('s3', endpoint_url=endpoint_url, region_name=query.get('region'))
+
+
+class CustomerIndex:
+    """Normalized email and phone -> customer guid, built from the customer exports.
+    Lets customer_create_flow resolve an existing customer without searching Booker in the browser.
+
+    Several tasks save the same index. A save re-reads the index and writes it back with only this run's entries
+    added: on S3 conditionally on the ETag it read, retried when another task wrote in between, locally under a
+    file lock."""
+    file_name = 'customer_index.json'
+
+    def __init__(self, uri, s3=None, max_attempts=5):
+        self.uri = uri
+        self.filesystem, root = open_filesystem(uri)
+        self.root = root.rstrip('/')
+        self.path = f'{self.root}/{self.file_name}'
+        self.s3 = s3
+        if self.s3 is None and uri.startswith('s3://'):
+            self.s3 = s3_client(uri)
+        self.max_attempts = max_attempts
+        self.emails = {}
+        self.phones = {}
+        # Entries added by this run, the only ones a save writes over the stored index
+        self.added_emails = {}
+        self.added_phones = {}
+        self.load()
+
+    @staticmethod
+    def normalize_email(email):
+        if not email:
+            return None
+        return str(email).strip().lower() or None
+
+    @staticmethod
+    def normalize_phone(phone):
+        """Same E.164 form that BookerParser.normalize_phones produces"""
+        if not phone:
+            return None
+        digits = re.sub(r'\D', '', str(phone))
+        if not digits:
+            return None
+        if len(digits) == 11 and digits.startswith('1'):
+            return f'+{digits}'
+        return f'+1{digits}'
+
+    def load(self):
+        data, _ = self.read()
+        self.emails = {**data.get('emails', {}), **self.added_emails}
+        self.phones = {**data.get('phones', {}), **self.added_phones}
+
+    def read(self):
+        """The stored index and its ETag on S3, ({}, None) while there is none"""
+        if self.s3 is not None:
+            bucket, key = self.path.split('/', 1)
+            try:
+                response = self.s3.get_object(Bucket=bucket, Key=key)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                    return {}, None
+                raise
+            return json.loads(response['Body'].read()), response['ETag']
+        if self.filesystem.get_file_info(self.path).type == pafs.FileType.NotFound:
+            return {}, None
+        with self.filesystem.open_input_stream(self.path) as f:
+            return json.loads(f.read()), None
+
+    def merged(self, data):
+        return {
+            'emails': {**data.get('emails', {}), **self.added_emails},
+            'phones': {**data.get('phones', {}), **self.added_phones},
+        }
+
+    def save(self):
+        if not self.added_emails and not self.added_phones:
+            return
+        if self.s3 is not None:
+            self.save_s3()
+        else:
+            self.save_locally()
+        print(f'Saved {len(self.added_emails)} emails and {len(self.added_phones)} phones to the customer index')
+        self.added_emails = {}
+        self.added_phones = {}
+
+    def save_s3(self):
+        bucket, key = self.path.split('/', 1)
+        for attempt in range(1, self.max_attempts + 1):
+            data, etag = self.read()
+            data = self.merged(data)
+            # Fails when another task wrote the index since it was read, or created it
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                self.s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(data).encode(), **condition)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                    raise
+                print(f'Customer index changed while saving, attempt {attempt}/{self.max_attempts}')
+                continue
+            self.emails, self.phones = data['emails'], data['phones']
+            return
+        raise Exception(f'Could not save the customer index after {self.max_attempts} attempts')
+
+    def save_locally(self):
+        self.filesystem.create_dir(self.root, recursive=True)
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self.merged(self.read()[0])
+            with self.filesystem.open_output_stream(self.path) as f:
+                f.write(json.dumps(data).encode())
+        self.emails, self.phones = data['emails'], data['phones']
+
+    def add(self, guid, email=None, phone=None):
+        email = self.normalize_email(email)
+        phone = self.normalize_phone(phone)
+        if email:
+            self.emails[email] = self.added_emails[email] = guid
+        if phone:
+            self.phones[phone] = self.added_phones[phone] = guid
+
+    def update_from_frame(self, df):
+        """Index every customer of a parsed customer export"""
+        guids = df['guid'].astype(object)
+        emails = df['email'].astype('string').str.strip().str.lower()
+        self.added_emails.update(
+            {email: guid for email, guid in zip(emails, guids) if isinstance(email, str) and email})
+        # Phones were already normalized to E.164 by the parser
+        for column in [column for column in df.columns if 'phone' in column]:
+            phones = df[column].astype(object)
+            self.added_phones.update(
+                {phone: guid for phone, guid in zip(phones, guids) if isinstance(phone, str) and phone})
+        self.emails.update(self.added_emails)
+        self.phones.update(self.added_phones)
+
+    def lookup(self, email=None, phone=None):
+        email = self.normalize_email(email)
+        if email and email in self.emails:
+            return self.emails[email]
+        phone = self.normalize_phone(phone)
+        if phone and phone in self.phones:
+            return self.phones[phone]
+        return None
@@ -0,0 +1,89 @@
+import json
+import sqlite3
+import time
+
+
+class CustomerQueue:
+    """SQLite backed stand-in for SQS holding customer creation requests until a worker drains them.
+    Claimed requests become visible again after visibility_timeout seconds unless they are acked, and requests
+    claimed max_attempts times stay in the table as dead letters. Every claim counts as an attempt, so requests
+    whose worker crashed or timed out don't come back forever.
+    The queue file lives on shared network storage (EFS), so it uses SQLite's rollback journal: WAL needs a
+    shared memory index that network filesystems don't support."""
+
+    def __init__(self, path, visibility_timeout=300, max_attempts=3):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def _available(self):
+        return 'attempts < ? AND (claimed_at IS NULL OR claimed_at < ?)', \
+            (self.max_attempts, time.time() - self.visibility_timeout)
+
+    def enqueue(self, payload: dict):
+        cursor = self.connection.execute(
+            'INSERT INTO requests (payload, enqueued_at) VALUES (?, ?)',
+            (json.dumps(payload), time.time())
+        )
+        return cursor.lastrowid
+
+    def size(self):
+        condition, params = self._available()
+        return self.connection.execute(f'SELECT COUNT(*) FROM requests WHERE {condition}', params).fetchone()[0]
+
+    def oldest_age(self):
+        condition, params = self._available()
+        oldest = self.connection.execute(f'SELECT MIN(enqueued_at) FROM requests WHERE {condition}', params).fetchone()[0]
+        return None if oldest is None else time.time() - oldest
+
+    def wait_for_batch(self, batch_size, max_latency, poll_interval=0.5):
+        """Block until batch_size requests are waiting or the oldest has waited max_latency seconds.
+        Returns False when the queue is empty."""
+        while True:
+            age = self.oldest_age()
+            if age is None:
+                return False
+            if self.size() >= batch_size or age >= max_latency:
+                return True
+            time.sleep(min(poll_interval, max_latency - age))
+
+    def claim(self, batch_size):
+        condition, params = self._available()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.connection.execute(
+                f'SELECT id, payload FROM requests WHERE {condition} ORDER BY id LIMIT ?',
+                (*params, batch_size)
+            ).fetchall()
+            self.connection.executemany(
+                'UPDATE requests SET claimed_at = ?, attempts = attempts + 1 WHERE id = ?',
+                [(time.time(), request_id) for request_id, payload in rows]
+            )
+            self.connection.execute('COMMIT')
+        except Exception as e:
+            self.connection.execute('ROLLBACK')
+            raise e
+        return [(request_id, json.loads(payload)) for request_id, payload in rows]
+
+    def ack(self, request_ids):
+        self.connection.executemany('DELETE FROM requests WHERE id = ?', [(i,) for i in request_ids])
+
+    def release(self, request_ids, count_attempt=True):
+        """Make failed requests available again. Requests that weren't tried, e.g. left over at the deadline,
+        are released with count_attempt=False and get their claim's attempt back."""
+        attempts = 'attempts' if count_attempt else 'MAX(attempts - 1, 0)'
+        self.connection.executemany(
+            f'UPDATE requests SET claimed_at = NULL, attempts = {attempts} WHERE id = ?',
+            [(i,) for i in request_ids]
+        )
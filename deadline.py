@@ -0,0 +1,71 @@
+import signal
+from time import monotonic
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """Time budget of one invocation, taken from context.get_remaining_time_in_millis(). Loops stop taking new
+    work once only reserve seconds are left, and sends once only send_reserve seconds are left, so there is
+    time to flush what was sent and return a partial result instead of being killed mid-flush. Without a
+    context the budget is unlimited."""
+
+    def __init__(self, remaining_seconds=None, reserve=120, send_reserve=20):
+        self.end = monotonic() + remaining_seconds if remaining_seconds is not None else None
+        self.reserve = reserve
+        self.send_reserve = send_reserve
+        # Work that was skipped because of the deadline
+        self.stopped = []
+
+    @classmethod
+    def from_context(cls, context, reserve=120, send_reserve=20):
+        get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+        remaining_seconds = get_remaining_time() / 1000 if get_remaining_time is not None else None
+        return cls(remaining_seconds, reserve=reserve, send_reserve=send_reserve)
+
+    def remaining(self):
+        if self.end is None:
+            return float('inf')
+        return self.end - monotonic()
+
+    def should_stop(self, work, sending=False):
+        """Whether to skip the work, skipped work is recorded and reported with the result"""
+        if self.remaining() > (self.send_reserve if sending else self.reserve):
+            return False
+        print(f'Deadline: {self.remaining():.0f}s left, stopping before {work}')
+        self.stopped.append(work)
+        return True
+
+    def check(self, work):
+        """Raise DeadlineExceeded instead of starting the work"""
+        if self.should_stop(work):
+            raise DeadlineExceeded(f'Stopped before {work}, {self.remaining():.0f}s left')
+
+    ###############################
+    # ALARM
+    ###############################
+    def arm(self):
+        """Last resort for work that doesn't check the deadline, SIGALRM fires halfway through the send reserve
+        and the handler's alarm handler raises DeadlineExceeded"""
+        if self.end is not None:
+            signal.alarm(max(1, int(self.remaining() - self.send_reserve / 2)))
+
+    @staticmethod
+    def disarm():
+        signal.alarm(0)
+
+
+_current_deadline = Deadline()
+
+
+def start_deadline(context, reserve=120, send_reserve=20):
+    global _current_deadline
+    _current_deadline = Deadline.from_context(context, reserve=reserve, send_reserve=send_reserve)
+    return _current_deadline
+
+
+def current_deadline():
+    """Deadline of the running invocation, code outside the handler runs without one"""
+    return _current_deadline
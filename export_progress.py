@@ -0,0 +1,53 @@
+import json
+import uuid
+
+import pyarrow.fs as pafs
+
+from archive import open_filesystem
+
+
+class ExportProgress:
+    """Chunks of a chunked export that were downloaded and archived, keyed by the export and its whole date
+    window. A run the deadline cut short leaves its finished chunks here, the next run of the same export
+    stages them from the archive instead of downloading them again. An export that finishes clears its chunks.
+    Every export has its own small JSON file in a local directory or on S3, so concurrent tasks and shards
+    exporting other windows or locations never overwrite each other's progress."""
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.filesystem, root = open_filesystem(uri)
+        self.root = root.rstrip('/')
+
+    @staticmethod
+    def key(type, location, date_type, start_date, end_date, export_period):
+        return ' '.join(str(part) for part in [type, location, date_type, start_date, end_date, export_period.days])
+
+    def path(self, key):
+        return f'{self.root}/{key.replace(" ", "_").replace("/", "-")}.json'
+
+    def chunks(self, key):
+        """Chunk start date -> archived raw export of the chunk"""
+        path = self.path(key)
+        if self.filesystem.get_file_info(path).type == pafs.FileType.NotFound:
+            return {}
+        with self.filesystem.open_input_stream(path) as f:
+            return json.loads(f.read())
+
+    def save(self, key, chunks):
+        """Written next to the file and moved over it, a reader never sees a half written file"""
+        self.filesystem.create_dir(self.root, recursive=True)
+        path = self.path(key)
+        temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with self.filesystem.open_output_stream(temporary_path) as f:
+            f.write(json.dumps(chunks).encode())
+        self.filesystem.move(temporary_path, path)
+
+    def record(self, key, start_date, archive_path):
+        chunks = self.chunks(key)
+        chunks[str(start_date)] = archive_path
+        self.save(key, chunks)
+
+    def clear(self, key):
+        path = self.path(key)
+        if self.filesystem.get_file_info(path).type != pafs.FileType.NotFound:
+            self.filesystem.delete_file(path)
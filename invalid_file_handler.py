@@ -1,16 +1,22 @@
-import tempfile
-import boto3
+import io
 import os
+import shutil
+import tarfile
+import tempfile
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-s3_client = boto3.client('s3')
-ses_client = boto3.client('ses')
+import boto3
 
 
 class InvalidFileHandler:
+    """Collects the export files that failed to parse during a run. Files are bundled into one tar.gz in a
+    background thread, and has_errors uploads the bundle and sends a single summary email, so parsing never
+    waits on S3. S3_ENDPOINT_URL points the S3 client at a local stand-in such as MinIO or moto."""
     _instance = None
+    bundle_name = 'invalid_files.tar.gz'
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -22,7 +28,8 @@ class InvalidFileHandler:
             cls._instance.initialized = False
         return cls._instance
 
-    def __init__(self, bucket_name=None, region=None, sender=None, receiver=None, logger=None):
+    def __init__(self, bucket_name=None, region=None, sender=None, receiver=None, logger=None,
+                 s3_client=None, ses_client=None, endpoint_url=None):
         if not hasattr(self, 'initialized') or not self.initialized:
             if not all([bucket_name, region, sender, receiver]):
                 raise Exception("Must provide bucket_name, region, sender, and receiver on first initialization")
@@ -33,58 +40,146 @@ class InvalidFileHandler:
             self.sender = sender
             self.receiver = receiver
             self.logger = logger
+            self.endpoint_url = endpoint_url or os.environ.get('S3_ENDPOINT_URL') or None
+            self._s3_client = s3_client
+            self._ses_client = ses_client
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='invalid-files')
+            self._start_bundle()
             self.initialized = True
 
+    ###############################
+    # CLIENTS
+    ###############################
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            self._s3_client = boto3.client('s3', region_name=self.region, endpoint_url=self.endpoint_url)
+        return self._s3_client
+
+    @property
+    def ses_client(self):
+        if self._ses_client is None:
+            self._ses_client = boto3.client('ses', region_name=self.region)
+        return self._ses_client
+
+    ###############################
+    # ERRORS
+    ###############################
     def add_error(self, file_name, error_detail):
-        self._upload_file(file_name)
+        """Record a bad file. Only a hard link is made here, so the file survives its temporary directory, the
+        compression runs in the background. Files on another filesystem are copied, files that are already gone
+        are only listed in the error details."""
         self.error_files.append(file_name)
         self.error_data.append(str(error_detail))
+        staged = os.path.join(self.staging_dir, f'{len(self.error_files)}_{os.path.basename(file_name)}')
+        try:
+            os.link(file_name, staged)
+        except FileNotFoundError as e:
+            print(f'Could not keep the invalid file {file_name}: {e}')
+            return
+        except OSError:
+            shutil.copyfile(file_name, staged)
+        self.pending.append(self.executor.submit(self._add_to_bundle, staged, file_name))
 
     def get_errors(self):
         return list(zip(self.error_files, self.error_data))
 
     def has_errors(self):
+        """Upload the bundle and send the summary email once per run, returns whether there were errors"""
         num_errors = len(self.error_files)
-        if num_errors > 0:
-            self._upload_details()
-            link = self._get_aws_link()
-            self._send_email(link)
+        if num_errors > 0 and not self.reported:
+            self.reported = True
+            key = self._finish_bundle()
+            self.link = self._get_aws_link(key)
+            self._send_email(self.link)
         return num_errors > 0
 
     def error_count(self):
         return len(self.error_files)
 
     def clear_errors(self):
+        """Forget the errors and start a new bundle, warm Lambda invocations reuse the instance"""
+        self._discard_bundle()
         self.error_files.clear()
         self.error_data.clear()
-
+        self.dir_name = None
+        self._start_bundle()
+
+    ###############################
+    # BUNDLE
+    ###############################
+    def _start_bundle(self):
+        self.staging_dir = tempfile.mkdtemp(prefix='invalid_files_')
+        self.bundle_path = os.path.join(self.staging_dir, self.bundle_name)
+        self.bundle = None
+        self.pending = []
+        self.reported = False
+        # Where the bundle was uploaded, once it is reported
+        self.link = None
+
+    def _add_to_bundle(self, staged_path, file_name):
+        if self.bundle is None:
+            self.bundle = tarfile.open(self.bundle_path, 'w:gz')
+        self.bundle.add(staged_path, arcname=os.path.basename(file_name))
+        os.remove(staged_path)
+
+    def _close_bundle(self):
+        if self.bundle is None:
+            self.bundle = tarfile.open(self.bundle_path, 'w:gz')
+        details = ''.join(f'{file_name}\n{error_detail}\n\n\n' for file_name, error_detail in self.get_errors())
+        info = tarfile.TarInfo('error_details.txt')
+        info.size = len(details.encode())
+        self.bundle.addfile(info, io.BytesIO(details.encode()))
+        self.bundle.close()
+        self.bundle = None
+
+    def _finish_bundle(self):
+        for future in self.pending:
+            # A file that couldn't be bundled is still listed in the error details
+            if future.exception() is not None:
+                print(f'Could not bundle an invalid file: {future.exception()}')
+        self.executor.submit(self._close_bundle).result()
+        key = f'{self._get_dir_name()}/{self.bundle_name}'
+        self.s3_client.upload_file(self.bundle_path, self.bucket_name, key)
+        if self.logger:
+            self.logger.debug(f'Uploaded {len(self.error_files)} invalid files to {key}')
+        self._discard_bundle()
+        return key
+
+    def _discard_bundle(self):
+        """Cancel the files still waiting and let the running one finish, before the bundle and its staging
+        directory go away"""
+        for future in self.pending:
+            future.cancel()
+        wait(self.pending)
+        self.pending = []
+        if self.bundle is not None:
+            self.executor.submit(self.bundle.close).result()
+            self.bundle = None
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    ###############################
+    # NOTIFICATION
+    ###############################
     def _get_dir_name(self):
         if self.dir_name is None:
             self.dir_name = str(uuid.uuid4())
+        return self.dir_name
 
-    def _get_aws_link(self):
+    def _get_aws_link(self, key=None):
         if self.dir_name is None:
             raise Exception("Must upload a file first")
-        return f"https://{self.bucket_name}.s3.{self.receiver}.amazonaws.com/{self.dir_name}"
-
-    def _upload_file(self, file_path, file_name=None):
-        file_name = file_name or os.path.basename(file_path)
-        s3_path = f'{self._get_dir_name()}/{file_name}'
-        s3_client.upload_file(file_path, self.bucket_name, s3_path)
-        if self.logger:
-            self.logger.debug(f'Uploaded {file_name} to {s3_path}')
-
-    def _upload_details(self):
-        with tempfile.NamedTemporaryFile() as tmp:
-            for file_name, error_detail in self.get_errors():
-                tmp.write(f'{file_name}\n{error_detail}\n\n\n'.encode())
-            tmp.flush()
-            tmp.seek(0)
-            self._upload_file(tmp.name, 'error_details.txt')
+        key = key or self.dir_name
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket_name}/{key}"
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
 
     def _send_email(self, link):
         subject = 'Booker Export has invalid files'
-        body = f"Here is the link to the directory on S3: {link}"
+        body = f"{len(self.error_files)} export files could not be parsed.\n\n"
+        body += ''.join(f'{os.path.basename(file_name)}: {error_detail}\n'
+                        for file_name, error_detail in self.get_errors())
+        body += f"\nThe files and error details are bundled on S3: {link}"
 
         msg = MIMEMultipart()
         msg['Subject'] = subject
@@ -92,7 +187,7 @@ class InvalidFileHandler:
         msg['To'] = self.receiver
         msg.attach(MIMEText(body, 'plain'))
 
-        ses_client.send_raw_email(
+        self.ses_client.send_raw_email(
             Source=self.sender,
             Destinations=[
                 self.receiver
@@ -101,5 +196,5 @@ class InvalidFileHandler:
                 'Data': msg.as_string(),
             }
         )
-        self.logger.debug(f'Sent email to {self.receiver}')
-
+        if self.logger:
+            self.logger.debug(f'Sent email to {self.receiver}')
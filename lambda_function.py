@@ -6,13 +6,16 @@ import requests
 from dotenv import load_dotenv
 import signal
 
-from webdriver_client import chrome_headless, chrome_testing
+from webdriver_client import chrome_headless, chrome_testing, RecyclingDriver
 from tasks import customers_today, daily_scrape, weekly_scrape, monthly_scrape, daily_appointments_booked, \
     test_response, daily_completed_appointments, create_customer, all_customers, new_typeform_customer, \
-    appointment_map, daily_orders
+    appointment_map, daily_orders, replay, bulk_create_customers, enqueue_customer, drain_customer_queue, \
+    start_session, end_session, scrape_shard, sharded_scrape, get_sink, get_customer_queue
+from metrics import start_run
+from deadline import start_deadline, current_deadline, DeadlineExceeded
 from tempfile import TemporaryDirectory
 import segment.analytics as analytics
-# from invalid_file_handler import InvalidFileHandler
+from invalid_file_handler import InvalidFileHandler
 
 seg_logger = logging.getLogger('segment')
 seg_logger.setLevel(logging.DEBUG)
@@ -46,6 +49,16 @@ RECEIVER_EMAIL = get_env_variable('RECEIVER_EMAIL')
 TYPEFORM_OBJECTS_URL = get_env_variable('TYPEFORM_OBJECTS_URL')
 
 
+# Optional settings
+LEAN_DRIVER = os.getenv('LEAN_DRIVER', '').lower() in ['1', 'true', 'yes']
+CHROME_RSS_BUDGET_MB = int(os.getenv('CHROME_RSS_BUDGET_MB', 3072))
+CHROME_HEAP_BUDGET_MB = int(os.getenv('CHROME_HEAP_BUDGET_MB', 0)) or None
+CHROME_MEMORY_SAMPLE_EVERY = int(os.getenv('CHROME_MEMORY_SAMPLE_EVERY', 10))
+METRICS_LOG_PATH = os.getenv('METRICS_LOG_PATH', '/tmp/booker_metrics.jsonl')
+# Seconds before the Lambda timeout to stop starting new work, and to stop sending
+DEADLINE_RESERVE_SECONDS = int(os.getenv('DEADLINE_RESERVE_SECONDS', 120))
+DEADLINE_SEND_RESERVE_SECONDS = int(os.getenv('DEADLINE_SEND_RESERVE_SECONDS', 20))
+
 DB_USERNAME = get_env_variable('DB_USERNAME')
 DB_PASSWORD = get_env_variable('DB_PASSWORD')
 DB_HOST = get_env_variable('DB_HOST')
@@ -58,7 +71,7 @@ analytics.send = True
 
 
 def timeout_handler(signum, frame):
-    raise TimeoutError("Timout reached outside of handled exception")
+    raise DeadlineExceeded("Timout reached outside of handled exception")
 
 
 # Set the signal handler
@@ -86,11 +99,214 @@ TASKS = {
     'create_customer': create_customer,
     'all_customers': all_customers,
     'new_typeform_customer': new_typeform_customer,
-    'appointment_map': appointment_map
+    'appointment_map': appointment_map,
+    'replay': replay,
+    'bulk_create_customers': bulk_create_customers,
+    'enqueue_customer': enqueue_customer,
+    'drain_customer_queue': drain_customer_queue,
+    'scrape_shard': scrape_shard,
+    'sharded_scrape': sharded_scrape,
 }
 
+# Tasks that never need Chrome
+BROWSERLESS_TASKS = ['replay', 'enqueue_customer', 'sharded_scrape']
+
+
+def needs_browser(task_event):
+    if task_event['task'] in BROWSERLESS_TASKS:
+        return False
+    if task_event['task'] == 'drain_customer_queue':
+        # An empty queue is answered without starting Chrome
+        queue = get_customer_queue()
+        return queue is not None and queue.size() > 0
+    return True
+
+
+def record_metrics(run_metrics, driver=None):
+    """Log the run metrics as one JSON line and return them for the response"""
+    if driver is not None:
+        run_metrics.chrome_memory = driver.memory_report()
+    try:
+        run_metrics.append(METRICS_LOG_PATH)
+    except OSError as e:
+        logger.error(f'Could not write metrics to {METRICS_LOG_PATH}: {e}')
+    metrics = run_metrics.to_dict()
+    print(f'Run metrics: {json.dumps(metrics, default=str)}')
+    return metrics
+
+
+def as_response(result):
+    # Task results that aren't a lambda response become its body
+    if not isinstance(result, dict) or 'statusCode' not in result:
+        return {
+            'statusCode': 200,
+            'body': result or 'success'
+        }
+    return result
+
+
+def with_metrics(response, metrics):
+    return {**as_response(response), 'metrics': metrics}
+
+
+def with_deadline(response, stopped):
+    """Runs the deadline cut short are partial, 206 with the work that was skipped"""
+    response = as_response(response)
+    if not stopped:
+        return response
+    return {**response, 'statusCode': 206 if response['statusCode'] == 200 else response['statusCode'],
+            'stopped': stopped}
+
+
+def get_task_arguments(task, event):
+    """Arguments a task takes from its event after (driver, download_dir, analytics).
+    Returns the extra args, the kwargs and an error message for bad requests."""
+    args = []
+    kwargs = {}
+    if task == 'create_customer':
+        customer_data = event.get('customer', None)
+        if customer_data is None:
+            return args, kwargs, 'No customer answers provided'
+        args.append(customer_data)
+        logger.debug(f'Customer data: {customer_data}')
+    elif task == 'new_typeform_customer':
+        args = [
+            event.get('customer', None),
+            event.get('typeform', None),
+            event.get('source_key', None),
+            TYPEFORM_OBJECTS_URL
+        ]
+        if not all(args):
+            return args, kwargs, 'Missing required parameters'
+    elif task == 'order_from_appointment':
+        args = [
+            event.get('appointment_id', None),
+            event.get('location', None)
+        ]
+        if not all(args):
+            return args, kwargs, 'Missing required parameters'
+    elif task == 'bulk_create_customers':
+        customers = event.get('customers', None)
+        if not customers:
+            return args, kwargs, 'No customers provided'
+        args.append(customers)
+        kwargs = {
+            'source_key': event.get('source_key', None),
+            'callback_object': TYPEFORM_OBJECTS_URL,
+        }
+    elif task == 'enqueue_customer':
+        customer_data = event.get('customer', None)
+        if customer_data is None:
+            return args, kwargs, 'No customer answers provided'
+        args.append(customer_data)
+        kwargs = {
+            'typeform': event.get('typeform', None),
+            'source_key': event.get('source_key', None),
+        }
+    elif task == 'drain_customer_queue':
+        kwargs = {
+            'batch_size': int(event.get('batch_size', 10)),
+            'max_latency': float(event.get('max_latency', 5)),
+            'callback_object': TYPEFORM_OBJECTS_URL,
+        }
+    elif task in ['all_customers', 'weekly']:
+        kwargs = {'full_resync': event.get('full_resync', False)}
+    elif task == 'scrape_shard':
+        shard = event.get('shard', None)
+        if shard is None:
+            return args, kwargs, 'No shard provided'
+        args.append(shard)
+    elif task == 'sharded_scrape':
+        kwargs = {
+            'start_date': event.get('start_date', None),
+            'end_date': event.get('end_date', None),
+            'period': int(event.get('period', 10)),
+            'types': event.get('types', None),
+            'date_type': event.get('date_type', 'date_on'),
+            'max_workers': event.get('max_workers', None),
+        }
+    elif task == 'replay':
+        kwargs = {
+            'archive_uri': event.get('archive', None),
+            'start_date': event.get('start_date', None),
+            'end_date': event.get('end_date', None),
+            'types': event.get('types', None),
+        }
+    return args, kwargs, None
+
+
+def create_driver(download_dir):
+    if ENVIRONMENT == 'test':
+        return RecyclingDriver(
+            lambda: chrome_testing(download_dir, lean=LEAN_DRIVER),
+            CHROME_RSS_BUDGET_MB, CHROME_HEAP_BUDGET_MB, CHROME_MEMORY_SAMPLE_EVERY
+        )
+    return RecyclingDriver(
+        lambda: chrome_headless(logger, download_dir, lean=LEAN_DRIVER),
+        CHROME_RSS_BUDGET_MB, CHROME_HEAP_BUDGET_MB, CHROME_MEMORY_SAMPLE_EVERY
+    )
+
+
+def run_tasks(task_events, driver, download_dir, run_metrics):
+    """Run several tasks on one driver and login, exports with the same parameters are downloaded once.
+    A failing task is reported in its result and doesn't stop the tasks after it."""
+    start_session(driver, download_dir)
+    deadline = current_deadline()
+    results = []
+    try:
+        for task_event in task_events:
+            task = task_event['task']
+            if deadline.should_stop(f'task {task}'):
+                results.append({'task': task, 'statusCode': 206, 'message': 'Skipped, the deadline was reached'})
+                continue
+            args, kwargs, _ = get_task_arguments(task, task_event)
+            print(f'Running task: {task}')
+            stopped = len(deadline.stopped)
+            try:
+                with run_metrics.phase(f'task.{task}'):
+                    result = TASKS[task](driver, download_dir, analytics, *args, **kwargs)
+                results.append({'task': task, **with_deadline(result, deadline.stopped[stopped:])})
+            except DeadlineExceeded as e:
+                logger.error(f'Task {task} stopped by the deadline: {e}')
+                results.append({
+                    'task': task,
+                    'statusCode': 206,
+                    'message': f'Task {task} stopped by the deadline: {e}',
+                    'stopped': deadline.stopped[stopped:],
+                })
+            except Exception as e:
+                logger.error(f'Error in task {task}: {e}')
+                results.append({
+                    'task': task,
+                    'statusCode': 500,
+                    'message': f'Error in task {task}: {e}'
+                })
+    finally:
+        end_session()
+    if any(result['statusCode'] >= 300 for result in results):
+        status_code = 207
+    elif any(result['statusCode'] == 206 for result in results):
+        status_code = 206
+    else:
+        status_code = 200
+    return {
+        'statusCode': status_code,
+        'results': results
+    }
+
 
 def handler(event, context):
+    """Lambda entry point. Tasks get the invocation's remaining time as their deadline, the alarm is the last
+    resort for work that doesn't check it."""
+    deadline = start_deadline(context, DEADLINE_RESERVE_SECONDS, DEADLINE_SEND_RESERVE_SECONDS)
+    deadline.arm()
+    try:
+        return handle_event(event, context)
+    finally:
+        deadline.disarm()
+
+
+def handle_event(event, context):
     analytics.write_key = SEGMENT_WRITE_KEY
     if len(MISSING_ENVIRONMENT_VARIABLES) > 0:
         error = f'Internal Server Error - Missing environment variables: {", ".join(MISSING_ENVIRONMENT_VARIABLES)}'
@@ -103,100 +319,126 @@ def handler(event, context):
         raise Exception('No internet connection')
     logger.debug('Internet connection is established')
 
-    # inval_file_handler = InvalidFileHandler(S3_BUCKET_NAME, S3_AWS_REGION, SENDER_EMAIL, RECEIVER_EMAIL, logger)
-    inval_file_handler = None
+    inval_file_handler = InvalidFileHandler(S3_BUCKET_NAME, S3_AWS_REGION, SENDER_EMAIL, RECEIVER_EMAIL, logger)
+    inval_file_handler.clear_errors()
+    try:
+        response = run_event(event)
+    finally:
+        # Also when the task failed, the quarantined files may be what failed it
+        invalid_files = report_invalid_files(inval_file_handler)
+    return with_invalid_files(response, invalid_files)
+
 
+def report_invalid_files(inval_file_handler):
+    """Upload and email the files quarantined during the run, returns their count and bundle link"""
+    try:
+        if not inval_file_handler.has_errors():
+            return None
+    except Exception as e:
+        logger.error(f'Could not report invalid files: {e}')
+        return {'error_count': inval_file_handler.error_count()}
+    logger.error(f'Task completed with errors: {inval_file_handler.error_count()} errors')
+    return {'error_count': inval_file_handler.error_count(), 'invalid_files': inval_file_handler.link}
+
+
+def with_invalid_files(response, invalid_files):
+    """Runs that quarantined files are partial, 207 with the error count and the bundle link"""
+    if not invalid_files:
+        return response
+    return {**response, 'statusCode': 207 if response['statusCode'] < 300 else response['statusCode'],
+            **invalid_files}
+
+
+def run_event(event):
     body = event.get('body', None)
     if body is not None:
         print(f'Body: {body}')
         event = json.loads(body)
 
-    task = event.get('task', None)
-    if task is None:
-        return {
-            'statusCode': 400,
-            'message': 'Bad Request - No task specified'
-        }
-    task_func = TASKS.get(task, None)
-    if task_func is None:
-        return {
-            'statusCode': 400,
-            'message': 'Bad Request - Task not found'
-        }
-
-    print(f'Running task: {task}')
+    # Either one task, or a list of task names / task events that share a driver and login
+    tasks = event.get('tasks', None)
+    if tasks is None:
+        task = event.get('task', None)
+        if task is None:
+            return {
+                'statusCode': 400,
+                'message': 'Bad Request - No task specified'
+            }
+        task_events = [event]
+    else:
+        task_events = [{'task': task} if isinstance(task, str) else task for task in tasks]
+        task = ','.join(str(task_event.get('task')) for task_event in task_events)
 
-    with TemporaryDirectory() as download_dir:
-        if ENVIRONMENT == 'test':
-            driver = chrome_testing(download_dir)
-        else:
-            driver = chrome_headless(logger, download_dir)
-
-        args = [driver, download_dir, analytics]
-        additional_args = []
-        if task == 'create_customer':
-            customer_data = event.get('customer', None)
-            if customer_data is None:
-                return {
-                    'statusCode': 400,
-                    'message': 'Bad Request - No customer answers provided'
-                }
-            args.append(customer_data)
-            logger.debug(f'Customer data: {customer_data}')
-        elif task == 'new_typeform_customer':
-            additional_args = [
-                event.get('customer', None),
-                event.get('typeform', None),
-                event.get('source_key', None),
-                TYPEFORM_OBJECTS_URL
-            ]
-            if not all(additional_args):
-                return {
-                    'statusCode': 400,
-                    'message': 'Bad Request - Missing required parameters'
-                }
-        elif task == 'order_from_appointment':
-            additional_args = [
-                event.get('appointment_id', None),
-                event.get('location', None)
-            ]
-        if not all(additional_args):
+    for task_event in task_events:
+        if TASKS.get(task_event.get('task', None), None) is None:
             return {
                 'statusCode': 400,
-                'message': 'Bad Request - Missing required parameters'
+                'message': f'Bad Request - Task not found: {task_event.get("task", None)}'
             }
-        args.extend(additional_args)
+        args, kwargs, error = get_task_arguments(task_event['task'], task_event)
+        if error is not None:
+            return {
+                'statusCode': 400,
+                'message': f'Bad Request - {error}'
+            }
+
+    run_metrics = start_run(task)
+
+    with TemporaryDirectory() as download_dir:
+        with run_metrics.phase('driver_start'):
+            if not any(needs_browser(task_event) for task_event in task_events):
+                driver = None
+            else:
+                driver = create_driver(download_dir)
+
         try:
-            response = task_func(*args)
+            if tasks is None:
+                print(f'Running task: {task}')
+                args, kwargs, _ = get_task_arguments(task, event)
+                with run_metrics.phase('task'):
+                    response = TASKS[task](driver, download_dir, analytics, *args, **kwargs)
+            else:
+                response = run_tasks(task_events, driver, download_dir, run_metrics)
+        except DeadlineExceeded as e:
+            # What was sent before the deadline is still flushed, the browser isn't needed for that
+            logger.error(f'Task {task} stopped by the deadline: {e}')
+            if driver is not None:
+                driver.quit()
+                driver = None
+            response = {
+                'statusCode': 206,
+                'message': f'Task {task} stopped by the deadline: {e}'
+            }
         except Exception as e:
-            driver.quit()
+            if driver is not None:
+                driver.quit()
+            run_metrics.extra['error'] = str(e)
+            record_metrics(run_metrics, driver)
             raise Exception(f'Error in task {task}: {e}')
 
-    driver.quit()
+    if driver is not None:
+        driver.sample_memory()
+        driver.quit()
+        print(f'Chrome memory: {driver.memory_report()}')
 
     try:
-        analytics.flush()
+        with run_metrics.phase('flush'):
+            analytics.flush()
+            get_sink(analytics).flush()
+    except DeadlineExceeded as e:
+        # The alarm fired while flushing, records still queued weren't sent
+        logger.error(f'Flush stopped by the deadline: {e}')
+        current_deadline().stopped.append('flushing the sends')
     except TimeoutError as e:
         logger.error("Analytics shutdown took too long")
-        return {
+        return with_metrics({
             'statusCode': 500,
             'message': 'Internal Server Error - Analytics shutdown took too long'
-        }
-    if inval_file_handler is not None and inval_file_handler.has_errors():
-        logger.error(f'Task completed with errors: {inval_file_handler.error_count()} errors')
-        return {
-            'statusCode': 200,
-            'message': 'Task completed with errors',
-            'error_count': inval_file_handler.error_count()
-        }
-
-    if response:
-        return response
-    else:
-        return {
-            'statusCode': 200,
-            'body': 'success'
-        }
+        }, record_metrics(run_metrics, driver))
+    stopped = current_deadline().stopped
+    if stopped:
+        run_metrics.extra['stopped'] = stopped
+    return with_metrics(with_deadline(response, stopped), record_metrics(run_metrics, driver))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+import json
+import time
+
+import pyarrow.fs as pafs
+
+from archive import open_filesystem
+from deadline import DeadlineExceeded
+
+# Spas known before discovery. Their export views name the views to look for on the other spas.
+DEFAULT_LOCATIONS = {
+    'll': {
+        'id': '36085',
+        'appointments_view_id': 57651,
+        'orders_view_id': 57650,
+    },
+    'cda': {
+        'id': '51309',
+        'appointments_view_id': 57707,
+        'orders_view_id': 57738,
+    }
+}
+
+# Location field -> discovered {view id: view name} of the spa
+VIEW_FIELDS = {
+    'appointments_view_id': 'appointments_views',
+    'orders_view_id': 'orders_views',
+}
+
+
+class LocationRegistry:
+    """Spas of the brand and their export view ids, discovered from the brand admin pages and cached for ttl
+    seconds in a local directory or on S3. Falls back to the last discovery, or DEFAULT_LOCATIONS, when
+    discovery fails."""
+    file_name = 'locations.json'
+
+    def __init__(self, uri, ttl=24 * 60 * 60, seeds=None):
+        self.uri = uri
+        self.ttl = ttl
+        self.seeds = seeds or DEFAULT_LOCATIONS
+        self.filesystem, root = open_filesystem(uri)
+        self.root = root.rstrip('/')
+        self.path = f'{self.root}/{self.file_name}'
+
+    def load(self):
+        """Cached locations and the time they were discovered, (None, None) when nothing is cached"""
+        if self.filesystem.get_file_info(self.path).type == pafs.FileType.NotFound:
+            return None, None
+        with self.filesystem.open_input_stream(self.path) as f:
+            data = json.loads(f.read())
+        return data['locations'], data['discovered_at']
+
+    def save(self, locations):
+        self.filesystem.create_dir(self.root, recursive=True)
+        with self.filesystem.open_output_stream(self.path) as f:
+            f.write(json.dumps({'locations': locations, 'discovered_at': time.time()}).encode())
+
+    def match_views(self, spas):
+        """Pick the export views of every discovered spa. Seeded spas keep their views, the others use the
+        view with the same name as the seeded one. Spas without matching views are left out."""
+        seeds_by_id = {location['id']: (key, location) for key, location in self.seeds.items()}
+        view_names = {view: set() for view in VIEW_FIELDS}
+        for spa in spas:
+            if spa['id'] in seeds_by_id:
+                key, seed = seeds_by_id[spa['id']]
+                for view, field in VIEW_FIELDS.items():
+                    name = spa[field].get(str(seed[view]))
+                    if name:
+                        view_names[view].add(name)
+
+        locations = {}
+        for spa in spas:
+            if spa['id'] in seeds_by_id:
+                key, seed = seeds_by_id[spa['id']]
+                locations[key] = {**seed, 'name': spa['name']}
+                continue
+            location = {'id': spa['id'], 'name': spa['name']}
+            for view, field in VIEW_FIELDS.items():
+                matches = [int(value) for value, name in spa[field].items() if name in view_names[view]]
+                if matches:
+                    location[view] = matches[0]
+            if 'appointments_view_id' in location and 'orders_view_id' in location:
+                locations[spa['id']] = location
+            else:
+                print(f'No export views found for spa {spa["name"]} ({spa["id"]}), skipping it')
+        return locations
+
+    def cached(self):
+        """Last discovered locations regardless of their age, for callers without a browser"""
+        try:
+            locations, discovered_at = self.load()
+        except Exception as e:
+            print(f'Could not read the location cache {self.path}')
+            print(e)
+            locations = None
+        return locations or dict(self.seeds)
+
+    def get(self, scraper, refresh=False):
+        """Locations to scrape, discovered through the logged in scraper when the cache is stale"""
+        try:
+            locations, discovered_at = self.load()
+        except Exception as e:
+            print(f'Could not read the location cache {self.path}')
+            print(e)
+            locations, discovered_at = None, None
+        if locations and not refresh and time.time() - discovered_at < self.ttl:
+            return locations
+
+        try:
+            discovered = self.match_views(scraper.discover_locations())
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print('Location discovery failed, using the cached locations')
+            print(e)
+            return locations or dict(self.seeds)
+        if not discovered:
+            return locations or dict(self.seeds)
+        print(f'Discovered {len(discovered)} locations: {", ".join(discovered)}')
+        try:
+            self.save(discovered)
+        except Exception as e:
+            print(f'Could not write the location cache {self.path}')
+            print(e)
+        return discovered
@@ -0,0 +1,152 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+
+def current_rss():
+    """Resident memory of this process in bytes, None where /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class RunMetrics:
+    """Throughput numbers of one handler invocation: rows parsed per type and location, records sent per
+    collection, bytes downloaded and uploaded, phase durations, retries and peak memory. A warm Lambda container
+    runs many invocations in one process, so the run's peak is sampled at every phase boundary and the process
+    lifetime peak is reported separately as the container's."""
+
+    def __init__(self, task=None):
+        self.task = task
+        self.started_at = datetime.now(timezone.utc)
+        self.rows_parsed = {}
+        self.records_sent = {}
+        self.bytes_downloaded = 0
+        self.files_downloaded = 0
+        self.chunks_resumed = 0
+        self.uploads = {'batches': 0, 'raw_bytes': 0, 'sent_bytes': 0, 'seconds': 0}
+        self.phases = {}
+        self.retries = 0
+        self.retries_by_step = {}
+        self.round_trips = {'total': 0, 'flows': {}}
+        self.chrome_memory = None
+        self.extra = {}
+        self.peak_rss = None
+        self.sample_rss()
+
+    def add_rows(self, type, location, count):
+        location = str(location) if location is not None else 'all'
+        locations = self.rows_parsed.setdefault(type, {})
+        locations[location] = locations.get(location, 0) + count
+
+    def add_sent(self, collection, count):
+        self.records_sent[collection] = self.records_sent.get(collection, 0) + count
+
+    def add_download(self, size):
+        self.bytes_downloaded += size
+        self.files_downloaded += 1
+
+    def add_resumed_chunk(self):
+        self.chunks_resumed += 1
+
+    def add_upload(self, raw_bytes, sent_bytes, seconds):
+        self.uploads['batches'] += 1
+        self.uploads['raw_bytes'] += raw_bytes
+        self.uploads['sent_bytes'] += sent_bytes
+        self.uploads['seconds'] += seconds
+
+    def add_retry(self, step=None):
+        self.retries += 1
+        if step is not None:
+            self.retries_by_step[step] = self.retries_by_step.get(step, 0) + 1
+
+    def add_round_trips(self, flow, count, nested=False):
+        """Round trips of a flow, a nested flow's are already in the total of the flow that called it"""
+        if not nested:
+            self.round_trips['total'] += count
+        self.round_trips['flows'][flow] = self.round_trips['flows'].get(flow, 0) + count
+
+    def sample_rss(self):
+        rss = current_rss()
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+            self.sample_rss()
+
+    def to_dict(self):
+        self.sample_rss()
+        # ru_maxrss is in kilobytes on Linux
+        container_peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return {
+            'task': self.task,
+            'started_at': self.started_at.isoformat(),
+            'duration_s': round((datetime.now(timezone.utc) - self.started_at).total_seconds(), 3),
+            'rows_parsed': self.rows_parsed,
+            'records_sent': self.records_sent,
+            'bytes_downloaded': self.bytes_downloaded,
+            'files_downloaded': self.files_downloaded,
+            'chunks_resumed': self.chunks_resumed,
+            'uploads': {
+                **self.uploads,
+                'seconds': round(self.uploads['seconds'], 3),
+                'compression_ratio': round(self.uploads['raw_bytes'] / self.uploads['sent_bytes'], 2)
+                if self.uploads['sent_bytes'] else None,
+            },
+            'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            'retries': self.retries,
+            'retries_by_step': self.retries_by_step,
+            'round_trips': self.round_trips,
+            'peak_python_rss_mb': round(self.peak_rss / 1024 / 1024, 1) if self.peak_rss is not None else None,
+            'container_peak_rss_mb': round(container_peak_rss_mb, 1),
+            'chrome_memory': self.chrome_memory,
+            **self.extra,
+        }
+
+    def append(self, path):
+        """Append the metrics as one line of a JSONL log"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.to_dict(), default=str) + '\n')
+
+
+_current_run = RunMetrics()
+
+
+def start_run(task):
+    global _current_run
+    _current_run = RunMetrics(task)
+    return _current_run
+
+
+def current_run():
+    """Metrics of the running invocation, code outside the handler records into a throwaway instance"""
+    return _current_run
+
+
+def timed(name):
+    """Add the duration of every call to the named phase of the current run"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with current_run().phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
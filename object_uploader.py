@@ -0,0 +1,87 @@
+import gzip
+import json
+from time import perf_counter
+
+import requests
+
+from metrics import current_run
+from retry import RetryPolicy
+
+OBJECTS_URL = 'https://objects.segment.com/v1/set'
+
+
+class RetryableResponse(requests.HTTPError):
+    """429 and 5xx responses, the batch is sent again"""
+
+
+# Transient failures the Segment client retries as well
+UPLOAD_RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, RetryableResponse)
+
+
+class ObjectUploader:
+    """Batches objects per collection and posts them to the Segment Objects API, the same /v1/set payload
+    analytics.object sends. Bodies are gzip compressed at compress_level (1-9, 0 sends them uncompressed). The
+    exports repeat the same keys, locations and statuses on every row, so batches compress well. Connection
+    errors, 429 and 5xx responses are retried with jittered backoff, up to max_attempts times per batch."""
+
+    def __init__(self, write_key, url=OBJECTS_URL, compress_level=6, batch_size=100, max_batch_bytes=500_000,
+                 session=None, max_attempts=5):
+        if not 0 <= compress_level <= 9:
+            raise ValueError('compress_level must be between 0 and 9')
+        self.write_key = write_key
+        self.url = url
+        self.compress_level = compress_level
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.session = session or requests.Session()
+        self.retry = RetryPolicy('upload', max_attempts=max_attempts, base_delay=1, max_delay=30,
+                                 retryable=UPLOAD_RETRYABLE_ERRORS, sending=True)
+        # collection -> (encoded objects, their size in bytes)
+        self.batches = {}
+        self.sent_batches = 0
+
+    def object(self, object_id, collection, properties):
+        encoded = json.dumps({'id': object_id, 'properties': properties}, default=str)
+        objects, size = self.batches.get(collection, ([], 0))
+        if objects and size + len(encoded) > self.max_batch_bytes:
+            self.send_batch(collection, objects)
+            objects, size = [], 0
+        objects.append(encoded)
+        self.batches[collection] = (objects, size + len(encoded) + 1)
+        if len(objects) >= self.batch_size:
+            self.send_batch(collection, objects)
+            del self.batches[collection]
+
+    def flush(self):
+        for collection, (objects, size) in list(self.batches.items()):
+            self.send_batch(collection, objects)
+        self.batches = {}
+
+    def send_batch(self, collection, objects):
+        """Post one batch and report its compression ratio and upload time"""
+        body = f'{{"collection": {json.dumps(collection)}, "objects": [{",".join(objects)}]}}'.encode()
+        headers = {'Content-Type': 'application/json'}
+        start = perf_counter()
+        if self.compress_level:
+            data = gzip.compress(body, compresslevel=self.compress_level)
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            data = body
+        compress_seconds = perf_counter() - start
+        try:
+            self.retry.call(self.post, data, headers)
+        except Exception:
+            print(f'Could not upload {len(objects)} {collection}, {self.sent_batches} batches were uploaded before')
+            raise
+        self.sent_batches += 1
+        seconds = perf_counter() - start
+        print(f'Uploaded {len(objects)} {collection}: {len(body) / 1024:.1f} KB -> {len(data) / 1024:.1f} KB '
+              f'({len(body) / len(data):.1f}x) in {seconds:.3f}s, {compress_seconds:.3f}s compressing')
+        current_run().add_upload(len(body), len(data), seconds)
+
+    def post(self, data, headers):
+        response = self.session.post(self.url, data=data, headers=headers, auth=(self.write_key, ''), timeout=30)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableResponse(f'{response.status_code} from {self.url}', response=response)
+        response.raise_for_status()
+        return response
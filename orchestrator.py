@@ -0,0 +1,138 @@
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+
+import boto3
+from botocore.config import Config
+
+from deadline import current_deadline
+from metrics import current_run
+
+SHARD_TYPES = ['Appointment', 'Order']
+
+
+def plan_shards(locations, start_date, end_date, period_days, types=None, date_type='date_on'):
+    """Split a scrape into one shard per location, export type and date window. The windows are the chunks the
+    sequential appointments_export and orders_export loops would have exported, the last one ends on end_date."""
+    period = timedelta(days=period_days)
+    shards = []
+    for location in locations.values():
+        for type in types or SHARD_TYPES:
+            current = start_date
+            while current <= end_date:
+                shards.append({
+                    'type': type,
+                    'location': location,
+                    'start_date': current.isoformat(),
+                    'end_date': min(current + period - timedelta(days=1), end_date).isoformat(),
+                    # Orders are always exported by the date they were created
+                    'date_type': date_type if type == 'Appointment' else 'date_created',
+                })
+                current += period
+    return shards
+
+
+def shard_name(shard):
+    return f'{shard["type"]} {shard["location"]["id"]} {shard["start_date"]}-{shard["end_date"]}'
+
+
+class LocalDispatcher:
+    """Runs every shard in a worker process that starts its own browser"""
+
+    def __init__(self, worker, max_workers=2):
+        self.worker = worker
+        self.max_workers = max_workers
+
+    def executor(self):
+        return ProcessPoolExecutor(self.max_workers)
+
+    def submit(self, executor, shard):
+        return executor.submit(self.worker, shard)
+
+
+class LambdaDispatcher:
+    """Runs every shard as its own synchronous invocation of the scraper Lambda. The client waits as long as a
+    Lambda can run and never retries by itself, a timed out invocation re-sent by botocore would scrape the same
+    window again while the first one is still running. Failed shards are retried by the Orchestrator."""
+
+    def __init__(self, function_name, max_workers=10, client=None):
+        self.function_name = function_name
+        self.max_workers = max_workers
+        self.client = client or boto3.client('lambda', config=Config(
+            read_timeout=900,
+            connect_timeout=10,
+            retries={'max_attempts': 0},
+        ))
+
+    def executor(self):
+        return ThreadPoolExecutor(self.max_workers)
+
+    def submit(self, executor, shard):
+        return executor.submit(self.invoke, shard)
+
+    def invoke(self, shard):
+        response = self.client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps({'task': 'scrape_shard', 'shard': shard}).encode(),
+        )
+        payload = json.loads(response['Payload'].read() or 'null')
+        if response.get('FunctionError'):
+            error = payload.get('errorMessage', payload) if isinstance(payload, dict) else payload
+            raise Exception(f'Shard invocation failed: {error}')
+        if isinstance(payload, dict) and payload.get('statusCode', 200) >= 300:
+            raise Exception(f'Shard invocation returned {payload.get("statusCode")}: {payload.get("message")}')
+        return payload
+
+
+class Orchestrator:
+    """Dispatches shards to parallel workers. A failed shard is dispatched again on its own, up to max_attempts
+    times, while the other shards keep running. Once the deadline is reached no shard is retried and the shards
+    still running are left behind, so what finished can still be merged and sent."""
+
+    def __init__(self, dispatcher, max_attempts=3, poll_seconds=5):
+        self.dispatcher = dispatcher
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+
+    def run(self, shards):
+        """Returns (shard, result) for the shards that succeeded, (shard, error) for the ones that didn't and the
+        shards the deadline stopped"""
+        results = {}
+        failed = {}
+        stopped = []
+        attempts = {}
+        futures = {}
+        executor = self.dispatcher.executor()
+        try:
+            def submit(i):
+                attempts[i] = attempts.get(i, 0) + 1
+                futures[self.dispatcher.submit(executor, shards[i])] = i
+
+            for i in range(len(shards)):
+                submit(i)
+            while futures:
+                done, _ = wait(futures, timeout=self.poll_seconds, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = futures.pop(future)
+                    try:
+                        results[i] = future.result()
+                        print(f'Shard {shard_name(shards[i])} finished')
+                    except Exception as e:
+                        print(f'Shard {shard_name(shards[i])} failed on attempt {attempts[i]}/{self.max_attempts}')
+                        print(e)
+                        if attempts[i] < self.max_attempts and \
+                                not current_deadline().should_stop(f'retrying shard {shard_name(shards[i])}'):
+                            current_run().add_retry('shard')
+                            submit(i)
+                        else:
+                            failed[i] = str(e)
+                if futures and current_deadline().should_stop(f'waiting for {len(futures)} shards'):
+                    stopped = sorted(futures.values())
+                    break
+        finally:
+            # Shards that haven't started are cancelled, running ones are not waited for after the deadline
+            executor.shutdown(wait=not stopped, cancel_futures=True)
+        return [(shards[i], results[i]) for i in sorted(results)], \
+            [(shards[i], failed[i]) for i in sorted(failed)], \
+            [shards[i] for i in stopped]
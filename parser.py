@@ -1,25 +1,47 @@
+import csv
 import os
-from datetime import datetime
-# from invalid_file_handler import InvalidFileHandler
+from datetime import datetime, timezone
+from invalid_file_handler import InvalidFileHandler
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+from archive import ExportArchive, ARCHIVED_AT_FORMAT
+from deadline import DeadlineExceeded
+from metrics import current_run, timed
+from schema import apply_schema, MONEY_COLUMNS, NATURAL_KEYS, STRING_DTYPE
+from validation import ExportValidator
 
 DATE_FORMAT = '%b %d, %Y'
 DATETIME_FORMAT = '%b %-d, %Y  %-I:%M %p'
+ENGINES = ['pandas', 'pyarrow']
 
 
 class BookerParser:
-    def __init__(self, directory):
+    """Parses the exports in directory, laid out by BookerScraper.move_file. A manifest of the downloads, as kept
+    by BookerScraper.manifest, is parsed directly instead and the directory is not listed. Exports that fail
+    validation are handled like files that don't parse."""
+    def __init__(self, directory, archive=None, typed=False, engine='pandas', manifest=None, validate=True):
+        if engine not in ENGINES:
+            raise ValueError(f'engine must be one of {ENGINES}')
         self.directory = directory
+        self.manifest = manifest
+        self.archive = archive
+        self.typed = typed
+        self.engine = engine
         self.skip_invalid_move = True
+        # Files this parser quarantined, the frames built without them are incomplete
+        self.quarantined = []
+        self.validator = ExportValidator() if validate else None
         try:
-            # self.invalid_file_handler = InvalidFileHandler()
-            self.invalid_file_handler = None
+            self.invalid_file_handler = InvalidFileHandler()
         except Exception as e:
             print('Could not initialize InvalidFileHandler')
             print(e)
             self.invalid_file_handler = None
 
-        subdirectories = os.listdir(self.directory)
+        subdirectories = os.listdir(self.directory) if manifest is None else []
         categories = ['Appointments', 'Customers', 'Orders']
         self.category_directories = [c for c in subdirectories if c in categories]
         self.datetime_parser = lambda x: datetime.strptime(x, DATETIME_FORMAT.replace('-', '')).isoformat()
@@ -109,8 +131,159 @@ class BookerParser:
     ###############################
 
     @staticmethod
-    def add_location_to_df(df, file_path):
-        location = os.path.basename(os.path.dirname(file_path))
+    def _stack_text(df, columns):
+        """All cells of the given columns as one Arrow string series, column after column"""
+        return pd.Series(df[columns].to_numpy(dtype=object).ravel(order='F'), dtype=STRING_DTYPE)
+
+    @staticmethod
+    def _unstack_text(df, columns, stacked):
+        if not any(df[column].dtype == STRING_DTYPE for column in columns):
+            df[columns] = stacked.to_numpy(dtype=object, na_value=None).reshape((len(df), len(columns)), order='F')
+            return
+        # Columns read by the pyarrow engine stay Arrow strings
+        for i, column in enumerate(columns):
+            values = stacked.iloc[i * len(df):(i + 1) * len(df)].set_axis(df.index)
+            if df[column].dtype == STRING_DTYPE:
+                df[column] = values
+            else:
+                df[column] = values.to_numpy(dtype=object, na_value=None)
+
+    @classmethod
+    def normalize_money(cls, df, columns, blank=None):
+        """Strip dollar signs and thousands separators from every money column in a single Arrow pass.
+        Blank cells become `blank` when it is given."""
+        # Columns pandas already read as numbers have nothing to strip
+        columns = [column for column in columns if df[column].dtype in [object, STRING_DTYPE]]
+        if len(df) == 0 or not columns:
+            return
+        money = cls._stack_text(df, columns)
+        if blank is not None:
+            money = money.mask(money == '', blank)
+        cls._unstack_text(df, columns, money.str.replace(r'[\$,]', '', regex=True))
+
+    @classmethod
+    def normalize_phones(cls, df, columns):
+        """Normalize phone columns to E.164, numbers without a country code are assumed to be +1"""
+        if len(df) == 0 or not columns:
+            return
+        digits = cls._stack_text(df, columns).str.replace(r'\D', '', regex=True)
+        has_country_code = (digits.str.len() == 11) & digits.str.startswith('1')
+        phones = ('+1' + digits).mask(has_country_code, '+' + digits).mask(digits == '', digits)
+        cls._unstack_text(df, columns, phones)
+
+    @staticmethod
+    def _infer_number_type(column):
+        """Cast a string column to the type pandas' CSV reader would infer for it"""
+        if column.null_count == len(column):
+            # pandas reads a column without any values as float NaN
+            return column.cast(pa.float64())
+        for type in [pa.int64(), pa.float64(), pa.bool_()]:
+            try:
+                return pc.cast(column, type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                pass
+        return column
+
+    @staticmethod
+    def _timestamp_text_format(column):
+        # Matches Series.astype(str) on datetimes, which leaves the time out when every value is at midnight
+        if pc.all(pc.equal(pc.strftime(column, format='%H:%M:%S'), '00:00:00')).as_py():
+            return '%Y-%m-%d'
+        return '%Y-%m-%d %H:%M:%S'
+
+    def read_csv_arrow(self, file_path, columns=None, timestamp_columns=None, timestamp_format=None,
+                       keep_blank=False, infer_types=True, escape_char=False):
+        """The pyarrow engine's read_csv: a multithreaded read of only the given columns into Arrow strings.
+        Columns are read as text and typed afterwards the way pandas infers them, so text that looks like a date
+        stays text. Timestamp columns are parsed with timestamp_format and returned as the same strings the
+        pandas engine produces. keep_blank keeps empty cells as '' (keep_default_na=False)."""
+        timestamp_columns = timestamp_columns or []
+        with open(file_path, newline='') as f:
+            names = next(csv.reader(f))
+        column_types = {name: pa.string() for name in names}
+        column_types.update({name: pa.timestamp('s') for name in timestamp_columns})
+        convert_options = pacsv.ConvertOptions(
+            include_columns=[name for name in names if columns is None or name in columns],
+            column_types=column_types,
+            timestamp_parsers=[timestamp_format] if timestamp_format else None,
+            strings_can_be_null=not keep_blank,
+            null_values=[] if keep_blank else None,
+        )
+        with pa.memory_map(file_path) as source:
+            table = pacsv.read_csv(
+                source,
+                parse_options=pacsv.ParseOptions(escape_char=escape_char),
+                convert_options=convert_options,
+            )
+
+        arrays = []
+        for name in table.column_names:
+            column = table[name]
+            if name in timestamp_columns:
+                if column.null_count:
+                    raise ValueError(f'{name} is missing dates')
+                column = pc.strftime(column, format=self._timestamp_text_format(column))
+            elif infer_types:
+                column = self._infer_number_type(column)
+            arrays.append(column)
+        table = pa.table(arrays, names=table.column_names)
+        return table.to_pandas(types_mapper={pa.string(): STRING_DTYPE}.get)
+
+    @staticmethod
+    def count_rows(file_path, escape_char=None):
+        """Data rows of an export, read as plain CSV without parsing, validating or quarantining it"""
+        with open(file_path, newline='') as f:
+            return max(sum(1 for _ in csv.reader(f, escapechar=escape_char)) - 1, 0)
+
+    @staticmethod
+    def list_files(directory):
+        """Files in the order they were exported, so the newest copy of a row is parsed last. Exports staged from
+        the archive carry their archive time in the name, their modification time is only when they were copied."""
+        def exported_at(file):
+            modified = datetime.fromtimestamp(os.path.getmtime(os.path.join(directory, file)), timezone.utc)
+            return ExportArchive.archived_at(file) or modified.strftime(ARCHIVED_AT_FORMAT), file
+        return sorted(os.listdir(directory), key=exported_at)
+
+    def export_files(self, type):
+        """Manifest entries (type, location, start_date, end_date, path) of the type's exports in the order they
+        were exported. Without a manifest they are listed from the directory and file names."""
+        if self.manifest is not None:
+            return [entry for entry in self.manifest if entry['type'] == type]
+        type_dir = os.path.join(self.directory, type)
+        if type == 'Customer':
+            return [{'type': type, 'location': None, 'start_date': None, 'end_date': None,
+                     'path': os.path.join(type_dir, file)} for file in self.list_files(type_dir)]
+        entries = []
+        for location in os.listdir(type_dir):
+            for file in self.list_files(os.path.join(type_dir, location)):
+                try:
+                    start_date, end_date = self.get_dates_from_file_name(file)
+                except (IndexError, ValueError):
+                    start_date, end_date = None, None
+                entries.append({'type': type, 'location': location, 'start_date': start_date,
+                                'end_date': end_date, 'path': os.path.join(type_dir, location, file)})
+        return entries
+
+    @staticmethod
+    def deduplicate(df, frame):
+        """Drop rows repeated by overlapping export windows, keeping the newest version of each entity"""
+        keys = [key for key in NATURAL_KEYS[frame] if key in df.columns]
+        if not keys:
+            return df
+        deduplicated = df.drop_duplicates(subset=keys, keep='last').reset_index(drop=True)
+        if len(deduplicated) < len(df):
+            print(f'Dropped {len(df) - len(deduplicated)} duplicate {frame}')
+        return deduplicated
+
+    @staticmethod
+    def empty_frame(columns):
+        """Frame of an import where no file parsed, every export was missing or quarantined"""
+        return pd.DataFrame(columns=list(columns))
+
+    @staticmethod
+    def add_location_to_df(df, file_path, location=None):
+        if location is None:
+            location = os.path.basename(os.path.dirname(file_path))
         df['location'] = location
 
     def validate_dates_in_df_match_file_name(self, df, file_name, date_column):
@@ -131,6 +304,26 @@ class BookerParser:
         if min_date < start_date or max_date > end_date:
             raise ValueError(f'Dates in {file_name} do not match the date range in the file name')
 
+    def validate(self, export, frames):
+        if self.validator is not None:
+            self.validator.validate(export, frames)
+
+    def file_parsed(self, type, file_path, frames, location=None):
+        """Count the parsed rows and keep a copy of the parsed frames, archive failures never stop an import"""
+        if location is None and type != 'Customer':
+            location = os.path.basename(os.path.dirname(file_path))
+        for name, df in frames.items():
+            current_run().add_rows(name, location, len(df))
+        if self.archive is None:
+            return
+        try:
+            self.archive.archive_frames(location, file_path, frames)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f'Could not archive {file_path}')
+            print(e)
+
     @staticmethod
     def get_dates_from_file_name(file_name):
         date_range = file_name.split(' ')[1].replace('.csv', '')
@@ -151,26 +344,36 @@ class BookerParser:
     ###############################
     # APPOINTMENTS
     ###############################
-    def appointment_file_to_df(self, file_name):
+    def appointment_file_to_df(self, file_name, location=None):
         date_fields = ['Start Date/Time', 'End Date/Time']
         headers = {
             **self.appointment_headers,
             **self.appointment_customer_headers
         }
-        df = pd.read_csv(
-            file_name,
-            usecols=headers.keys(),
-            parse_dates=date_fields,
-            converters={k: self.datetime_parser for k in date_fields}
-        )
+        if self.engine == 'pyarrow':
+            df = self.read_csv_arrow(
+                file_name,
+                columns=headers.keys(),
+                timestamp_columns=date_fields,
+                timestamp_format=DATETIME_FORMAT.replace('-', ''),
+            )
+        else:
+            df = pd.read_csv(
+                file_name,
+                memory_map=True,
+                usecols=headers.keys(),
+                parse_dates=date_fields,
+                converters={k: self.datetime_parser for k in date_fields}
+            )
         df.rename(columns=headers, inplace=True)
 
-        for date_field in ['Start Date/Time', 'End Date/Time']:
-            renamed_header = headers[date_field]
-            df[renamed_header] = df[renamed_header].astype(str)
+        if self.engine == 'pandas':
+            for date_field in ['Start Date/Time', 'End Date/Time']:
+                renamed_header = headers[date_field]
+                df[renamed_header] = df[renamed_header].astype(str)
 
         df.fillna('', inplace=True)
-        self.add_location_to_df(df, file_name)
+        self.add_location_to_df(df, file_name, location)
         return df
 
     def appointment_file_to_treatment_df(self, file_name):
@@ -179,113 +382,154 @@ class BookerParser:
             **self.appointment_customer_headers,
             'Booking Number': 'appointment'
         }
-        df = pd.read_csv(
-            file_name,
-            usecols=list(headers.keys()),
-            parse_dates=['Appointment On'],
-            converters={
-                'Appointment On': self.datetime_parser,
-            }
-        )
+        if self.engine == 'pyarrow':
+            df = self.read_csv_arrow(
+                file_name,
+                columns=headers.keys(),
+                timestamp_columns=['Appointment On'],
+                timestamp_format=DATETIME_FORMAT.replace('-', ''),
+            )
+        else:
+            df = pd.read_csv(
+                file_name,
+                memory_map=True,
+                usecols=list(headers.keys()),
+                parse_dates=['Appointment On'],
+                converters={
+                    'Appointment On': self.datetime_parser,
+                }
+            )
         df.rename(columns=headers, inplace=True)
-        df['appointment_on'] = df['appointment_on'].astype(str)
-        df['total'].replace('[\$,]', '', regex=True, inplace=True)
-        df['tax'].replace('[\$,]', '', regex=True, inplace=True)
-        df['price'].replace('[\$,]', '', regex=True, inplace=True)
+        if self.engine == 'pandas':
+            df['appointment_on'] = df['appointment_on'].astype(str)
+        self.normalize_money(df, MONEY_COLUMNS['treatments'])
         df.fillna('', inplace=True)
         return df
 
-    def appointment_process(self, file_path):
-        appointment_df = self.appointment_file_to_df(file_path)
+    def appointment_process(self, file_path, location=None):
+        appointment_df = self.appointment_file_to_df(file_path, location)
         treatment_df = self.appointment_file_to_treatment_df(file_path)
+        if self.typed:
+            appointment_df = apply_schema(appointment_df, 'appointments')
+            treatment_df = apply_schema(treatment_df, 'treatments')
 
         return appointment_df, treatment_df
 
-    def mport_appointments(self):
-        # Get the appointments directory
-        appointments_dir = os.path.join(self.directory, 'Appointment')
-
-        # Get the list of files in the appointments directory
-        locations = os.listdir(appointments_dir)
-
+    @timed('parse')
+    def import_appointments(self):
         appointments_dfs = []
         treatments_dfs = []
         # Loop through the files
-        for location in locations:
-            files = os.listdir(os.path.join(appointments_dir, location))
-            for file in files:
-                # Get the file path
-                file_path = os.path.join(appointments_dir, location, file)
-                try:
-                    appointment_df, treatment_df = self.appointment_process(file_path)
-                    appointments_dfs.append(appointment_df)
-                    treatments_dfs.append(treatment_df)
-                except Exception as e:
-                    if self.invalid_file_handler:
-                        self.invalid_file_handler.add_error(file_path, e)
-                    else:
-                        raise e
+        for export in self.export_files('Appointment'):
+            file_path = export['path']
+            try:
+                appointment_df, treatment_df = self.appointment_process(file_path, export['location'])
+                self.validate(export, {'appointments': appointment_df, 'treatments': treatment_df})
+                appointments_dfs.append(appointment_df)
+                treatments_dfs.append(treatment_df)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if self.invalid_file_handler:
+                    self.quarantined.append(file_path)
+                    self.invalid_file_handler.add_error(file_path, e)
+                    continue
+                else:
+                    raise e
+            self.file_parsed('Appointment', file_path, {
+                'appointments': appointment_df,
+                'treatments': treatment_df,
+            }, export['location'])
 
         # return appointment, treatment
-        return pd.concat(appointments_dfs, ignore_index=True), pd.concat(treatments_dfs, ignore_index=True)
+        if not appointments_dfs:
+            appointments_dfs = [self.empty_frame([
+                *self.appointment_headers.values(), *self.appointment_customer_headers.values(), 'location'
+            ])]
+            treatments_dfs = [self.empty_frame([
+                *self.appointment_treatment_headers.values(), *self.appointment_customer_headers.values(),
+                'appointment'
+            ])]
+        appointment_df = pd.concat(appointments_dfs, ignore_index=True)
+        treatment_df = pd.concat(treatments_dfs, ignore_index=True)
+        if self.typed:
+            # Categories that differ between files concat to object, restore them
+            appointment_df = apply_schema(appointment_df, 'appointments')
+            treatment_df = apply_schema(treatment_df, 'treatments')
+        return self.deduplicate(appointment_df, 'appointments'), self.deduplicate(treatment_df, 'treatments')
 
     ###############################
     # Orders
     ###############################
-    def order_file_to_df(self, file_path):
-        df = pd.read_csv(
-            file_path,
-            keep_default_na=False,
-            escapechar='\\',
-            parse_dates=['Order Date'],
-            converters={'Order Date': self.date_parser},
-            usecols=self.order_headers.keys(),
-        )
+    def order_file_to_df(self, file_path, location=None):
+        if self.engine == 'pyarrow':
+            df = self.read_csv_arrow(
+                file_path,
+                columns=self.order_headers.keys(),
+                timestamp_columns=['Order Date'],
+                timestamp_format='%b %d, %Y',
+                keep_blank=True,
+                escape_char='\\',
+            )
+        else:
+            df = pd.read_csv(
+                file_path,
+                memory_map=True,
+                keep_default_na=False,
+                escapechar='\\',
+                parse_dates=['Order Date'],
+                converters={'Order Date': self.date_parser},
+                usecols=self.order_headers.keys(),
+            )
         df.rename(columns=self.order_headers, inplace=True)
-        df['order_date'] = df['order_date'].astype(str)
-        for index in ['Total Price', 'Refund Amount', 'Balance', 'Total Products', 'Total Treatments',
-                      'Total Packages', 'Total Series', 'Total Gift Certificate Cards', 'Total Cancellation Fee',
-                      'Total Discount Special', 'Tax', 'Tip', 'Total Tips', 'Prepaid Credit']:
-            df[self.order_headers[index]].replace('', '0.00', inplace=True)
-            df[self.order_headers[index]].replace('[\$,]', '', regex=True, inplace=True)
+        if self.engine == 'pandas':
+            df['order_date'] = df['order_date'].astype(str)
+        self.normalize_money(df, MONEY_COLUMNS['orders'], blank='0.00')
 
         df['customer'].replace('[\{\}]', '', regex=True, inplace=True)
         df['last_refund_date'].replace({'': None}, inplace=True)
 
-        self.add_location_to_df(df, file_path)
-        # self.validate_dates_in_df_match_file_name(df, file_path, 'order_date')
+        self.add_location_to_df(df, file_path, location)
         return df
 
+    @timed('parse')
     def import_orders(self):
-        # Get the orders directory
-        orders_dir = os.path.join(self.directory, 'Order')
-
-        # Get the list of files in the orders directory
-        locations = os.listdir(orders_dir)
-
         dfs = []
-        for location in locations:
-            # Get the list of files in the location directory
-            files = os.listdir(os.path.join(orders_dir, location))
-            # Loop through the files
-            for file in files:
-                # Get the file path
-                file_path = os.path.join(orders_dir, location, file)
-                try:
-                    dfs.append(self.order_file_to_df(file_path))
-                except Exception as e:
-                    if self.invalid_file_handler:
-                        self.invalid_file_handler.add_error(file_path, e)
-                    else:
-                        raise e
+        # Loop through the files
+        for export in self.export_files('Order'):
+            file_path = export['path']
+            try:
+                df = self.order_file_to_df(file_path, export['location'])
+                if self.typed:
+                    df = apply_schema(df, 'orders')
+                self.validate(export, {'orders': df})
+                dfs.append(df)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if self.invalid_file_handler:
+                    self.quarantined.append(file_path)
+                    self.invalid_file_handler.add_error(file_path, e)
+                    continue
+                else:
+                    raise e
+            self.file_parsed('Order', file_path, {'orders': df}, export['location'])
 
-        return pd.concat(dfs, ignore_index=True)
+        if not dfs:
+            dfs = [self.empty_frame([*self.order_headers.values(), 'location'])]
+        df = pd.concat(dfs, ignore_index=True)
+        if self.typed:
+            df = apply_schema(df, 'orders')
+        return self.deduplicate(df, 'orders')
 
     ###############################
     # Customers
     ###############################
     def customer_file_to_df(self, file_path):
-        df = pd.read_csv(file_path, dtype=str)
+        if self.engine == 'pyarrow':
+            df = self.read_csv_arrow(file_path, infer_types=False)
+        else:
+            df = pd.read_csv(file_path, dtype=str, memory_map=True)
         df.rename(columns=self.customer_headers, inplace=True)
 
         # Replace remaining NaN values with None
@@ -293,30 +537,38 @@ class BookerParser:
 
         # Remove Curly Braces from GUID
         df['guid'].replace('[\{\}]', '', regex=True, inplace=True)
-        for index in [value for value in self.customer_headers.values() if 'phone' in value]:
-            df[index].replace(r'\D', '', regex=True, inplace=True)
-            df[index] = df[index].apply(lambda x: '+1' + x if x and not x.startswith('+1') else x)
+        self.normalize_phones(df, [value for value in self.customer_headers.values() if 'phone' in value])
 
         return df
 
+    @timed('parse')
     def parse_customers(self):
-        # Get the customers directory
-        customers_dir = os.path.join(self.directory, 'Customer')
-        # customers_dir = self.directory
-
-        # Get the list of files in the customers directory
-        files = os.listdir(customers_dir)
-
         dataframes = []
-        for file in files:
-            # Get the file path
-            file_path = os.path.join(customers_dir, file)
+        for export in self.export_files('Customer'):
+            file_path = export['path']
             try:
-                dataframes.append(self.customer_file_to_df(file_path))
+                df = self.customer_file_to_df(file_path)
+                if self.typed:
+                    df = apply_schema(df, 'customers')
+                self.validate(export, {'customers': df})
+                dataframes.append(df)
+            except DeadlineExceeded:
+                raise
             except Exception as e:
                 if self.invalid_file_handler:
+                    self.quarantined.append(file_path)
                     self.invalid_file_handler.add_error(file_path, e)
+                    continue
                 else:
                     raise e
-
-        return pd.concat(dataframes, ignore_index=True)
+            self.file_parsed('Customer', file_path, {'customers': df})
+
+        if not dataframes:
+            dataframes = [self.empty_frame(self.customer_headers.values())]
+        df = pd.concat(dataframes, ignore_index=True)
+        if self.typed:
+            df = apply_schema(df, 'customers')
+        df = self.deduplicate(df, 'customers')
+        # sync_customers doesn't treat customers missing from an incomplete export as deleted
+        df.attrs['quarantined'] = list(self.quarantined)
+        return df
@@ -0,0 +1,64 @@
+import random
+from time import monotonic, sleep
+
+from selenium.common.exceptions import TimeoutException, StaleElementReferenceException, NoSuchElementException, \
+    ElementClickInterceptedException, ElementNotInteractableException
+
+from deadline import current_deadline, DeadlineExceeded
+from metrics import current_run
+
+# Errors of a slow or still changing page, anything else fails the step right away
+RETRYABLE_ERRORS = (
+    TimeoutException,
+    StaleElementReferenceException,
+    NoSuchElementException,
+    ElementClickInterceptedException,
+    ElementNotInteractableException,
+)
+
+
+class RetryPolicy:
+    """Retries one step on transient errors with jittered exponential backoff. The step gets max_attempts tries
+    within budget seconds, whichever runs out first. Past the run's deadline the step isn't retried and
+    DeadlineExceeded is raised from the last error, sends (sending=True) keep retrying into the send reserve."""
+
+    def __init__(self, step, max_attempts=3, base_delay=1, max_delay=30, budget=None, retryable=RETRYABLE_ERRORS,
+                 sending=False):
+        self.step = step
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retryable = retryable
+        self.sending = sending
+
+    def delay(self, attempt):
+        """Full jitter, a random delay up to the exponential backoff of the attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def is_retryable(self, error):
+        return isinstance(error, self.retryable)
+
+    def call(self, func, *args, on_retry=None, **kwargs):
+        """Run func, on_retry() runs before every retry to get the page back to where the step starts"""
+        start = monotonic()
+        attempt = 1
+        while True:
+            try:
+                if attempt > 1 and on_retry is not None:
+                    on_retry()
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e) or attempt >= self.max_attempts:
+                    raise e
+                delay = self.delay(attempt)
+                if self.budget is not None and monotonic() - start + delay > self.budget:
+                    print(f'{self.step} is out of its {self.budget}s retry budget')
+                    raise e
+                if current_deadline().should_stop(f'retrying {self.step}', sending=self.sending):
+                    raise DeadlineExceeded(f'Stopped retrying {self.step}: {e}') from e
+                print(f'{self.step} failed on attempt {attempt}/{self.max_attempts}, retrying in {delay:.1f}s')
+                print(e)
+                current_run().add_retry(self.step)
+                sleep(delay)
+                attempt += 1
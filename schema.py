@@ -0,0 +1,156 @@
+import pandas as pd
+import pyarrow as pa
+
+# Typed layout of the parsed frames, keyed by frame name. Columns not listed are kept as Arrow backed strings.
+MONEY_COLUMNS = {
+    'appointments': [],
+    'treatments': ['price', 'tax', 'total'],
+    'orders': ['total_price', 'refund_amount', 'balance', 'total_products', 'total_treatments', 'total_packages',
+               'total_series', 'total_gift_certificate_cards', 'total_cancellation_fee', 'total_discount_special',
+               'tax', 'tip', 'total_tips', 'prepaid_credit'],
+    'customers': [],
+}
+CATEGORY_COLUMNS = {
+    'appointments': ['location', 'status', 'type', 'origin', 'payment_method', 'payment_special', 'created_by',
+                     'pre_book_rebook'],
+    'treatments': ['treatment_name', 'category', 'subcategory', 'staff_name', 'room', 'staff_requested'],
+    'orders': ['location', 'status', 'payment_method', 'created_by', 'refund'],
+    'customers': ['state', 'city', 'status'],
+}
+INTEGER_COLUMNS = {
+    'appointments': ['booking_number'],
+    'treatments': ['appointment', 'duration'],
+    'orders': ['order_number'],
+    'customers': ['customer_id'],
+}
+BOOLEAN_COLUMNS = {
+    'appointments': [],
+    'treatments': [],
+    'orders': [],
+    'customers': ['receives_email', 'receives_sms'],
+}
+DATETIME_COLUMNS = {
+    'appointments': ['start_date_time', 'end_date_time'],
+    'treatments': ['appointment_on'],
+    'orders': ['order_date'],
+    'customers': [],
+}
+
+# Columns identifying a single entity, the same ids the send functions use as object ids
+NATURAL_KEYS = {
+    'appointments': ['booking_number'],
+    'treatments': ['appointment', 'appointment_on'],
+    'orders': ['order_number'],
+    'customers': ['guid'],
+}
+
+# What the untyped frames carry for a blank cell, customers are read with blanks as None
+BLANK_VALUES = {
+    'appointments': '',
+    'treatments': '',
+    'orders': '',
+    'customers': None,
+}
+# Blank columns the untyped frames carry as None regardless of the frame
+NULL_COLUMNS = {
+    'orders': ['last_refund_date'],
+}
+# Frames that are read as text, their integer columns are sent as strings
+TEXT_FRAMES = ['customers']
+
+TRUE_VALUES = ['yes', 'true', 'y', '1']
+FALSE_VALUES = ['no', 'false', 'n', '0']
+STRING_DTYPE = pd.ArrowDtype(pa.string())
+
+
+###############################
+# TYPED FRAMES
+###############################
+def blank_to_na(series):
+    return series.where(series != '')
+
+
+def money_to_cents(series):
+    """'1,234.50', '$1,234.50' or '(1.50)' to integer cents, blanks become <NA>"""
+    text = series.astype('string').str.strip()
+    negative = text.str.startswith('(') | text.str.startswith('-')
+    amount = pd.to_numeric(blank_to_na(text.str.replace(r'[\$,()\-]', '', regex=True)), errors='coerce')
+    cents = (amount * 100).round().astype('Int64')
+    return cents.where(~negative.fillna(False), -cents)
+
+
+def to_boolean(series):
+    text = series.astype('string').str.strip().str.lower()
+    result = pd.Series(pd.NA, index=series.index, dtype='boolean')
+    result[text.isin(TRUE_VALUES).fillna(False)] = True
+    result[text.isin(FALSE_VALUES).fillna(False)] = False
+    return result
+
+
+def apply_schema(df, frame):
+    """Convert a parsed frame to its compact typed layout. Converting an already typed frame is a no-op."""
+    df = df.copy()
+    for column in df.columns:
+        series = df[column]
+        if column in MONEY_COLUMNS[frame]:
+            if not pd.api.types.is_integer_dtype(series):
+                df[column] = money_to_cents(series)
+        elif column in INTEGER_COLUMNS[frame]:
+            if not pd.api.types.is_integer_dtype(series):
+                df[column] = pd.to_numeric(blank_to_na(series), errors='coerce').astype('Int64')
+        elif column in BOOLEAN_COLUMNS[frame]:
+            if not pd.api.types.is_bool_dtype(series):
+                df[column] = to_boolean(series)
+        elif column in DATETIME_COLUMNS[frame]:
+            if not pd.api.types.is_datetime64_any_dtype(series):
+                df[column] = pd.to_datetime(blank_to_na(series), errors='coerce')
+        elif column in CATEGORY_COLUMNS[frame]:
+            df[column] = blank_to_na(series).astype('category')
+        elif series.dtype in [object, STRING_DTYPE]:
+            df[column] = blank_to_na(series).astype(STRING_DTYPE)
+    return df
+
+
+###############################
+# SINK BOUNDARY
+###############################
+def cents_to_money(series):
+    """Integer cents back to money strings, always in the '-1234.50' form. The exports also write '(5.00)' and
+    '12', the untyped frames send those as they are."""
+    absolute = series.abs()
+    text = (absolute // 100).astype('string') + '.' + (absolute % 100).astype('string').str.zfill(2)
+    text = text.where(series >= 0, '-' + text)
+    return text.astype(object).where(series.notna(), None)
+
+
+def boolean_to_text(series):
+    """Booleans back to the Yes/No of the exports"""
+    return series.map({True: 'Yes', False: 'No'}, na_action='ignore').astype(object)
+
+
+def json_records(df, frame):
+    """Rows as plain python dicts that can be serialized to JSON. Typed columns are converted back to the values
+    the untyped frames carry, except money: typed frames send it canonical ('(5.00)' as '-5.00', '12' as '12.00').
+    Untyped frames come out with the same values they were parsed with."""
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if series.dtype == object:
+            columns[column] = series
+            continue
+        if column in MONEY_COLUMNS.get(frame, []) and pd.api.types.is_integer_dtype(series):
+            values = cents_to_money(series)
+        elif pd.api.types.is_bool_dtype(series):
+            values = boolean_to_text(series)
+        elif pd.api.types.is_integer_dtype(series) and frame in TEXT_FRAMES:
+            values = series.astype('string').astype(object)
+        elif pd.api.types.is_integer_dtype(series) and series.hasnans:
+            # pandas reads an integer column with blanks as floats
+            values = series.astype('float64').astype(object)
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            values = series.astype(str).astype(object)
+        else:
+            values = series.astype(object)
+        blank = None if column in NULL_COLUMNS.get(frame, []) else BLANK_VALUES.get(frame)
+        columns[column] = values.where(series.notna(), blank)
+    return pd.DataFrame(columns, index=df.index).to_dict('records')
@@ -1,13 +1,31 @@
+import csv
+import json
 import os
 from datetime import date, timedelta, datetime
 from time import sleep
 
 import pytz
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 from tempfile import TemporaryDirectory
 
+from locations import DEFAULT_LOCATIONS
+from deadline import current_deadline, DeadlineExceeded
+from export_progress import ExportProgress
+from metrics import current_run, timed
+from retry import RetryPolicy
+from webdriver_client import RoundTripCounter, count_round_trips
+
+# Retries of the steps that fail on a slow or still changing page, budgets in seconds
+STEP_RETRIES = {
+    'export chunk': {'max_attempts': 3, 'base_delay': 5, 'budget': 600},
+    'export download': {'max_attempts': 10, 'base_delay': 2, 'max_delay': 20, 'budget': 300},
+    'create customer': {'max_attempts': 3, 'base_delay': 0.5, 'budget': 120},
+    'booking lookup': {'max_attempts': 3, 'base_delay': 1, 'budget': 60},
+}
+
 
 class BookerScraper:
     def __init__(self,
@@ -21,8 +39,20 @@ class BookerScraper:
                  export_period=11,
                  destination_dir=None,
                  locations=None,
+                 customer_index=None,
+                 browser_waits=True,
+                 archive=None,
+                 progress=None,
                  ):
         self.driver = driver
+        self.customer_index = customer_index
+        self.browser_waits = browser_waits
+        self.round_trips = RoundTripCounter(driver) if driver is not None else None
+        self.script_timeout = None
+        self.credentials = None
+        self.current_location = None
+        if hasattr(driver, 'on_recycle'):
+            driver.on_recycle.append(self.restore_session)
         self.start_date = start_date
         self.end_date = end_date
         self.wait_time = wait_time
@@ -31,19 +61,16 @@ class BookerScraper:
         self.export_period = timedelta(days=export_period)
         self.download_dir = download_dir
         self.destination_dir = destination_dir
+        # ExportArchive that keeps a copy of every raw download
+        self.archive = archive
+        # ExportProgress that lets a chunked export pick up where a stopped run left off
+        self.progress = progress
+        # (type, location, start_date, end_date, date_type, path, archive_path) of every moved download,
+        # BookerParser parses it directly
+        self.manifest = []
         self.timezone = pytz.timezone('America/Los_Angeles')
-        self.locations = locations or {
-            'll': {
-                'id': '36085',
-                'appointments_view_id': 57651,
-                'orders_view_id': 57650,
-            },
-            'cda': {
-                'id': '51309',
-                'appointments_view_id': 57707,
-                'orders_view_id': 57738,
-            }
-        }
+        self.locations = locations or dict(DEFAULT_LOCATIONS)
+        self.retries = {step: RetryPolicy(step, **settings) for step, settings in STEP_RETRIES.items()}
         self.urls = {
             'signin': 'https://signin.booker.com/',
             'locations': 'https://app.secure-booker.com/App/BrandAdmin/Spas/SearchSpas.aspx',
@@ -58,16 +85,81 @@ class BookerScraper:
     ###############################
     # UTILITY FUNCTIONS
     ###############################
+    # Resolves as soon as the element matching the query is present (or gone), watching the DOM with a
+    # MutationObserver so a whole wait costs one WebDriver round trip instead of one per poll.
+    WAIT_SCRIPT = """
+        const [by, value, present, timeout, done] = arguments;
+        function find() {
+            switch (by) {
+                case 'xpath':
+                    return document.evaluate(value, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+                case 'id':
+                    return document.getElementById(value);
+                case 'name':
+                    return document.getElementsByName(value)[0] || null;
+                case 'tag name':
+                    return document.getElementsByTagName(value)[0] || null;
+                case 'class name':
+                    return document.getElementsByClassName(value)[0] || null;
+                default:
+                    return document.querySelector(value);
+            }
+        }
+        function check() {
+            const element = find();
+            return present ? element : (element ? null : true);
+        }
+        let result = check();
+        if (result) return done(result);
+        const observer = new MutationObserver(() => {
+            result = check();
+            if (result) {
+                observer.disconnect();
+                clearTimeout(timer);
+                done(result);
+            }
+        });
+        const timer = setTimeout(() => {
+            observer.disconnect();
+            done(null);
+        }, timeout * 1000);
+        observer.observe(document, {childList: true, subtree: true, attributes: true});
+    """
+
+    def browser_wait(self, query: tuple, timeout, present=True):
+        """Wait inside the browser for an element to be present, or gone when present is False.
+        Raises TimeoutException on timeout and falls back to polling if the page navigates mid wait."""
+        if self.script_timeout is None or self.script_timeout < timeout + 5:
+            self.script_timeout = timeout + 5
+            self.driver.set_script_timeout(self.script_timeout)
+        try:
+            result = self.driver.execute_async_script(self.WAIT_SCRIPT, query[0], query[1], present, timeout)
+        except TimeoutException:
+            result = None
+        except WebDriverException:
+            # Document unloaded during the wait, poll on the new page instead
+            return self.poll_wait(query, timeout, present)
+        if result is None:
+            raise TimeoutException(f'Timed out waiting for {query}')
+        return result
+
+    def poll_wait(self, query: tuple, timeout, present=True, poll_frequency=.05):
+        wait = WebDriverWait(self.driver, timeout, poll_frequency=poll_frequency)
+        if present:
+            return wait.until(EC.presence_of_element_located(query))
+        return wait.until_not(EC.presence_of_element_located(query))
+
     def wait_for_element(self, query: tuple, timeout: int = None, quit_on_fail: bool = True):
         timeout = timeout or self.wait_time
         try:
-            i = WebDriverWait(self.driver, timeout, poll_frequency=.05).until(
-                EC.presence_of_element_located(query)
-            )
-            return i
+            if self.browser_waits:
+                return self.browser_wait(query, timeout)
+            return self.poll_wait(query, timeout)
+        except DeadlineExceeded:
+            raise
         except Exception as e:
+            # The driver stays up so the step can be retried, the task quits it
             if quit_on_fail:
-                self.driver.quit()
                 raise e
             else:
                 print(f'Element not found for query: {query}')
@@ -76,35 +168,91 @@ class BookerScraper:
     def wait_for_element_to_be_clickable(self, element, timeout=None):
         timeout = timeout or self.wait_time
         print('Waiting for element to be clickable.')
-        try:
-            i = WebDriverWait(self.driver, timeout).until(
-                EC.element_to_be_clickable(element)
-            )
-            return i
-        except Exception as e:
-            self.driver.quit()
-            raise e
+        return WebDriverWait(self.driver, timeout).until(
+            EC.element_to_be_clickable(element)
+        )
 
     def wait_for_loader(self, query, short_wait=None, long_wait=None):
         short_wait = short_wait or self.wait_time / 2
         long_wait = long_wait or self.wait_time
         try:
-            WebDriverWait(self.driver, short_wait, poll_frequency=0.1).until(
-                EC.presence_of_element_located(query),
-            )
-            WebDriverWait(self.driver, long_wait).until_not(
-                EC.presence_of_element_located(query)
-            )
+            if self.browser_waits:
+                self.browser_wait(query, short_wait)
+                self.browser_wait(query, long_wait, present=False)
+            else:
+                self.poll_wait(query, short_wait, poll_frequency=0.1)
+                self.poll_wait(query, long_wait, present=False, poll_frequency=0.5)
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             print('Loader not found')
             raise Exception(e)
 
+    # Reads every row of a GridView, then posts back for each following page and parses the returned HTML,
+    # so the whole table comes back in a single WebDriver round trip.
+    EXTRACT_TABLE_SCRIPT = """
+        const [tableXPath, rowXPath, done] = arguments;
+        const clean = (text) => (text || '').replace(/\\s+/g, ' ').trim();
+        function rowsFrom(doc) {
+            const table = doc.evaluate(tableXPath, doc, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+            if (!table) return [];
+            const rows = doc.evaluate(rowXPath, table, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+            const result = [];
+            for (let i = 0; i < rows.snapshotLength; i++) {
+                const cells = rows.snapshotItem(i).querySelectorAll('th, td');
+                result.push(Array.from(cells, (cell) => clean(doc === document ? cell.innerText : cell.textContent)));
+            }
+            return result;
+        }
+        function nextPage(doc, page) {
+            const link = Array.from(doc.querySelectorAll('a[href*="__doPostBack"]'))
+                .find((a) => a.getAttribute('href').includes(`'Page$${page + 1}'`));
+            if (!link) return null;
+            const match = link.getAttribute('href').match(/__doPostBack\\('([^']*)','([^']*)'\\)/);
+            return match ? {target: match[1], argument: match[2]} : null;
+        }
+        async function extract() {
+            let doc = document;
+            let page = 1;
+            const rows = rowsFrom(doc);
+            const header = JSON.stringify(rows[0]);
+            let next = nextPage(doc, page);
+            while (next) {
+                const form = doc.forms[0];
+                const data = new FormData(form);
+                data.set('__EVENTTARGET', next.target);
+                data.set('__EVENTARGUMENT', next.argument);
+                const action = new URL(form.getAttribute('action') || location.href, location.href);
+                const response = await fetch(action, {method: 'POST', body: new URLSearchParams(data), credentials: 'same-origin'});
+                doc = new DOMParser().parseFromString(await response.text(), 'text/html');
+                page += 1;
+                const pageRows = rowsFrom(doc);
+                rows.push(...(JSON.stringify(pageRows[0]) === header ? pageRows.slice(1) : pageRows));
+                next = nextPage(doc, page);
+            }
+            return {pages: page, rows: rows};
+        }
+        extract().then((result) => done(JSON.stringify(result)), (error) => done(JSON.stringify({error: String(error)})));
+    """
+
+    def extract_table(self, table_xpath, row_xpath="./tr[@align='left']", timeout=None):
+        """Every row of a results table, including all of its pagination pages, as lists of cell text"""
+        self.wait_for_element((By.XPATH, table_xpath))
+        self.driver.set_script_timeout(timeout or self.wait_time * 4)
+        result = json.loads(self.driver.execute_async_script(self.EXTRACT_TABLE_SCRIPT, table_xpath, row_xpath))
+        if 'error' in result:
+            raise Exception(f'Error extracting table: {result["error"]}')
+        print(f'Extracted {len(result["rows"])} rows from {result["pages"]} pages')
+        return result['rows']
+
     def change_export_view(self, value):
         try:
             view_select = self.wait_for_element((By.ID, 'ctl00_ctl00_content_content_ddlViewing'))
             view_select.click()
             view_select.find_element(By.XPATH, f'//option[@value="{value}"]').click()
             self.wait_for_element((By.XPATH, f'//option[@value="{value}" and @selected="selected"]'))
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             print(e)
             raise Exception('Error changing view')
@@ -128,10 +276,27 @@ class BookerScraper:
             print(f'Export not found at {time_string}')
             return None
 
+    def discard_downloads(self, type):
+        """Remove downloads of a failed attempt so they are not moved as the retry's file"""
+        for file in os.listdir(self.download_dir):
+            if type in file:
+                print(f'Discarding {file}')
+                os.remove(os.path.join(self.download_dir, file))
+
     def get_download_dir_filecount(self):
         files = [file for file in os.listdir(self.download_dir) if 'crdownload' not in file.lower() and 'Chrome' not in file]
         return len(files)
 
+    def export_chunk(self, type, export_chunked, start_date, end_date, location=None, date_type=None, timeout=None):
+        """Export one date window and move its download, the step an export chunk retry repeats"""
+        file_count = self.get_download_dir_filecount()
+        export_chunked(start_date, end_date)
+        # Wait for file download to show up in directory
+        if not self.wait_until_filecount_reached(file_count + 1, timeout):
+            raise TimeoutException(f'{type} download did not finish in a timely manner')
+        self.move_file(type, location=location, start_date=start_date, end_date=end_date, date_type=date_type)
+        self.record_chunk(type, start_date, location=location, date_type=date_type)
+
     def wait_until_filecount_reached(self, count: int, timeout: int = None):
         print(f'Waiting for file count to reach {count}')
         timeout = timeout or self.wait_time
@@ -141,7 +306,7 @@ class BookerScraper:
             sleep(1)
         return False
 
-    def move_file(self, type, location=None, start_date=None, end_date=None):
+    def move_file(self, type, location=None, start_date=None, end_date=None, date_type=None):
         # Skip if no destination dir
         if self.destination_dir is None:
             return
@@ -150,20 +315,7 @@ class BookerScraper:
         file_types = ['Customer', 'Appointment', 'Order']
         if type not in file_types:
             raise Exception(f'File type must be one of {file_types}')
-        # Create subdirectory if it doesn't exist
-        sub_dir = os.path.join(self.destination_dir, type)
-        if not os.path.exists(sub_dir):
-            os.mkdir(sub_dir)
-        if location is not None:
-            sub_dir = os.path.join(sub_dir, location)
-            if not os.path.exists(sub_dir):
-                os.mkdir(sub_dir)
-        # Set destination file name
-        dest_file_name = type
-        if start_date:
-            dest_file_name += f' {self.get_file_date_string(start_date).replace("/", "_")}'
-            if end_date:
-                dest_file_name += f'-{self.get_file_date_string(end_date).replace("/", "_")}'
+        dest = self.destination_path(type, location, start_date, end_date)
         # Get file name
         file_name = [file for file in os.listdir(self.download_dir) if type in file]
         if len(file_name) == 0:
@@ -172,9 +324,107 @@ class BookerScraper:
             raise Exception(f'Multiple files found for type {type}')
         # Move file
         src = os.path.join(self.download_dir, file_name[0])
-        dest = os.path.join(sub_dir, f'{dest_file_name}.csv')
         print(f'Moving file {src} to {dest}')
+        current_run().add_download(os.path.getsize(src))
         os.rename(src, dest)
+        self.manifest.append({
+            'type': type,
+            'location': location,
+            'start_date': start_date,
+            'end_date': end_date,
+            'date_type': date_type,
+            'path': dest,
+            'archive_path': self.archive_download(type, location, dest, date_type),
+        })
+        return dest
+
+    def destination_path(self, type, location=None, start_date=None, end_date=None):
+        """<destination_dir>/<Type>/<location>/<Type> <start>-<end>.csv, creating the subdirectories"""
+        sub_dir = os.path.join(self.destination_dir, type)
+        if location is not None:
+            sub_dir = os.path.join(sub_dir, location)
+        os.makedirs(sub_dir, exist_ok=True)
+        dest_file_name = type
+        if start_date:
+            dest_file_name += f' {self.get_file_date_string(start_date).replace("/", "_")}'
+            if end_date:
+                dest_file_name += f'-{self.get_file_date_string(end_date).replace("/", "_")}'
+        return os.path.join(sub_dir, f'{dest_file_name}.csv')
+
+    def archive_download(self, type, location, file_path, date_type=None):
+        """Archive the raw export before it is parsed, exports that fail to parse are the ones to replay after a
+        parser fix. Archive failures never stop a scrape."""
+        if self.archive is None:
+            return None
+        try:
+            return self.archive.archive_raw(type, location, file_path, date_type)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f'Could not archive {file_path}')
+            print(e)
+            return None
+
+    ###############################
+    # EXPORT PROGRESS
+    ###############################
+    def progress_key(self, type, location, date_type):
+        return ExportProgress.key(type, location, date_type, self.start_date, self.end_date, self.export_period)
+
+    def resume_chunk(self, type, start_date, end_date, location=None, date_type=None):
+        """Stage a chunk an earlier run downloaded from the archive, False when the chunk has to be downloaded"""
+        if self.progress is None or self.archive is None or self.destination_dir is None:
+            return False
+        try:
+            archive_path = self.progress.chunks(self.progress_key(type, location, date_type)).get(str(start_date))
+            if archive_path is None:
+                return False
+            dest = self.archive.copy_raw(archive_path, self.destination_path(type, location, start_date, end_date))
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f'Could not resume the {type} export from {start_date}, downloading it again')
+            print(e)
+            return False
+        print(f'Resumed the {type} export from {start_date} with {archive_path}')
+        current_run().add_resumed_chunk()
+        self.manifest.append({
+            'type': type,
+            'location': location,
+            'start_date': start_date,
+            'end_date': end_date,
+            'date_type': date_type,
+            'path': dest,
+            'archive_path': archive_path,
+        })
+        return True
+
+    def record_chunk(self, type, start_date, location=None, date_type=None):
+        """Record an archived chunk so a stopped run can resume after it, best effort like archiving"""
+        if self.progress is None or self.destination_dir is None or not self.manifest:
+            return
+        archive_path = self.manifest[-1]['archive_path']
+        if archive_path is None:
+            return
+        try:
+            self.progress.record(self.progress_key(type, location, date_type), start_date, archive_path)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f'Could not record the progress of the {type} export')
+            print(e)
+
+    def finish_export(self, type, location=None, date_type=None):
+        """Every chunk was exported, the next run of the same window downloads it again"""
+        if self.progress is None:
+            return
+        try:
+            self.progress.clear(self.progress_key(type, location, date_type))
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f'Could not clear the progress of the {type} export')
+            print(e)
 
     ###############################
     # NAVIGATION
@@ -199,13 +449,56 @@ class BookerScraper:
         print('Navigating to customers page.')
         self.driver.get(self.urls['customers'])
 
-    def select_location(self, location_code):
+    def select_location(self, location_code, force=False):
+        if location_code == self.current_location and not force:
+            print('Location already selected.')
+            return
         self.navigate_to_locations_page()
         print('Selecting location.')
         location_select = self.wait_for_element((By.XPATH, f"//a[@href='Impersonate.aspx?SpaID={location_code}']"))
         location_select.click()
+        self.current_location = location_code
         sleep(1)
 
+    # Every spa the brand admin can impersonate, as [{id, name}]
+    SPAS_SCRIPT = """
+        const spas = new Map();
+        for (const link of document.querySelectorAll("a[href^='Impersonate.aspx?SpaID=']")) {
+            const id = link.getAttribute('href').split('SpaID=')[1];
+            if (!spas.has(id)) spas.set(id, {id: id, name: link.textContent.trim()});
+        }
+        return Array.from(spas.values());
+    """
+    # Export views of the current search page, as {view id: view name}
+    VIEWS_SCRIPT = """
+        const select = document.getElementById('ctl00_ctl00_content_content_ddlViewing');
+        const views = {};
+        for (const option of select.options) views[option.value] = option.text.trim();
+        return views;
+    """
+
+    def export_views(self):
+        if self.wait_for_element((By.ID, 'ctl00_ctl00_content_content_ddlViewing'), quit_on_fail=False) is None:
+            return {}
+        return self.driver.execute_script(self.VIEWS_SCRIPT)
+
+    @timed('discover_locations')
+    @count_round_trips
+    def discover_locations(self):
+        """Spas listed on the brand admin spa search with the export views of their appointment and order pages"""
+        self.navigate_to_locations_page()
+        spa_link = (By.XPATH, "//a[starts-with(@href, 'Impersonate.aspx?SpaID=')]")
+        if self.wait_for_element(spa_link, quit_on_fail=False) is None:
+            return []
+        spas = self.driver.execute_script(self.SPAS_SCRIPT)
+        for spa in spas:
+            self.select_location(spa['id'])
+            self.navigate_to_appointments_page()
+            spa['appointments_views'] = self.export_views()
+            self.navigate_to_orders_page()
+            spa['orders_views'] = self.export_views()
+        return spas
+
     ###############################
     # AUTHENTICATION
     ###############################
@@ -226,10 +519,26 @@ class BookerScraper:
 
         self.driver.find_element(By.XPATH, "//button[@type='submit']").click()
 
+    @timed('login')
+    @count_round_trips
     def login(self, account_name, username, password):
+        self.credentials = (account_name, username, password)
+        self.current_location = None
         self.account_selection(account_name)
         self.user_login(username, password)
 
+    def restore_session(self, driver):
+        """Log the replacement driver of a recycled RecyclingDriver back in and return to the current location"""
+        print('Restoring session on new driver.')
+        self.script_timeout = None
+        if self.round_trips is not None:
+            self.round_trips.install(driver)
+        if self.credentials is not None:
+            self.account_selection(self.credentials[0])
+            self.user_login(self.credentials[1], self.credentials[2])
+        if self.current_location is not None:
+            self.select_location(self.current_location, force=True)
+
     ###############################
     # CUSTOMERS
     ###############################
@@ -271,24 +580,25 @@ class BookerScraper:
         sleep(3)
         self.driver.refresh()
         sleep(1)
-        export_download_button = None
-        for i in range(0, 10):
+
+        def find_download_button():
             export_download_button = self.wait_for_element(
                 (By.XPATH, f"//a[string()='{button_text}' and @title='download .csv file']"),
                 timeout=self.wait_time,
                 quit_on_fail=False
             )
-            if export_download_button is not None:
-                break
-            else:
-                self.driver.refresh()
-                print('Export not found. Refreshing page.')
+            if export_download_button is None:
+                raise TimeoutException('Customer Export Button not found to be clickable')
+            return export_download_button
 
-        if export_download_button is None:
-            raise Exception('Customer Export Button not found to be clickable')
+        # The button shows up once the export finished, the page needs a refresh to show it
+        export_download_button = self.retries['export download'].call(find_download_button,
+                                                                       on_retry=self.driver.refresh)
         export_download_button.click()
         print('Customer export download started')
 
+    @timed('scrape')
+    @count_round_trips
     def customer_flow(self, view_id=57514):
         filecount = self.get_download_dir_filecount()
 
@@ -303,6 +613,8 @@ class BookerScraper:
         print('Customer download finished')
         self.move_file('Customer', start_date=export_time)
 
+    @timed('scrape')
+    @count_round_trips
     def customer_added_today_flow(self):
         self.select_location(self.locations['ll']['id'])
         self.navigate_to_customers_page()
@@ -317,21 +629,12 @@ class BookerScraper:
             sleep(3)
 
         table_xpath = "//table[@class='grdSearchResults']/tbody"
-        table = self.wait_for_element((By.XPATH, table_xpath))
-        rows = table.find_elements(By.XPATH, "./tr[@align='left']")
+        rows = self.extract_table(table_xpath)
         print(f'Found {len(rows)} rows')
 
-
         file_path = os.path.join(self.download_dir, f'Customer.csv')
-        with open(file_path, 'w') as f:
-            for row in rows:
-                cells = row.find_elements(By.XPATH, ".//th | .//td")
-                for cell in cells:
-                    f.write(f'"{cell.text}"')
-                    f.write(',')
-                f.write('\n')
-        with open(file_path, 'r') as f:
-            print(f.read())
+        with open(file_path, 'w', newline='') as f:
+            csv.writer(f, quoting=csv.QUOTE_ALL).writerows(rows)
         self.move_file('Customer', start_date=export_time)
 
     def customer_added_last_year_flow(self):
@@ -343,32 +646,12 @@ class BookerScraper:
     def customer_create_select_location(self):
         self.select_location(self.locations['ll']['id'])
 
+    @timed('create_customer')
+    @count_round_trips
     def customer_create_flow(self, customer_data: dict):
         self.customer_create_select_location()
         self.navigate_to_customers_page()
 
-        import time
-        from functools import wraps
-
-        def retry(max_attempts, delay_seconds):
-            def decorator(func):
-                @wraps(func)
-                def wrapper(*args, **kwargs):
-                    attempts = 0
-                    while attempts < max_attempts:
-                        try:
-                            return func(*args, **kwargs)
-                        except Exception as e:
-                            attempts += 1
-                            print(f"Attempt {attempts}/{max_attempts} failed: {e}")
-                            time.sleep(delay_seconds)
-                    return func(*args, **kwargs)
-
-                return wrapper
-
-            return decorator
-
-        @retry(max_attempts=3, delay_seconds=0.1)
         def create_customer():
             print('Navigating to create customer page.')
             self.driver.get(self.urls['customers_create'])
@@ -422,29 +705,41 @@ class BookerScraper:
                     (By.ID, "ctl00_ctl00_content_content_ucDetails_ucDynamicForm_ctl29_ctl00_lblValueEdit"))
                 guid = str(guid.text).replace('{', '').replace('}', '')
                 print(f'Customer guid: {guid}')
+                if self.customer_index is not None:
+                    self.customer_index.add(guid, email=email, phone=phone)
                 return guid
             else:
                 customer_exists_error = self.wait_for_element(
                     (By.XPATH, "//span[@class='xError' and contains(text(), 'Another customer exists')]"))
                 if customer_exists_error is not None:
                     print('Customer already exists.')
+                    if self.customer_index is not None:
+                        guid = self.customer_index.lookup(email=email, phone=phone)
+                        if guid:
+                            print(f'Customer found in local index: {guid}')
+                            return guid
                     if email:
                         print('Searching for customer by email.')
                         guid = self.customer_get_guid_by_email(email)
                         if guid:
+                            if self.customer_index is not None:
+                                self.customer_index.add(guid, email=email, phone=phone)
                             return guid
                         print('Customer not found by email.')
                     elif phone:
                         print('Searching for customer by phone.')
                         guid = self.customer_get_guid_by_phone(phone)
                         if guid:
+                            if self.customer_index is not None:
+                                self.customer_index.add(guid, phone=phone)
                             return guid
                         print('Customer not found by phone.')
                     raise Exception('Customer already exists but could not be found by email or phone.')
                 raise Exception('Unexpected error creating customer')
 
-        return create_customer()
+        return self.retries['create customer'].call(create_customer)
 
+    @count_round_trips
     def customer_get_guid_by_email(self, email: str):
         self.customer_create_select_location()
         self.navigate_to_customers_page()
@@ -477,6 +772,7 @@ class BookerScraper:
         print(f'Customer guid: {guid}')
         return guid
 
+    @count_round_trips
     def customer_get_guid_by_phone(self, phone: str):
         from selenium.webdriver import Keys
         self.customer_create_select_location()
@@ -533,20 +829,26 @@ class BookerScraper:
         self.wait_for_loader((By.XPATH, '//div[@class="reports-overlay-words"]'))
         self.driver.find_element(By.ID, 'ctl00_ctl00_content_content_btnExport').click()
 
-    def appointments_export(self, location):
+    def appointments_export(self, location, date_type='date_on', reopen=None):
+        """reopen() gets the search page back to its export view before a chunk is retried"""
         current_time = self.start_date
         while current_time < self.end_date + self.export_period:
-            sleep(60)
-            file_count = self.get_download_dir_filecount()
+            # Chunks downloaded so far are still parsed and sent, and the next run resumes after them
+            if current_deadline().should_stop(f'the appointment export from {current_time}'):
+                return
             query_end = current_time + self.export_period - timedelta(days=1)
-            self.appointments_export_chunked(current_time, query_end)
-            # Wait for file download to show up in directory
-            if not self.wait_until_filecount_reached(file_count + 1):
-                raise Exception('Appointment download did not finish in a timely manner')
-            self.move_file('Appointment', location=location, start_date=current_time, end_date=query_end)
+            if self.resume_chunk('Appointment', current_time, query_end, location=location, date_type=date_type):
+                current_time += self.export_period
+                continue
+            sleep(60)
+            self.retries['export chunk'].call(
+                self.export_chunk, 'Appointment', self.appointments_export_chunked, current_time, query_end,
+                location=location, date_type=date_type, on_retry=reopen
+            )
             current_time += self.export_period
+        self.finish_export('Appointment', location=location, date_type=date_type)
 
-    def appointments_flow(self, location, date_type='date_on'):
+    def appointments_open_export(self, location, date_type='date_on'):
         self.select_location(location['id'])
         self.navigate_to_appointments_page()
 
@@ -557,43 +859,62 @@ class BookerScraper:
                 view_select.click()
                 view_select.find_element(By.XPATH, f'//option[@value="{value}"]').click()
                 self.wait_for_element((By.XPATH, f'//option[@value="{value}" and @selected="selected"]'))
+            except DeadlineExceeded:
+                raise
             except Exception as e:
                 print(e)
                 raise Exception('Error changing view')
 
         self.change_export_view(location['appointments_view_id'])
-        self.appointments_export(location=location['id'])
+
+    @timed('scrape')
+    @count_round_trips
+    def appointments_flow(self, location, date_type='date_on'):
+        self.appointments_open_export(location, date_type)
+
+        def reopen():
+            self.discard_downloads('Appointment')
+            self.appointments_open_export(location, date_type)
+
+        self.appointments_export(location=location['id'], date_type=date_type, reopen=reopen)
 
     def appointment_map_booking_numbers_to_orders(self, location, booking_numbers: list):
         self.select_location(location['id'])
 
         # booking_order_map = {}
         for booking_number in booking_numbers:
-            print(f'Getting order number for booking number {booking_number}')
-            self.navigate_to_appointments_page()
-            booking_number_field = self.wait_for_element((By.ID, 'ctl00_ctl00_content_content_txtBookingNumber'))
-            booking_number_field.send_keys(str(booking_number))
-            search_button = self.wait_for_element(
-                (By.XPATH, "//div[@id='ctl00_ctl00_content_content_pnlLeft']//input[@id='ctl00_ctl00_content_content_btnSearch']"))
-            search_button.click()
-            sleep(.25)
-            view_button = self.wait_for_element(
-                (By.XPATH, "//div[@id='ctl00_ctl00_content_content_upnlSearchResults']//table[@id='ctl00_ctl00_content_content_grdSearchResults']/tbody/tr[@class='xTr'][1]//a[@title='View' or @title='Review']"),
-                quit_on_fail=False
-            )
-            if view_button is None:
-                print(f'Appointment not found for booking number {booking_number}')
+            if current_deadline().should_stop(f'looking up booking {booking_number}'):
+                return
+            order_number = self.retries['booking lookup'].call(self.appointment_get_order_number, booking_number)
+            if order_number is None:
                 continue
-            view_button.click()
-            order_xpath = '//*[@id="ctl00_ctl00_content_content_ucViewAppointment_ucAppointmentHeaderBlock_lnkViewOrder" or @id="ctl00_ctl00_content_content_ucViewGroupAppointment_ucGroupHeaderBlock_lnkViewOrder" or @id="ctl00_ctl00_content_content_ucViewGroupAppointment_ucGroupHeaderBlock_rptOrders_ctl01_lnkViewOrder"]'
-            order_number_element = self.wait_for_element((By.XPATH, order_xpath), quit_on_fail=True)
-            order_number = order_number_element.text
-            # booking_order_map[booking_number] = order_number_element.text
+            # booking_order_map[booking_number] = order_number
             print(f'Order number for booking number {booking_number}: {order_number}')
             yield booking_number, order_number
 
         return
 
+    def appointment_get_order_number(self, booking_number):
+        print(f'Getting order number for booking number {booking_number}')
+        self.navigate_to_appointments_page()
+        booking_number_field = self.wait_for_element((By.ID, 'ctl00_ctl00_content_content_txtBookingNumber'))
+        booking_number_field.send_keys(str(booking_number))
+        search_button = self.wait_for_element(
+            (By.XPATH, "//div[@id='ctl00_ctl00_content_content_pnlLeft']//input[@id='ctl00_ctl00_content_content_btnSearch']"))
+        search_button.click()
+        sleep(.25)
+        view_button = self.wait_for_element(
+            (By.XPATH, "//div[@id='ctl00_ctl00_content_content_upnlSearchResults']//table[@id='ctl00_ctl00_content_content_grdSearchResults']/tbody/tr[@class='xTr'][1]//a[@title='View' or @title='Review']"),
+            quit_on_fail=False
+        )
+        if view_button is None:
+            print(f'Appointment not found for booking number {booking_number}')
+            return None
+        view_button.click()
+        order_xpath = '//*[@id="ctl00_ctl00_content_content_ucViewAppointment_ucAppointmentHeaderBlock_lnkViewOrder" or @id="ctl00_ctl00_content_content_ucViewGroupAppointment_ucGroupHeaderBlock_lnkViewOrder" or @id="ctl00_ctl00_content_content_ucViewGroupAppointment_ucGroupHeaderBlock_rptOrders_ctl01_lnkViewOrder"]'
+        order_number_element = self.wait_for_element((By.XPATH, order_xpath), quit_on_fail=True)
+        return order_number_element.text
+
     ###############################
     # ORDERS
     ###############################
@@ -612,20 +933,35 @@ class BookerScraper:
         # wait_for_loader(driver, (By.XPATH, '//div[@class="reports-overlay-words"]'))
         self.wait_for_element((By.ID, 'ctl00_ctl00_content_content_btnExport')).click()
 
-    def orders_export(self, location=None):
+    def orders_export(self, location=None, reopen=None):
+        """reopen() gets the search page back to its export view before a chunk is retried"""
         current_time = self.start_date
         while current_time < self.end_date + self.export_period:
-            file_count = self.get_download_dir_filecount()
+            if current_deadline().should_stop(f'the order export from {current_time}'):
+                return
             query_end = current_time + self.export_period - timedelta(days=1)
-            self.orders_export_chunked(current_time, query_end)
-            # Wait for file download to show up in directory
-            if not self.wait_until_filecount_reached(file_count + 1, self.wait_time*2):
-                raise Exception('Order download did not finish in a timely manner')
-            self.move_file('Order', location=location, start_date=current_time, end_date=query_end)
+            if self.resume_chunk('Order', current_time, query_end, location=location, date_type='date_created'):
+                current_time += self.export_period
+                continue
+            self.retries['export chunk'].call(
+                self.export_chunk, 'Order', self.orders_export_chunked, current_time, query_end,
+                location=location, date_type='date_created', timeout=self.wait_time*2, on_retry=reopen
+            )
             current_time += self.export_period
+        self.finish_export('Order', location=location, date_type='date_created')
 
-    def orders_flow(self, location):
+    def orders_open_export(self, location):
         self.select_location(location['id'])
         self.navigate_to_orders_page()
         self.change_export_view(location['orders_view_id'])
-        self.orders_export(location['id'])
+
+    @timed('scrape')
+    @count_round_trips
+    def orders_flow(self, location):
+        self.orders_open_export(location)
+
+        def reopen():
+            self.discard_downloads('Order')
+            self.orders_open_export(location)
+
+        self.orders_export(location['id'], reopen=reopen)
@@ -0,0 +1,175 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine
+
+
+class Sink:
+    """Destination of the records the send functions produce. object() queues one record of a collection,
+    flush() writes everything queued. Records of the same id are merged like Segment objects, so a later
+    record only overwrites the properties it carries."""
+    name = None
+
+    def object(self, object_id, collection, properties):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class SegmentSink(Sink):
+    """Objects API of the Segment fork, the warehouse picks the records up on its next sync. An ObjectUploader
+    posts the objects itself instead, in gzip compressed batches."""
+    name = 'segment'
+
+    def __init__(self, analytics, uploader=None):
+        self.analytics = analytics
+        self.uploader = uploader
+
+    def object(self, object_id, collection, properties):
+        if self.uploader is not None:
+            self.uploader.object(object_id, collection, properties)
+        else:
+            self.analytics.object(object_id=object_id, collection=collection, properties=properties)
+
+    def flush(self):
+        if self.uploader is not None:
+            self.uploader.flush()
+        else:
+            self.analytics.flush()
+
+
+class JsonlSink(Sink):
+    """Appends the records to a local JSONL file, one {collection, id, properties, received_at} per line"""
+    name = 'jsonl'
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = []
+
+    def object(self, object_id, collection, properties):
+        self.queue.append({
+            'collection': collection,
+            'id': object_id,
+            'properties': properties,
+            'received_at': datetime.now(timezone.utc).isoformat(),
+        })
+
+    def flush(self):
+        if not self.queue:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a') as f:
+            for record in self.queue:
+                f.write(json.dumps(record, default=str) + '\n')
+        print(f'Wrote {len(self.queue)} records to {self.path}')
+        self.queue = []
+
+
+class PostgresSink(Sink):
+    """Upserts the records straight into the warehouse tables the Segment sync would write, <schema>.<collection>
+    keyed by a unique id. Every flush copies a batch into a temporary staging table of text columns, updates the
+    rows that exist and inserts the others (INSERT ... ON CONFLICT (id)), casting to the table's column types.
+    Partial records, e.g. an appointment's order number, only touch their own columns. Properties without a
+    column in the table are left out."""
+    # Column types that keep blank strings, in every other type a blank is NULL
+    text_types = ('text', 'character varying', 'character')
+    name = 'postgres'
+
+    def __init__(self, connection_string, schema='booker_prod', batch_size=5000, engine=None):
+        self.schema = schema
+        self.batch_size = batch_size
+        self.engine = engine or create_engine(connection_string)
+        self.queue = []
+        self.table_columns = {}
+
+    def object(self, object_id, collection, properties):
+        self.queue.append((collection, object_id, properties, datetime.now(timezone.utc)))
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.queue:
+            return
+        # One upsert per collection and set of properties, partial records only update what they carry
+        batches = {}
+        for collection, object_id, properties, received_at in self.queue:
+            batch = batches.setdefault((collection, tuple(properties)), {})
+            # A batch may only touch a row once, the last record of an id wins
+            batch[str(object_id)] = {**properties, 'id': str(object_id), 'received_at': received_at}
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                for (collection, properties), rows in batches.items():
+                    self.upsert(cursor, collection, properties, list(rows.values()))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        print(f'Upserted {len(self.queue)} records into {self.schema}')
+        self.queue = []
+
+    def get_table_columns(self, cursor, collection):
+        """Column name -> type of the table, e.g. 'numeric(10,2)' or 'timestamp with time zone'"""
+        if collection not in self.table_columns:
+            cursor.execute(
+                'SELECT a.attname, format_type(a.atttypid, a.atttypmod) FROM pg_attribute a '
+                'JOIN pg_class c ON c.oid = a.attrelid JOIN pg_namespace n ON n.oid = c.relnamespace '
+                'WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped',
+                (self.schema, collection)
+            )
+            self.table_columns[collection] = dict(cursor.fetchall())
+            if not self.table_columns[collection]:
+                raise Exception(f'Table {self.schema}.{collection} does not exist')
+        return self.table_columns[collection]
+
+    def cast(self, column, type):
+        """Staged text to the column's type, blanks of numbers, dates and the like become NULL"""
+        if type.startswith(self.text_types):
+            return f's."{column}"::{type}'
+        return f'NULLIF(s."{column}", \'\')::{type}'
+
+    def upsert(self, cursor, collection, properties, rows):
+        table_columns = self.get_table_columns(cursor, collection)
+        properties = [column for column in properties if column not in ['id', 'received_at']]
+        columns = [column for column in ['id', *properties, 'received_at'] if column in table_columns]
+        skipped = [column for column in properties if column not in table_columns]
+        if skipped:
+            print(f'{self.schema}.{collection} has no columns for {skipped}, leaving them out')
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            # Missing properties are NULL, blank strings stay blank
+            writer.writerow(['\\N' if row.get(column) is None else row[column] for column in columns])
+        buffer.seek(0)
+
+        table = f'"{self.schema}"."{collection}"'
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        # Only the written columns are staged, as text, so the table's NOT NULL columns a partial record leaves
+        # out don't fail the COPY
+        staging_columns = ', '.join(f'"{column}" text' for column in columns)
+        values = {column: self.cast(column, table_columns[column]) for column in columns}
+        same_id = f't."id" = {values["id"]}'
+        cursor.execute(f'CREATE TEMPORARY TABLE staging ({staging_columns})')
+        cursor.copy_expert(f"COPY staging ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        # Postgres checks NOT NULL on the row an INSERT proposes before ON CONFLICT, existing rows are updated
+        # on their own
+        updates = [column for column in columns if column != 'id']
+        if updates:
+            assignments = ', '.join(f'"{column}" = {values[column]}' for column in updates)
+            cursor.execute(f'UPDATE {table} AS t SET {assignments} FROM staging AS s WHERE {same_id}')
+        conflict = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in updates)
+        cursor.execute(
+            f'INSERT INTO {table} ({column_list}) SELECT {", ".join(values.values())} FROM staging AS s '
+            f'WHERE NOT EXISTS (SELECT 1 FROM {table} AS t WHERE {same_id}) '
+            f'ON CONFLICT ("id") DO ' + (f'UPDATE SET {conflict}' if conflict else 'NOTHING')
+        )
+        cursor.execute('DROP TABLE staging')
@@ -0,0 +1,69 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from archive import open_filesystem
+
+
+class CustomerSnapshot:
+    """Hash of every customer in the last export, keyed by guid, so a sync only sends what changed.
+    Stored as a small Parquet file in a local directory or on S3."""
+    file_name = 'customers.parquet'
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.filesystem, root = open_filesystem(uri)
+        self.root = root.rstrip('/')
+        self.path = f'{self.root}/{self.file_name}'
+
+    @staticmethod
+    def hash_rows(df):
+        """One 64 bit hash per customer over all of its columns"""
+        hashes = pd.util.hash_pandas_object(df[sorted(df.columns)], index=False)
+        return pd.DataFrame({'guid': df['guid'].to_numpy(), 'hash': hashes.to_numpy()})
+
+    def load(self):
+        if self.filesystem.get_file_info(self.path).type == pa.fs.FileType.NotFound:
+            return pd.DataFrame({'guid': pd.Series(dtype=object), 'hash': pd.Series(dtype='uint64')})
+        return pq.read_table(self.path, filesystem=self.filesystem).to_pandas()
+
+    def save(self, hashes):
+        self.filesystem.create_dir(self.root, recursive=True)
+        table = pa.Table.from_pandas(hashes.reset_index(drop=True), preserve_index=False)
+        pq.write_table(table, self.path, filesystem=self.filesystem)
+
+    def diff(self, df, detect_deletes=True):
+        """Split an export into inserted and updated customers, plus the guids that disappeared since the last
+        snapshot. Partial exports (customers added last week) can't tell deletes apart so skip detecting them."""
+        current = self.hash_rows(df)
+        merged = current.merge(self.load(), on='guid', how='outer', suffixes=('', '_previous'), indicator=True)
+
+        inserted_guids = merged.loc[merged['_merge'] == 'left_only', 'guid']
+        changed = (merged['_merge'] == 'both') & (merged['hash'] != merged['hash_previous'])
+        updated_guids = merged.loc[changed, 'guid']
+        if detect_deletes:
+            deleted = merged.loc[merged['_merge'] == 'right_only', ['guid']].reset_index(drop=True)
+        else:
+            deleted = pd.DataFrame({'guid': pd.Series(dtype=object)})
+
+        inserted = df[df['guid'].isin(inserted_guids)]
+        updated = df[df['guid'].isin(updated_guids)]
+        print(f'Customer snapshot diff: {len(inserted)} inserted, {len(updated)} updated, {len(deleted)} deleted, '
+              f'{len(df) - len(inserted) - len(updated)} unchanged')
+        return inserted, updated, deleted
+
+    def deletes_allowed(self, deleted, max_ratio):
+        """A single run may delete at most max_ratio of the snapshot, more points at a broken export"""
+        size = len(self.load())
+        if size == 0 or len(deleted) <= max_ratio * size:
+            return True
+        print(f'Refusing to delete {len(deleted)} of {size} customers, more than {max_ratio:.0%} of the snapshot')
+        return False
+
+    def update(self, df, replace=True):
+        """Record an export as the new snapshot. Partial exports are merged into the previous snapshot."""
+        hashes = self.hash_rows(df)
+        if not replace:
+            previous = self.load()
+            hashes = pd.concat([previous[~previous['guid'].isin(hashes['guid'])], hashes], ignore_index=True)
+        self.save(hashes)
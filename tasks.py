@@ -1,12 +1,26 @@
 import logging
 import os
 import datetime
+from contextlib import contextmanager
 from time import sleep
 
 import requests
 
 from scrapers import BookerScraper
 from parser import BookerParser
+from archive import ExportArchive
+from schema import json_records
+from snapshot import CustomerSnapshot
+from export_progress import ExportProgress
+from customer_index import CustomerIndex
+from customer_queue import CustomerQueue
+from locations import LocationRegistry, DEFAULT_LOCATIONS
+from orchestrator import Orchestrator, LocalDispatcher, LambdaDispatcher, plan_shards, shard_name
+from metrics import current_run, timed
+from deadline import current_deadline, DeadlineExceeded
+from sinks import SegmentSink, JsonlSink, PostgresSink
+from object_uploader import ObjectUploader, OBJECTS_URL
+import pandas as pd
 from tempfile import TemporaryDirectory
 import hashlib
 import uuid
@@ -18,53 +32,336 @@ def string_to_uuid(s):
     return str(uuid.UUID(bytes=sha1.digest()[:16]))
 
 
+def get_archive():
+    archive_uri = os.environ.get('ARCHIVE_URI')
+    if not archive_uri:
+        return None
+    return ExportArchive(archive_uri)
+
+
+def get_export_progress():
+    """Resuming a stopped export stages its finished chunks from the archive, so it needs ARCHIVE_URI too"""
+    progress_uri = os.environ.get('EXPORT_PROGRESS_URI')
+    if not progress_uri or not os.environ.get('ARCHIVE_URI'):
+        return None
+    return ExportProgress(progress_uri)
+
+
+def get_parser(directory, archive=True, manifest=None, validate=True):
+    """BookerParser configured from the environment, TYPED_FRAMES=1 opts in to compact typed frames (money is
+    then sent as '-1234.50' instead of the export's text), PARSER_ENGINE=pyarrow to the multithreaded Arrow CSV
+    reader and VALIDATE_EXPORTS=0 turns validation off"""
+    typed = os.environ.get('TYPED_FRAMES', '').lower() in ['1', 'true', 'yes']
+    engine = os.environ.get('PARSER_ENGINE', 'pandas')
+    validate = validate and os.environ.get('VALIDATE_EXPORTS', '1').lower() in ['1', 'true', 'yes']
+    return BookerParser(directory, archive=get_archive() if archive else None, typed=typed, engine=engine,
+                        manifest=manifest, validate=validate)
+
+
+class TaskSession:
+    """One logged in scraper and the exports it parsed, shared by the tasks of a multi-task invocation"""
+
+    def __init__(self, driver, download_dir):
+        self.driver = driver
+        self.download_dir = download_dir
+        self.scraper = None
+        self.exports = {}
+
+
+_session = None
+
+
+def start_session(driver, download_dir):
+    global _session
+    _session = TaskSession(driver, download_dir)
+    return _session
+
+
+def end_session():
+    global _session
+    _session = None
+
+
+def release_driver(driver):
+    """Quit the driver after a failed task, unless other tasks of the session still need it"""
+    if _session is None and driver is not None:
+        driver.quit()
+
+
+def get_location_registry():
+    registry_uri = os.environ.get('LOCATION_REGISTRY_URI', '/tmp/booker_locations')
+    if not registry_uri:
+        return None
+    return LocationRegistry(registry_uri, ttl=float(os.environ.get('LOCATION_TTL_HOURS', 24)) * 60 * 60)
+
+
+def get_scraper(driver, download_dir, start_date, end_date, export_period=11, customer_index=None,
+                discover_locations=True, wait_time=15):
+    """Logged in scraper for the date window. Tasks of a session reuse the same scraper and login.
+    Scraped locations come from the location registry, tasks that don't loop over locations skip it."""
+    scraper = _session.scraper if _session is not None else None
+    if scraper is None:
+        try:
+            scraper = BookerScraper(
+                driver=driver,
+                start_date=start_date,
+                end_date=end_date,
+                download_dir=download_dir,
+                export_period=export_period,
+                customer_index=customer_index,
+                archive=get_archive(),
+                progress=get_export_progress(),
+                wait_time=wait_time,
+            )
+            scraper.login(
+                os.environ.get('BOOKER_ACCOUNT'),
+                os.environ.get('BOOKER_USERNAME'),
+                os.environ.get('BOOKER_PASSWORD')
+            )
+        except Exception as e:
+            release_driver(driver)
+            raise (e)
+        if _session is not None:
+            _session.scraper = scraper
+    else:
+        scraper.start_date = start_date
+        scraper.end_date = end_date
+        scraper.export_period = datetime.timedelta(days=export_period)
+        scraper.customer_index = customer_index
+        scraper.archive = get_archive()
+        scraper.progress = get_export_progress()
+        scraper.wait_time = wait_time
+    registry = get_location_registry() if discover_locations else None
+    if registry is not None:
+        scraper.locations = registry.get(scraper)
+    return scraper
+
+
+def cached_export(scraper, key, export):
+    """Download and parse an export into a fresh directory. Within a session the parsed frames are kept, keyed
+    by the export and its date window, so tasks asking for the same export share it."""
+    key = (*key, scraper.start_date, scraper.end_date, scraper.export_period)
+    if _session is not None and key in _session.exports:
+        print(f'Reusing {key[0]} export from an earlier task')
+        return _session.exports[key]
+    current_deadline().check(f'the {key[0]} export')
+    with TemporaryDirectory() as dest_dir:
+        scraper.destination_dir = dest_dir
+        scraper.manifest = []
+        frames = export(dest_dir)
+    if _session is not None:
+        _session.exports[key] = frames
+    return frames
+
+
+def export_appointments(scraper, location, date_type='date_on'):
+    def export(dest_dir):
+        scraper.appointments_flow(location, date_type=date_type)
+        return get_parser(dest_dir, manifest=scraper.manifest).import_appointments()
+    return cached_export(scraper, ('appointments', location['id'], date_type), export)
+
+
+def export_orders(scraper, location):
+    def export(dest_dir):
+        scraper.orders_flow(location)
+        return get_parser(dest_dir, manifest=scraper.manifest).import_orders()
+    return cached_export(scraper, ('orders', location['id']), export)
+
+
+def export_customers(scraper, flow):
+    def export(dest_dir):
+        getattr(scraper, flow)()
+        return get_parser(dest_dir, manifest=scraper.manifest).parse_customers()
+    return cached_export(scraper, ('customers', flow), export)
+
+
+_sink = None
+
+
+def get_sink(analytics):
+    """Where the send functions write, SINK=segment (default), jsonl (SINK_PATH) or postgres (the DB_*
+    variables and SINK_SCHEMA). SEGMENT_GZIP_LEVEL=1-9 has the segment sink post compressed batches itself.
+    The sink is kept for the warm Lambda, records queued by a task are flushed with the run."""
+    global _sink
+    name = os.environ.get('SINK', 'segment')
+    gzip_level = os.environ.get('SEGMENT_GZIP_LEVEL')
+    if name == 'segment' and gzip_level is None:
+        return SegmentSink(analytics)
+    if _sink is not None and _sink.name == name:
+        if name == 'segment':
+            # The handler sets the write key of every run
+            _sink.analytics = analytics
+            _sink.uploader.write_key = analytics.write_key
+        return _sink
+    if name == 'segment':
+        _sink = SegmentSink(analytics, ObjectUploader(
+            analytics.write_key,
+            url=os.environ.get('SEGMENT_OBJECTS_URL', OBJECTS_URL),
+            compress_level=int(gzip_level),
+            batch_size=int(os.environ.get('SEGMENT_BATCH_SIZE', 100)),
+        ))
+    elif name == 'jsonl':
+        _sink = JsonlSink(os.environ.get('SINK_PATH', '/tmp/booker_records.jsonl'))
+    elif name == 'postgres':
+        connection_string = f"postgresql://{os.environ.get('DB_USERNAME')}:{os.environ.get('DB_PASSWORD')}@" \
+                            f"{os.environ.get('DB_HOST')}:{os.environ.get('DB_PORT')}/{os.environ.get('DB_NAME')}"
+        _sink = PostgresSink(
+            connection_string,
+            schema=os.environ.get('SINK_SCHEMA', 'booker_prod'),
+            batch_size=int(os.environ.get('SINK_BATCH_SIZE', 5000)),
+        )
+    else:
+        raise Exception(f'Unknown sink {name}, use segment, jsonl or postgres')
+    return _sink
+
+
+@timed('send')
 def send_customers(dataframe, analytics):
+    """Returns the number of customers sent, fewer than the frame when the deadline stopped the sends"""
+    sink = get_sink(analytics)
     i = 0
-    for row in dataframe.iterrows():
-        data = dict(row[1])
-        analytics.object(object_id=data['guid'], collection='customers', properties=data)
+    for data in json_records(dataframe, 'customers'):
+        # Objects are merged, a customer that comes back after a delete is undeleted
+        sink.object(object_id=data['guid'], collection='customers', properties={**data, 'deleted': False})
         i += 1
         if i % 200 == 0:
-            analytics.flush()
-
-
+            sink.flush()
+            if current_deadline().should_stop(f'sending customers {i}-{len(dataframe)}', sending=True):
+                break
+    current_run().add_sent('customers', i)
+    return i
+
+
+@timed('send')
+def send_deleted_customers(dataframe, analytics):
+    sink = get_sink(analytics)
+    for guid in dataframe['guid']:
+        sink.object(object_id=guid, collection='customers', properties={'guid': guid, 'deleted': True})
+    sink.flush()
+    current_run().add_sent('customers', len(dataframe))
+
+
+def get_customer_snapshot():
+    snapshot_uri = os.environ.get('CUSTOMER_SNAPSHOT_URI')
+    if not snapshot_uri:
+        return None
+    return CustomerSnapshot(snapshot_uri)
+
+
+def get_customer_index():
+    index_uri = os.environ.get('CUSTOMER_INDEX_URI')
+    if not index_uri:
+        return None
+    return CustomerIndex(index_uri)
+
+
+def update_customer_index(dataframe):
+    customer_index = get_customer_index()
+    if customer_index is None:
+        return
+    customer_index.update_from_frame(dataframe)
+    customer_index.save()
+
+
+def sync_customers(dataframe, analytics, full_export=True, full_resync=False, max_delete_ratio=None):
+    """Send only the customers that changed since the last snapshot, or everyone on a full resync.
+    The snapshot is only updated once all the sends are flushed, a run stopped by the deadline resends them.
+    Customers missing from a full export are deleted, unless the export is empty, had files quarantined or would
+    delete more than max_delete_ratio (CUSTOMER_MAX_DELETE_RATIO, 0.1) of the snapshot. The snapshot then keeps
+    them."""
+    if max_delete_ratio is None:
+        max_delete_ratio = float(os.environ.get('CUSTOMER_MAX_DELETE_RATIO', 0.1))
+    quarantined = dataframe.attrs.get('quarantined', [])
+    detect_deletes = full_export and len(dataframe) > 0 and not quarantined
+    if full_export and not detect_deletes:
+        print(f'Customer export is incomplete ({len(dataframe)} customers, {len(quarantined)} files quarantined), '
+              f'not detecting deletes')
+    snapshot = get_customer_snapshot()
+    if snapshot is None or full_resync:
+        complete = send_customers(dataframe, analytics) == len(dataframe)
+        get_sink(analytics).flush()
+    else:
+        inserted, updated, deleted = snapshot.diff(dataframe, detect_deletes=detect_deletes)
+        if len(deleted) > 0 and not snapshot.deletes_allowed(deleted, max_delete_ratio):
+            deleted = deleted.iloc[:0]
+            detect_deletes = False
+        changed = pd.concat([inserted, updated], ignore_index=True)
+        complete = send_customers(changed, analytics) == len(changed)
+        get_sink(analytics).flush()
+        if complete and len(deleted) > 0:
+            send_deleted_customers(deleted, analytics)
+    if snapshot is not None and complete:
+        snapshot.update(dataframe, replace=detect_deletes)
+
+
+@timed('send')
 def send_appointments(appointment_dataframe, treatment_dataframe, analytics):
-    for row in appointment_dataframe.iterrows():
-        data = dict(row[1])
-        analytics.object(object_id=str(data['booking_number']), collection='appointments', properties=data)
-
-    for row in treatment_dataframe.iterrows():
-        data = dict(row[1])
-        analytics.object(object_id=string_to_uuid(f'{data["appointment"]}{data["appointment_on"]}'),
-                         collection='treatments',
-                         properties=data)
-    analytics.flush()
+    sink = get_sink(analytics)
+    sent = {'appointments': 0, 'treatments': 0}
+    for data in json_records(appointment_dataframe, 'appointments'):
+        if sent['appointments'] % 1000 == 0 and current_deadline().should_stop('sending appointments', sending=True):
+            break
+        sink.object(object_id=str(data['booking_number']), collection='appointments', properties=data)
+        sent['appointments'] += 1
+
+    for data in json_records(treatment_dataframe, 'treatments'):
+        if sent['treatments'] % 1000 == 0 and current_deadline().should_stop('sending treatments', sending=True):
+            break
+        sink.object(object_id=string_to_uuid(f'{data["appointment"]}{data["appointment_on"]}'),
+                    collection='treatments',
+                    properties=data)
+        sent['treatments'] += 1
+    sink.flush()
+    current_run().add_sent('appointments', sent['appointments'])
+    current_run().add_sent('treatments', sent['treatments'])
 
 
 def update_appointment_order(appointment_id, order_id, analytics):
-    analytics.object(object_id=str(appointment_id), collection='appointments', properties={'order_number': order_id})
+    get_sink(analytics).object(object_id=str(appointment_id), collection='appointments',
+                               properties={'order_number': order_id})
+    current_run().add_sent('appointments', 1)
 
 
+@timed('send')
 def send_orders(dataframe, analytics):
-    for row in dataframe.iterrows():
-        data = dict(row[1])
-        analytics.object(object_id=str(data['order_number']), collection='orders', properties=data)
-    analytics.flush()
+    sink = get_sink(analytics)
+    sent = 0
+    for data in json_records(dataframe, 'orders'):
+        if sent % 1000 == 0 and current_deadline().should_stop('sending orders', sending=True):
+            break
+        sink.object(object_id=str(data['order_number']), collection='orders', properties=data)
+        sent += 1
+    sink.flush()
+    current_run().add_sent('orders', sent)
+
+
+@contextmanager
+def segment_source(analytics, write_key):
+    """Send to another Segment source, the run's write key and client are restored afterwards so later tasks
+    and the sink keep sending to the run's source"""
+    write_key_before, client_before = analytics.write_key, analytics.default_client
+    analytics.default_client = None
+    analytics.write_key = write_key
+    try:
+        yield analytics
+    finally:
+        analytics.shutdown()
+        analytics.write_key = write_key_before
+        analytics.default_client = client_before
 
 
 def create_customer(driver, download_dir, analytics, customer_data):
     try:
-        scraper = BookerScraper(
-            driver=driver,
+        scraper = get_scraper(
+            driver, download_dir,
             start_date=datetime.date.today() - datetime.timedelta(days=1),
             end_date=datetime.date.today() + datetime.timedelta(days=1),
-        )
-        scraper.login(
-            os.environ.get('BOOKER_ACCOUNT'),
-            os.environ.get('BOOKER_USERNAME'),
-            os.environ.get('BOOKER_PASSWORD')
+            customer_index=get_customer_index(),
+            discover_locations=False,
         )
         customer_id = scraper.customer_create_flow(customer_data)
+        if scraper.customer_index is not None:
+            scraper.customer_index.save()
         message = {
             'customer_id': customer_id,
             'message': f'Created customer with id {customer_id}'
@@ -75,23 +372,22 @@ def create_customer(driver, download_dir, analytics, customer_data):
             'body': dumps(message)
         }
     except Exception as e:
-        driver.quit()
+        release_driver(driver)
         raise (e)
 
 
 def new_typeform_customer(driver, download_dir, analytics, customer, typeform, source_key, callback_object):
     try:
-        scraper = BookerScraper(
-            driver=driver,
+        scraper = get_scraper(
+            driver, download_dir,
             start_date=datetime.date.today() - datetime.timedelta(days=1),
             end_date=datetime.date.today() + datetime.timedelta(days=1),
-        )
-        scraper.login(
-            os.environ.get('BOOKER_ACCOUNT'),
-            os.environ.get('BOOKER_USERNAME'),
-            os.environ.get('BOOKER_PASSWORD')
+            customer_index=get_customer_index(),
+            discover_locations=False,
         )
         customer_id = scraper.customer_create_flow(customer)
+        if scraper.customer_index is not None:
+            scraper.customer_index.save()
         logging.debug(f'Created customer with id {customer_id}')
         print(f'Created customer with id {customer_id}')
 
@@ -103,14 +399,11 @@ def new_typeform_customer(driver, download_dir, analytics, customer, typeform, s
         response = requests.post(callback_object, json=object_json)
         assert response.status_code == 200
 
-        analytics.default_client = None
-        analytics.write_key = source_key
-        analytics.identify(user_id=customer_id, traits=customer)
-        analytics.flush()
-        sleep(3)
-        analytics.track(user_id=customer_id, event="Typeform Submission", properties=typeform['properties'])
-        analytics.shutdown()
-        analytics.default_client = None
+        with segment_source(analytics, source_key):
+            analytics.identify(user_id=customer_id, traits=customer)
+            analytics.flush()
+            sleep(3)
+            analytics.track(user_id=customer_id, event="Typeform Submission", properties=typeform['properties'])
 
         message = {
             'customer_id': customer_id,
@@ -122,324 +415,316 @@ def new_typeform_customer(driver, download_dir, analytics, customer, typeform, s
             'body': dumps(message)
         }
     except Exception as e:
-        driver.quit()
+        release_driver(driver)
         raise (e)
 
 
-def customers_today(driver, download_dir, analytics):
-    # TODO: Add check if multiple pages of customers exist, and then loop through them
-    with TemporaryDirectory() as dest_dir:
+def create_customers_batch(scraper, analytics, items, source_key=None, callback_object=None):
+    """Create customers on an already logged in scraper and return a guid or error for each of them.
+    Each item is a customer dict, or {'customer': {...}, 'typeform': {...}, 'source_key': ...} for Typeform
+    submissions, whose callbacks and Segment calls are sent in batches once every customer exists. At the deadline
+    the remaining customers are left uncreated, the ones created before still get their callbacks."""
+    results = []
+    for i, item in enumerate(items):
+        customer = item.get('customer', item)
         try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=1),
-                end_date=datetime.date.today() + datetime.timedelta(days=1),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-            scraper.customer_added_today_flow()
+            customer_id = scraper.customer_create_flow(customer)
+            print(f'Created customer with id {customer_id}')
+            results.append({'customer_id': customer_id})
+        except DeadlineExceeded as e:
+            print(f'Stopped creating customers: {e}')
+            current_deadline().stopped.append(f'creating customers {i + 1}-{len(items)}')
+            results.extend({'customer_id': None, 'error': str(e), 'stopped': True} for item in items[i:])
+            break
         except Exception as e:
-            driver.quit()
+            print(f'Could not create customer: {e}')
+            results.append({'customer_id': None, 'error': str(e)})
+    if scraper.customer_index is not None:
+        scraper.customer_index.save()
+
+    submissions = [(item, result) for item, result in zip(items, results)
+                   if result['customer_id'] and item.get('typeform')]
+
+    if submissions and callback_object:
+        with requests.Session() as session:
+            for item, result in submissions:
+                object_json = {
+                    "event_type": "assign_id",
+                    "form_id": item['typeform']['anonymousId'],
+                    "customer_id": result['customer_id'],
+                }
+                response = session.post(callback_object, json=object_json)
+                if response.status_code != 200:
+                    result['error'] = f'Typeform callback failed with status {response.status_code}'
+
+    by_source_key = {}
+    for item, result in submissions:
+        key = item.get('source_key', source_key)
+        if key:
+            by_source_key.setdefault(key, []).append((item, result))
+    for key, key_submissions in by_source_key.items():
+        with segment_source(analytics, key):
+            for item, result in key_submissions:
+                analytics.identify(user_id=result['customer_id'], traits=item['customer'])
+            analytics.flush()
+            sleep(3)
+            for item, result in key_submissions:
+                analytics.track(user_id=result['customer_id'], event="Typeform Submission",
+                                properties=item['typeform']['properties'])
+
+    return results
+
+
+def bulk_create_customers(driver, download_dir, analytics, customers, source_key=None, callback_object=None):
+    """Create a list of customers in one logged in session"""
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=1),
+        end_date=datetime.date.today() + datetime.timedelta(days=1),
+        customer_index=get_customer_index(),
+        discover_locations=False,
+    )
+
+    results = create_customers_batch(scraper, analytics, customers, source_key, callback_object)
+
+    error_count = len([result for result in results if result.get('error')])
+    message = {
+        'results': results,
+        'message': f'Created {len(results) - error_count} of {len(results)} customers'
+    }
+    from json import dumps
+    return {
+        'statusCode': 201 if error_count == 0 else 207,
+        'body': dumps(message)
+    }
+
+
+def get_customer_queue():
+    """The queue has to live on storage every Lambda container shares (e.g. an EFS mount), a queue in a container's
+    /tmp is never seen by the drain and is lost when the container is recycled"""
+    queue_path = os.environ.get('CUSTOMER_QUEUE_PATH')
+    if not queue_path:
+        return None
+    return CustomerQueue(queue_path)
+
+
+def enqueue_customer(driver, download_dir, analytics, customer, typeform=None, source_key=None):
+    """Accept a customer creation request without starting a browser, a worker creates it later"""
+    item = {'customer': customer}
+    if typeform:
+        item['typeform'] = typeform
+    if source_key:
+        item['source_key'] = source_key
+    queue = get_customer_queue()
+    if queue is None:
+        return {
+            'statusCode': 503,
+            'body': 'Customer queue is not configured, set CUSTOMER_QUEUE_PATH to shared storage'
+        }
+    request_id = queue.enqueue(item)
+    from json import dumps
+    return {
+        'statusCode': 202,
+        'body': dumps({'request_id': request_id, 'message': 'Customer creation queued'})
+    }
+
+
+def drain_customer_queue(driver, download_dir, analytics, batch_size=10, max_latency=5, callback_object=None):
+    """Create queued customers in micro-batches through one logged in session. A batch starts once
+    batch_size requests are waiting or the oldest one has waited max_latency seconds."""
+    queue = get_customer_queue()
+    if queue is None:
+        raise Exception('Customer queue is not configured, set CUSTOMER_QUEUE_PATH to shared storage')
+    if queue.size() == 0:
+        return 'No queued customers.'
+    if driver is None:
+        # The handler found the queue empty and didn't start Chrome
+        return 'Customers were queued after the drain started, leaving them for the next drain.'
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=1),
+        end_date=datetime.date.today() + datetime.timedelta(days=1),
+        customer_index=get_customer_index(),
+        discover_locations=False,
+    )
+
+    created = 0
+    failed = 0
+    batches = 0
+    while queue.wait_for_batch(batch_size, max_latency):
+        # Unclaimed requests stay queued for the next drain
+        if current_deadline().should_stop('creating queued customers'):
+            break
+        batch = queue.claim(batch_size)
+        if not batch:
+            continue
+        request_ids = [request_id for request_id, item in batch]
+        try:
+            results = create_customers_batch(scraper, analytics, [item for request_id, item in batch],
+                                             callback_object=callback_object)
+        except DeadlineExceeded as e:
+            queue.release(request_ids, count_attempt=False)
+            raise (e)
+        except Exception as e:
+            queue.release(request_ids)
             raise (e)
+        succeeded = [request_id for request_id, result in zip(request_ids, results) if result['customer_id']]
+        # Customers the deadline left uncreated weren't tried, their attempt doesn't count
+        stopped = [request_id for request_id, result in zip(request_ids, results) if result.get('stopped')]
+        failures = [request_id for request_id in request_ids if request_id not in succeeded + stopped]
+        queue.ack(succeeded)
+        queue.release(failures)
+        queue.release(stopped, count_attempt=False)
+        created += len(succeeded)
+        failed += len(failures)
+        batches += 1
+    return f'Created {created} queued customers in {batches} batches, {failed} failed.'
 
-        parser = BookerParser(dest_dir)
-        df = parser.parse_customers()
+
+def customers_today(driver, download_dir, analytics):
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=1),
+        end_date=datetime.date.today() + datetime.timedelta(days=1),
+    )
+    df = export_customers(scraper, 'customer_added_today_flow')
     send_customers(df, analytics)
+    update_customer_index(df)
     return f'Imported {len(df)} customers from today.'
 
 
 def daily_scrape(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=2),
-                end_date=datetime.date.today(),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=2
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-        except Exception as e:
-            driver.quit()
-            raise (e)
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=2),
+        end_date=datetime.date.today(),
+        export_period=2
+    )
 
     for location in scraper.locations.values():
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.appointments_flow(location, date_type='date_created')
-            parser = BookerParser(dest_dir)
-            a_df, t_df = parser.import_appointments()
+        a_df, t_df = export_appointments(scraper, location, date_type='date_created')
         send_appointments(a_df, t_df, analytics)
 
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.orders_flow(location)
-            parser = BookerParser(dest_dir)
-            df = parser.import_orders()
+        df = export_orders(scraper, location)
         send_orders(df, analytics)
 
 
 def daily_appointments_booked(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=2),
-                end_date=datetime.date.today(),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=2
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-        except Exception as e:
-            driver.quit()
-            raise (e)
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=2),
+        end_date=datetime.date.today(),
+        export_period=2
+    )
 
     for location in scraper.locations.values():
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.appointments_flow(location, date_type='date_created')
-            parser = BookerParser(dest_dir)
-            a_df, t_df = parser.import_appointments()
+        a_df, t_df = export_appointments(scraper, location, date_type='date_created')
         send_appointments(a_df, t_df, analytics)
 
 
 def daily_orders(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=2),
-                end_date=datetime.date.today(),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=2
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-        except Exception as e:
-            driver.quit()
-            raise (e)
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=2),
+        end_date=datetime.date.today(),
+        export_period=2
+    )
 
     for location in scraper.locations.values():
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.orders_flow(location)
-            parser = BookerParser(dest_dir)
-            df = parser.import_orders()
+        df = export_orders(scraper, location)
         send_orders(df, analytics)
 
 
 def daily_completed_appointments(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=1),
-                end_date=datetime.date.today(),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=1
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-        except Exception as e:
-            driver.quit()
-            raise (e)
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=1),
+        end_date=datetime.date.today(),
+        export_period=1
+    )
 
     for location in scraper.locations.values():
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.appointments_flow(location)
-            parser = BookerParser(dest_dir)
-            a_df, t_df = parser.import_appointments()
-
+        a_df, t_df = export_appointments(scraper, location)
         send_appointments(a_df, t_df, analytics)
 
 
-def weekly_scrape(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=7),
-                end_date=datetime.date.today() + datetime.timedelta(days=7),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=8
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-            scraper.customer_added_last_week_flow()
-            parser = BookerParser(dest_dir)
-            df = parser.parse_customers()
-        except Exception as e:
-            driver.quit()
-            raise (e)
-    send_customers(df, analytics)
+def weekly_scrape(driver, download_dir, analytics, full_resync=False):
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=7),
+        end_date=datetime.date.today() + datetime.timedelta(days=7),
+        export_period=8
+    )
+    df = export_customers(scraper, 'customer_added_last_week_flow')
+    sync_customers(df, analytics, full_export=False, full_resync=full_resync)
+    update_customer_index(df)
 
     for location in scraper.locations.values():
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.appointments_flow(location)
-            parser = BookerParser(dest_dir)
-            a_df, t_df = parser.import_appointments()
+        a_df, t_df = export_appointments(scraper, location)
         send_appointments(a_df, t_df, analytics)
 
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.orders_flow(location)
-            parser = BookerParser(dest_dir)
-            df = parser.import_orders()
+        df = export_orders(scraper, location)
         send_orders(df, analytics)
 
 
 def custom_order(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=365),
-                end_date=datetime.date.today() + datetime.timedelta(days=62),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=7
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-        except Exception as e:
-            driver.quit()
-            raise (e)
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=365),
+        end_date=datetime.date.today() + datetime.timedelta(days=62),
+        export_period=7,
+        discover_locations=False,
+    )
 
     # for location in scraper.locations.values():
     location = scraper.locations['ll']
-    with TemporaryDirectory() as dest_dir:
-        scraper.destination_dir = dest_dir
-        scraper.orders_flow(location)
-        parser = BookerParser(dest_dir)
-        df = parser.import_orders()
+    df = export_orders(scraper, location)
     send_orders(df, analytics)
 
 
 def custom_appointments(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=0),
-                end_date=datetime.date.today() + datetime.timedelta(days=60),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=21,
-                wait_time=120,
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-        except Exception as e:
-            driver.quit()
-            raise (e)
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=0),
+        end_date=datetime.date.today() + datetime.timedelta(days=60),
+        export_period=21,
+        discover_locations=False,
+        wait_time=120,
+    )
 
     # for location in scraper.locations.values():
     location = scraper.locations['ll']
-    with TemporaryDirectory() as dest_dir:
-        scraper.destination_dir = dest_dir
-        scraper.appointments_flow(location)
-        parser = BookerParser(dest_dir)
-        a_df, t_df = parser.import_appointments()
+    a_df, t_df = export_appointments(scraper, location)
     send_appointments(a_df, t_df, analytics)
 
 
-def all_customers(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=35),
-                end_date=datetime.date.today() + datetime.timedelta(days=32),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=10
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-            scraper.customer_flow()
-            parser = BookerParser(dest_dir)
-            df = parser.parse_customers()
-            send_customers(df, analytics)
-        except Exception as e:
-            driver.quit()
-            raise (e)
+def all_customers(driver, download_dir, analytics, full_resync=False):
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=35),
+        end_date=datetime.date.today() + datetime.timedelta(days=32),
+        export_period=10
+    )
+    df = export_customers(scraper, 'customer_flow')
+    sync_customers(df, analytics, full_resync=full_resync)
+    update_customer_index(df)
 
 
 def monthly_scrape(driver, download_dir, analytics):
-    with TemporaryDirectory() as dest_dir:
-        try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=32),
-                end_date=datetime.date.today() + datetime.timedelta(days=1),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-                export_period=10
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-            # scraper.customer_flow()
-            # parser = BookerParser(dest_dir)
-            # df = parser.parse_customers()
-        except Exception as e:
-            driver.quit()
-            raise (e)
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=32),
+        end_date=datetime.date.today() + datetime.timedelta(days=1),
+        export_period=10
+    )
+    # df = export_customers(scraper, 'customer_flow')
     # send_customers(df, analytics)
 
     for location in scraper.locations.values():
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.appointments_flow(location)
-            parser = BookerParser(dest_dir)
-            a_df, t_df = parser.import_appointments()
+        a_df, t_df = export_appointments(scraper, location)
         send_appointments(a_df, t_df, analytics)
 
-        with TemporaryDirectory() as dest_dir:
-            scraper.destination_dir = dest_dir
-            scraper.orders_flow(location)
-            parser = BookerParser(dest_dir)
-            df = parser.import_orders()
+        df = export_orders(scraper, location)
         send_orders(df, analytics)
 
 
@@ -462,7 +747,7 @@ def customer_weekly_scrape(driver, download_dir, analytics):
         except Exception as e:
             driver.quit()
             raise (e)
-        parser = BookerParser(dest_dir)
+        parser = get_parser(dest_dir, manifest=scraper.manifest)
         df = parser.parse_customers()
         send_customers(df, analytics)
 
@@ -487,7 +772,7 @@ def appointments_test(driver, download_dir, analytics):
         except Exception as e:
             driver.quit()
             raise (e)
-        parser = BookerParser(dest_dir)
+        parser = get_parser(dest_dir, manifest=scraper.manifest)
         a_df, t_df = parser.import_appointments()
 
     send_appointments(a_df, t_df, analytics)
@@ -539,7 +824,7 @@ def order_test(driver, download_dir, analytics):
         except Exception as e:
             driver.quit()
             raise (e)
-        parser = BookerParser(dest_dir)
+        parser = get_parser(dest_dir, manifest=scraper.manifest)
         df = parser.import_orders()
 
 
@@ -547,36 +832,171 @@ def appointment_map(driver, download_dir, analytics):
     from models import get_unmapped_appointments
     appointments = get_unmapped_appointments()
 
-    time_limit = datetime.datetime.now() + datetime.timedelta(minutes=10)
-
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=datetime.date.today() - datetime.timedelta(days=14),
+        end_date=datetime.date.today() + datetime.timedelta(days=2),
+        discover_locations=False,
+    )
+    amount = 0
+    for location in appointments.keys():
+        if current_deadline().should_stop(f'mapping the appointments of location {location}'):
+            break
+        # Stops looking up bookings at the deadline
+        for booking_number, order_number in scraper.appointment_map_booking_numbers_to_orders(
+            {"id": location},
+            appointments[location]
+        ):
+            update_appointment_order(booking_number, order_number, analytics)
+            amount += 1
+    return f"Updated {amount} appointments"
+
+
+def scrape_shard(driver, download_dir, analytics, shard):
+    """Worker side of sharded_scrape: export one location, type and window into the archive. The archive is the
+    only handoff to sharded_scrape, so the shard archives its raw exports itself and fails when it can't."""
+    archive = get_archive()
+    if archive is None:
+        raise Exception('Shards hand their exports over through the archive, set ARCHIVE_URI')
+    start_date = datetime.date.fromisoformat(shard['start_date'])
+    end_date = datetime.date.fromisoformat(shard['end_date'])
+    # Ending the scraper window on its start date makes the export loops run exactly one chunk
+    scraper = get_scraper(
+        driver, download_dir,
+        start_date=start_date,
+        end_date=start_date,
+        export_period=(end_date - start_date).days + 1,
+        discover_locations=False,
+    )
+    # Archived below, where a failed write fails the shard instead of being printed. A shard is a single chunk,
+    # the orchestrator retries it whole.
+    scraper.archive = None
+    scraper.progress = None
     with TemporaryDirectory() as dest_dir:
-        amount = 0
+        scraper.destination_dir = dest_dir
+        scraper.manifest = []
+        if shard['type'] == 'Appointment':
+            scraper.appointments_flow(shard['location'], date_type=shard.get('date_type', 'date_on'))
+        else:
+            scraper.orders_flow(shard['location'])
+        exports = [archive.archive_raw(export['type'], export['location'], export['path'], export['date_type'])
+                   for export in scraper.manifest]
+        # Only counted for the response, the files are parsed once by sharded_scrape after the merge
+        rows = sum(BookerParser.count_rows(export['path'], escape_char='\\' if export['type'] == 'Order' else None)
+                   for export in scraper.manifest)
+    return {
+        'statusCode': 200,
+        'body': f'Archived {rows} export rows of {shard_name(shard)}',
+        # Where the raw exports were archived, sharded_scrape merges exactly these
+        'exports': exports,
+    }
+
+
+def run_shard_locally(shard):
+    """Process pool entry point, every worker process scrapes its shard on its own headless Chrome"""
+    from webdriver_client import chrome_headless
+    lean = os.environ.get('LEAN_DRIVER', '').lower() in ['1', 'true', 'yes']
+    with TemporaryDirectory() as download_dir:
+        driver = chrome_headless(logging.getLogger(), download_dir, lean=lean)
         try:
-            scraper = BookerScraper(
-                driver=driver,
-                start_date=datetime.date.today() - datetime.timedelta(days=14),
-                end_date=datetime.date.today() + datetime.timedelta(days=2),
-                download_dir=download_dir,
-                destination_dir=dest_dir,
-            )
-            scraper.login(
-                os.environ.get('BOOKER_ACCOUNT'),
-                os.environ.get('BOOKER_USERNAME'),
-                os.environ.get('BOOKER_PASSWORD')
-            )
-            for location in appointments.keys():
-                for booking_number, order_number in scraper.appointment_map_booking_numbers_to_orders(
-                    {"id": location},
-                    appointments[location]
-                ):
-                    update_appointment_order(booking_number, order_number, analytics)
-                    amount += 1
-                    if datetime.datetime.now() > time_limit:
-                        break
-        except Exception as e:
+            return scrape_shard(driver, download_dir, None, shard)
+        finally:
             driver.quit()
-            raise (e)
-        return f"Updated {amount} appointments"
+
+
+def get_dispatcher(max_workers=None):
+    """Shards run as Lambda invocations of SHARD_FUNCTION_NAME (this function by default) when deployed, and in
+    local worker processes otherwise. SHARD_DISPATCH=local|lambda overrides it."""
+    function_name = os.environ.get('SHARD_FUNCTION_NAME', os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+    dispatch = os.environ.get('SHARD_DISPATCH', 'lambda' if function_name else 'local')
+    if dispatch == 'lambda':
+        return LambdaDispatcher(function_name, max_workers=max_workers or 10)
+    return LocalDispatcher(run_shard_locally, max_workers=max_workers or 2)
+
+
+def sharded_scrape(driver, download_dir, analytics, start_date=None, end_date=None, period=10, types=None,
+                   date_type='date_on', max_workers=None):
+    """Scrape every location, export type and window as parallel shards, then merge what the shards archived and
+    send it once. Defaults to the monthly_scrape window, failed shards are retried on their own."""
+    archive = get_archive()
+    if archive is None:
+        raise Exception('Sharded scrapes need an archive, set ARCHIVE_URI')
+    start_date = datetime.date.fromisoformat(start_date) if start_date else \
+        datetime.date.today() - datetime.timedelta(days=32)
+    end_date = datetime.date.fromisoformat(end_date) if end_date else \
+        datetime.date.today() + datetime.timedelta(days=1)
+    registry = get_location_registry()
+    locations = registry.cached() if registry is not None else dict(DEFAULT_LOCATIONS)
+
+    shards = plan_shards(locations, start_date, end_date, period, types, date_type)
+    print(f'Dispatching {len(shards)} shards')
+    orchestrator = Orchestrator(get_dispatcher(max_workers), int(os.environ.get('SHARD_MAX_ATTEMPTS', 3)))
+    succeeded, failed, stopped = orchestrator.run(shards)
+
+    # Merge exactly the exports of this run, older archived exports of the same window are left out
+    with TemporaryDirectory() as dest_dir:
+        manifest = []
+        merged = []
+        for shard, result in succeeded:
+            try:
+                staged = [archive.stage_file(dest_dir, path) for path in result['exports']]
+            except Exception as e:
+                # A shard whose exports can't be read from the archive failed, the other shards are still sent
+                print(f'Could not stage the exports of shard {shard_name(shard)}')
+                print(e)
+                failed.append((shard, f'Archived exports not found: {e}'))
+                continue
+            merged.append(shard)
+            for path in staged:
+                manifest.append({
+                    'type': shard['type'],
+                    'location': shard['location']['id'],
+                    'start_date': datetime.date.fromisoformat(shard['start_date']),
+                    'end_date': datetime.date.fromisoformat(shard['end_date']),
+                    'date_type': shard.get('date_type'),
+                    'path': path,
+                })
+        parser = get_parser(dest_dir, archive=False, manifest=manifest)
+        if any(shard['type'] == 'Appointment' for shard in merged):
+            a_df, t_df = parser.import_appointments()
+            send_appointments(a_df, t_df, analytics)
+        if any(shard['type'] == 'Order' for shard in merged):
+            send_orders(parser.import_orders(), analytics)
+
+    message = {
+        'message': f'Scraped {len(merged)} of {len(shards)} shards',
+        'failed': [{'shard': shard_name(shard), 'error': error} for shard, error in failed],
+        'stopped': [shard_name(shard) for shard in stopped],
+    }
+    from json import dumps
+    return {
+        'statusCode': 200 if not failed else 207,
+        'body': dumps(message)
+    }
+
+
+def replay(driver, download_dir, analytics, archive_uri=None, start_date=None, end_date=None, types=None):
+    """Parse and send archived exports again without starting a browser"""
+    archive = ExportArchive(archive_uri) if archive_uri else get_archive()
+    if archive is None:
+        raise Exception('No archive to replay, set ARCHIVE_URI or pass an archive')
+    start_date = datetime.date.fromisoformat(start_date) if start_date else None
+    end_date = datetime.date.fromisoformat(end_date) if end_date else None
+
+    with TemporaryDirectory() as dest_dir:
+        staged = archive.stage_raw(dest_dir, start_date, end_date, types)
+        print(f'Replaying {staged} from {archive.uri}')
+        # Files already live in the archive and were validated when they were scraped, their file names don't
+        # record the date type the window was filtered on
+        parser = get_parser(dest_dir, archive=False, validate=False)
+        if staged.get('Customer'):
+            send_customers(parser.parse_customers(), analytics)
+        if staged.get('Appointment'):
+            a_df, t_df = parser.import_appointments()
+            send_appointments(a_df, t_df, analytics)
+        if staged.get('Order'):
+            send_orders(parser.import_orders(), analytics)
+    return f'Replayed {sum(staged.values())} archived exports.'
 
 
 def test_response(driver, download_dir, analytics):
@@ -0,0 +1,99 @@
+import io
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from customer_index import CustomerIndex
+
+
+class FakeS3:
+    """An S3 bucket that honours IfMatch and IfNoneMatch, before_put runs once before the first write to let
+    another task write in between"""
+
+    def __init__(self, before_put=None):
+        self.objects = {}
+        self.versions = 0
+        self.before_put = before_put
+        self.puts = 0
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body, etag = self.objects[Key]
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        if self.before_put is not None:
+            before_put, self.before_put = self.before_put, None
+            before_put()
+        self.puts += 1
+        current = self.objects.get(Key)
+        if (IfNoneMatch == '*' and current) or (IfMatch and (current is None or current[1] != IfMatch)):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.versions += 1
+        self.objects[Key] = (Body, f'"{self.versions}"')
+
+
+class CustomerIndexS3Test(unittest.TestCase):
+    uri = 's3://booker-index/prod?region=us-west-2'
+
+    def test_concurrent_saves_keep_both_entries(self):
+        s3 = FakeS3()
+        first = CustomerIndex(self.uri, s3=s3)
+        second = CustomerIndex(self.uri, s3=s3)
+        first.add('guid-1', email='one@example.com')
+        # The second task saves between the first one's read and write
+        s3.before_put = second.save
+        second.add('guid-2', email='Two@Example.com', phone='(208) 555-1234')
+        first.save()
+        index = CustomerIndex(self.uri, s3=s3)
+        self.assertEqual(index.lookup(email='one@example.com'), 'guid-1')
+        self.assertEqual(index.lookup(email='two@example.com'), 'guid-2')
+        self.assertEqual(index.lookup(phone='2085551234'), 'guid-2')
+        # The first write was refused and retried on the second task's index
+        self.assertEqual(s3.puts, 3)
+        self.assertEqual(first.lookup(phone='+12085551234'), 'guid-2')
+
+    def test_gives_up_when_the_index_keeps_changing(self):
+        s3 = FakeS3()
+        index = CustomerIndex(self.uri, s3=s3, max_attempts=2)
+        other = CustomerIndex(self.uri, s3=s3)
+        index.add('guid-1', email='one@example.com')
+
+        def write_in_between():
+            other.add(f'guid-{s3.versions}', email='other@example.com')
+            other.save()
+            s3.before_put = write_in_between
+        s3.before_put = write_in_between
+        with self.assertRaises(Exception):
+            index.save()
+
+    def test_nothing_to_save(self):
+        s3 = FakeS3()
+        CustomerIndex(self.uri, s3=s3).save()
+        self.assertEqual(s3.puts, 0)
+
+
+class CustomerIndexLocalTest(unittest.TestCase):
+    def test_saves_merge_into_the_stored_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            uri = os.path.join(directory, 'index')
+            first = CustomerIndex(uri)
+            second = CustomerIndex(uri)
+            first.update_from_frame(pd.DataFrame({
+                'guid': ['guid-1'], 'email': [' One@Example.com '], 'primary_phone': ['+12085551234'],
+            }))
+            second.add('guid-2', email='two@example.com')
+            second.save()
+            first.save()
+            index = CustomerIndex(uri)
+            self.assertEqual(index.lookup(email='one@example.com'), 'guid-1')
+            self.assertEqual(index.lookup(phone='208-555-1234'), 'guid-1')
+            self.assertEqual(index.lookup(email='two@example.com'), 'guid-2')
+
+
+if __name__ == '__main__':
+    unittest.main()
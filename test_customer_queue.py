@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import tasks
+from customer_queue import CustomerQueue
+
+
+class CustomerQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'queue.sqlite3')
+        self.queue = CustomerQueue(self.path, visibility_timeout=60, max_attempts=2)
+        self.request_id = self.queue.enqueue({'first_name': 'Jane'})
+
+    def attempts(self):
+        return self.queue.connection.execute('SELECT attempts FROM requests WHERE id = ?',
+                                             (self.request_id,)).fetchone()[0]
+
+    def test_rollback_journal(self):
+        # WAL isn't safe on the network filesystems the queue lives on
+        mode = self.queue.connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'delete')
+
+    def test_claim_hides_the_request(self):
+        self.assertEqual(self.queue.claim(10), [(self.request_id, {'first_name': 'Jane'})])
+        self.assertEqual(self.queue.claim(10), [])
+        self.assertEqual(self.queue.size(), 0)
+
+    def test_claim_counts_the_attempt(self):
+        self.queue.claim(10)
+        self.assertEqual(self.attempts(), 1)
+        self.queue.release([self.request_id])
+        self.assertEqual(self.attempts(), 1)
+
+    def test_crashed_claims_become_dead_letters(self):
+        # The worker never releases, the request comes back after the visibility timeout
+        with mock.patch('customer_queue.time.time', return_value=1000):
+            self.queue.claim(10)
+        with mock.patch('customer_queue.time.time', return_value=1100):
+            self.assertEqual(len(self.queue.claim(10)), 1)
+        with mock.patch('customer_queue.time.time', return_value=1200):
+            self.assertEqual(self.queue.claim(10), [])
+            self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.attempts(), 2)
+
+    def test_release_without_counting(self):
+        for i in range(3):
+            self.assertEqual(len(self.queue.claim(10)), 1)
+            self.queue.release([self.request_id], count_attempt=False)
+        self.assertEqual(self.attempts(), 0)
+        self.assertEqual(self.queue.size(), 1)
+
+    def test_ack_removes_the_request(self):
+        self.queue.claim(10)
+        self.queue.ack([self.request_id])
+        self.assertIsNone(self.queue.oldest_age())
+
+
+class DrainCustomerQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = CustomerQueue(os.path.join(directory.name, 'queue.sqlite3'), max_attempts=3)
+        self.ids = [self.queue.enqueue({'first_name': name}) for name in ['Jane', 'John', 'Joan']]
+        for target, value in [('get_customer_queue', self.queue), ('get_scraper', mock.Mock()),
+                              ('get_customer_index', None)]:
+            patcher = mock.patch.object(tasks, target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def attempts(self):
+        return dict(self.queue.connection.execute('SELECT id, attempts FROM requests').fetchall())
+
+    def test_deadline_release_is_neutral(self):
+        results = [
+            {'customer_id': 'guid-1'},
+            {'customer_id': None, 'error': 'Invalid email'},
+            {'customer_id': None, 'error': 'Stopped', 'stopped': True},
+        ]
+        with mock.patch.object(tasks, 'create_customers_batch', return_value=results), \
+                mock.patch.object(self.queue, 'wait_for_batch', side_effect=[True, False]):
+            message = tasks.drain_customer_queue(mock.Mock(), None, None, batch_size=3)
+        self.assertEqual(message, 'Created 1 queued customers in 1 batches, 1 failed.')
+        self.assertEqual(self.attempts(), {self.ids[1]: 1, self.ids[2]: 0})
+        self.assertEqual(self.queue.size(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
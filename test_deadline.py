@@ -0,0 +1,106 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from selenium.common.exceptions import TimeoutException
+
+import deadline
+from deadline import Deadline, DeadlineExceeded
+from export_progress import ExportProgress
+from retry import RetryPolicy
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_unlimited_without_context(self):
+        self.assertFalse(Deadline.from_context(None).should_stop('work'))
+
+    def test_reserves(self):
+        current = Deadline(remaining_seconds=60, reserve=120, send_reserve=20)
+        self.assertTrue(current.should_stop('the order export'))
+        self.assertFalse(current.should_stop('sending orders', sending=True))
+        self.assertEqual(current.stopped, ['the order export'])
+
+    def test_check_raises(self):
+        with self.assertRaises(DeadlineExceeded):
+            Deadline(remaining_seconds=10).check('the customer export')
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('retry.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_deadline(self, remaining_seconds):
+        patcher = mock.patch.object(deadline, '_current_deadline', Deadline(remaining_seconds))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def flaky(self, failures, error):
+        calls = []
+
+        def step():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise error
+            return 'done'
+        return step, calls
+
+    def test_retries_transient_errors(self):
+        step, calls = self.flaky(2, TimeoutException('slow'))
+        self.assertEqual(RetryPolicy('step').call(step), 'done')
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_fail_right_away(self):
+        step, calls = self.flaky(1, ValueError('broken'))
+        with self.assertRaises(ValueError):
+            RetryPolicy('step').call(step)
+        self.assertEqual(len(calls), 1)
+
+    def test_deadline_stops_retrying(self):
+        self.use_deadline(60)
+        step, calls = self.flaky(1, TimeoutException('slow'))
+        with self.assertRaises(DeadlineExceeded) as raised:
+            RetryPolicy('step').call(step)
+        self.assertIsInstance(raised.exception.__cause__, TimeoutException)
+        self.assertEqual(len(calls), 1)
+
+    def test_sends_retry_into_the_send_reserve(self):
+        self.use_deadline(60)
+        step, calls = self.flaky(1, ConnectionError('reset'))
+        policy = RetryPolicy('upload', retryable=(ConnectionError,), sending=True)
+        self.assertEqual(policy.call(step), 'done')
+        self.assertEqual(len(calls), 2)
+
+
+class ExportProgressTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.progress = ExportProgress(os.path.join(directory.name, 'progress'))
+        period = datetime.timedelta(days=7)
+        self.orders = ExportProgress.key('Order', '51309', 'date_created', '2024-03-01', '2024-03-31', period)
+        self.appointments = ExportProgress.key('Appointment', '51309', 'date_on', '2024-03-01', '2024-03-31', period)
+
+    def test_record_and_clear(self):
+        self.progress.record(self.orders, datetime.date(2024, 3, 1), 'raw/Order/51309/a.csv')
+        self.progress.record(self.orders, datetime.date(2024, 3, 8), 'raw/Order/51309/b.csv')
+        self.assertEqual(self.progress.chunks(self.orders),
+                         {'2024-03-01': 'raw/Order/51309/a.csv', '2024-03-08': 'raw/Order/51309/b.csv'})
+        self.progress.clear(self.orders)
+        self.assertEqual(self.progress.chunks(self.orders), {})
+
+    def test_exports_are_kept_apart(self):
+        # Another task or shard writing its own export doesn't lose this one's chunks
+        other = ExportProgress(self.progress.uri)
+        self.progress.record(self.orders, datetime.date(2024, 3, 1), 'a.csv')
+        other.record(self.appointments, datetime.date(2024, 3, 1), 'b.csv')
+        other.clear(self.appointments)
+        self.assertEqual(self.progress.chunks(self.orders), {'2024-03-01': 'a.csv'})
+        self.assertEqual(os.listdir(self.progress.root), [os.path.basename(self.progress.path(self.orders))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import io
+import os
+import tarfile
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+from invalid_file_handler import InvalidFileHandler
+
+BUCKET = 'booker-invalid-files'
+REGION = 'us-west-2'
+SENDER = 'scraper@example.com'
+
+
+@mock_aws
+class InvalidFileHandlerTest(unittest.TestCase):
+    """Runs against moto's in-process S3 and SES"""
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.s3 = boto3.client('s3', region_name=REGION)
+        self.s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+        boto3.client('ses', region_name=REGION).verify_email_identity(EmailAddress=SENDER)
+        InvalidFileHandler._instance = None
+        self.addCleanup(setattr, InvalidFileHandler, '_instance', None)
+        self.handler = InvalidFileHandler(BUCKET, REGION, SENDER, 'team@example.com')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def export(self, name, content='garbage\n'):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def bundle(self):
+        key = f'{self.handler.dir_name}/{InvalidFileHandler.bundle_name}'
+        body = self.s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+        with tarfile.open(fileobj=io.BytesIO(body), mode='r:gz') as bundle:
+            return {member.name: bundle.extractfile(member).read().decode() for member in bundle.getmembers()}
+
+    def test_uploads_one_bundle(self):
+        self.handler.add_error(self.export('Order 2024-03-01.csv'), ValueError('duplicate order_number'))
+        self.handler.add_error(self.export('Customer 2024-03-01.csv', 'x\n'), ValueError('missing guid'))
+        self.assertTrue(self.handler.has_errors())
+        bundle = self.bundle()
+        self.assertEqual(bundle['Order 2024-03-01.csv'], 'garbage\n')
+        self.assertEqual(bundle['Customer 2024-03-01.csv'], 'x\n')
+        self.assertIn('duplicate order_number', bundle['error_details.txt'])
+        self.assertEqual(self.handler.link,
+                         f'https://{BUCKET}.s3.{REGION}.amazonaws.com/{self.handler.dir_name}/invalid_files.tar.gz')
+        # Reported once per run
+        self.assertTrue(self.handler.has_errors())
+
+    def test_file_survives_its_directory(self):
+        path = self.export('Order 2024-03-01.csv')
+        self.handler.add_error(path, ValueError('bad'))
+        os.remove(path)
+        self.handler.has_errors()
+        self.assertEqual(self.bundle()['Order 2024-03-01.csv'], 'garbage\n')
+
+    def test_missing_file_is_only_listed(self):
+        missing = os.path.join(self.directory.name, 'Order 2024-03-08.csv')
+        self.handler.add_error(missing, ValueError('moved away'))
+        self.assertEqual(self.handler.error_count(), 1)
+        self.assertTrue(self.handler.has_errors())
+        bundle = self.bundle()
+        self.assertEqual(list(bundle), ['error_details.txt'])
+        self.assertIn('moved away', bundle['error_details.txt'])
+
+    def test_clear_errors_waits_for_the_running_file(self):
+        add_to_bundle = self.handler._add_to_bundle
+
+        def slow_add_to_bundle(*args):
+            time.sleep(0.2)
+            add_to_bundle(*args)
+
+        with mock.patch.object(self.handler, '_add_to_bundle', side_effect=slow_add_to_bundle):
+            for i in range(3):
+                self.handler.add_error(self.export(f'Order {i}.csv'), ValueError('bad'))
+            pending = list(self.handler.pending)
+            self.handler.clear_errors()
+        # The running file finished into the discarded bundle, the waiting ones were cancelled
+        self.assertTrue(all(future.done() for future in pending))
+        self.assertTrue(all(future.cancelled() or future.exception() is None for future in pending))
+        self.assertEqual(self.handler.error_count(), 0)
+        self.assertFalse(self.handler.has_errors())
+
+        self.handler.add_error(self.export('Order 2024-03-15.csv'), ValueError('bad'))
+        self.assertTrue(self.handler.has_errors())
+        self.assertEqual(sorted(self.bundle()), ['Order 2024-03-15.csv', 'error_details.txt'])
+
+    def test_endpoint_link(self):
+        InvalidFileHandler._instance = None
+        handler = InvalidFileHandler(BUCKET, REGION, SENDER, 'team@example.com', endpoint_url='http://localhost:9000/')
+        handler.dir_name = 'run'
+        self.assertEqual(handler._get_aws_link('run/invalid_files.tar.gz'),
+                         f'http://localhost:9000/{BUCKET}/run/invalid_files.tar.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import gzip
+import json
+import unittest
+from unittest import mock
+
+import requests
+
+from object_uploader import ObjectUploader, RetryableResponse
+
+
+class FakeSession:
+    """Answers every post with the next response, an exception in the list is raised instead"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.posts = []
+
+    def post(self, url, data, headers, auth, timeout):
+        self.posts.append((data, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        if isinstance(response, int):
+            status_code, response = response, requests.Response()
+            response.status_code = status_code
+        return response
+
+
+class ObjectUploaderTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('retry.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, responses, max_attempts=5):
+        session = FakeSession(responses)
+        uploader = ObjectUploader('key', session=session, max_attempts=max_attempts)
+        uploader.object('1001', 'orders', {'status': 'Closed'})
+        uploader.flush()
+        return uploader, session
+
+    def test_gzipped_payload(self):
+        uploader, session = self.upload([200])
+        data, headers = session.posts[0]
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(data)),
+                         {'collection': 'orders', 'objects': [{'id': '1001', 'properties': {'status': 'Closed'}}]})
+        self.assertEqual(uploader.sent_batches, 1)
+
+    def test_retries_server_errors(self):
+        uploader, session = self.upload([503, 500, 200])
+        self.assertEqual(len(session.posts), 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(uploader.sent_batches, 1)
+
+    def test_retries_rate_limits_and_connection_errors(self):
+        uploader, session = self.upload([429, requests.ConnectionError('reset'), requests.Timeout('slow'), 200])
+        self.assertEqual(len(session.posts), 4)
+        self.assertEqual(uploader.sent_batches, 1)
+
+    def test_client_errors_fail_right_away(self):
+        with self.assertRaises(requests.HTTPError) as raised:
+            self.upload([400, 200])
+        self.assertNotIsInstance(raised.exception, RetryableResponse)
+        self.assertEqual(self.sleep.call_count, 0)
+
+    def test_gives_up_after_max_attempts(self):
+        with self.assertRaises(RetryableResponse):
+            self.upload([503, 503, 503, 200], max_attempts=3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
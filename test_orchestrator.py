@@ -0,0 +1,112 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import deadline
+from deadline import Deadline
+from orchestrator import Orchestrator, plan_shards
+from parser import BookerParser
+
+LOCATIONS = {'Downtown': {'id': '51309', 'name': 'Downtown'}}
+
+
+class PlanShardsTest(unittest.TestCase):
+    def windows(self, shards, type='Appointment'):
+        return [(shard['start_date'], shard['end_date']) for shard in shards if shard['type'] == type]
+
+    def test_last_window_ends_on_end_date(self):
+        shards = plan_shards(LOCATIONS, datetime.date(2024, 3, 1), datetime.date(2024, 3, 20), 7)
+        self.assertEqual(self.windows(shards), [
+            ('2024-03-01', '2024-03-07'),
+            ('2024-03-08', '2024-03-14'),
+            ('2024-03-15', '2024-03-20'),
+        ])
+
+    def test_window_ending_on_end_date(self):
+        shards = plan_shards(LOCATIONS, datetime.date(2024, 3, 1), datetime.date(2024, 3, 14), 7)
+        self.assertEqual(self.windows(shards), [('2024-03-01', '2024-03-07'), ('2024-03-08', '2024-03-14')])
+
+    def test_single_day(self):
+        shards = plan_shards(LOCATIONS, datetime.date(2024, 3, 1), datetime.date(2024, 3, 1), 7)
+        self.assertEqual(self.windows(shards), [('2024-03-01', '2024-03-01')])
+        self.assertEqual(self.windows(shards, 'Order'), [('2024-03-01', '2024-03-01')])
+
+    def test_orders_are_exported_by_date_created(self):
+        shards = plan_shards(LOCATIONS, datetime.date(2024, 3, 1), datetime.date(2024, 3, 1), 7, date_type='date_on')
+        self.assertEqual({shard['type']: shard['date_type'] for shard in shards},
+                         {'Appointment': 'date_on', 'Order': 'date_created'})
+
+
+class FakeDispatcher:
+    """Runs shards on threads, every shard fails the number of times given for its start date. The blocked shard
+    runs until running is set."""
+
+    def __init__(self, failures, blocked=None):
+        self.failures = failures
+        self.blocked = blocked
+        self.running = threading.Event()
+        self.calls = []
+
+    def executor(self):
+        return ThreadPoolExecutor(2)
+
+    def submit(self, executor, shard):
+        return executor.submit(self.invoke, shard)
+
+    def invoke(self, shard):
+        self.calls.append(shard['start_date'])
+        if shard['start_date'] == self.blocked:
+            self.running.wait()
+        if self.calls.count(shard['start_date']) <= self.failures.get(shard['start_date'], 0):
+            raise Exception(f'{shard["start_date"]} failed')
+        return {'statusCode': 200}
+
+
+class OrchestratorTest(unittest.TestCase):
+    def setUp(self):
+        self.shards = plan_shards(LOCATIONS, datetime.date(2024, 3, 1), datetime.date(2024, 3, 14), 7,
+                                  types=['Order'])
+
+    def test_retries_failed_shards(self):
+        dispatcher = FakeDispatcher({'2024-03-08': 2})
+        results, failed, stopped = Orchestrator(dispatcher, max_attempts=3, poll_seconds=0.01).run(self.shards)
+        self.assertEqual([shard['start_date'] for shard, _ in results], ['2024-03-01', '2024-03-08'])
+        self.assertEqual((failed, stopped), ([], []))
+        self.assertEqual(dispatcher.calls.count('2024-03-08'), 3)
+
+    def test_gives_up_after_max_attempts(self):
+        dispatcher = FakeDispatcher({'2024-03-08': 3})
+        results, failed, stopped = Orchestrator(dispatcher, max_attempts=3, poll_seconds=0.01).run(self.shards)
+        self.assertEqual([shard['start_date'] for shard, _ in results], ['2024-03-01'])
+        self.assertEqual([(shard['start_date'], error) for shard, error in failed],
+                         [('2024-03-08', '2024-03-08 failed')])
+
+    def test_no_retries_at_the_deadline(self):
+        dispatcher = FakeDispatcher({'2024-03-01': 1}, blocked='2024-03-08')
+        self.addCleanup(dispatcher.running.set)
+        with mock.patch.object(deadline, '_current_deadline', Deadline(remaining_seconds=10)):
+            results, failed, stopped = Orchestrator(dispatcher).run(self.shards)
+        self.assertEqual(results, [])
+        self.assertEqual([shard['start_date'] for shard, _ in failed], ['2024-03-01'])
+        self.assertEqual(dispatcher.calls.count('2024-03-01'), 1)
+        # Left running instead of being waited for
+        self.assertEqual([shard['start_date'] for shard in stopped], ['2024-03-08'])
+
+
+class ShardRowsTest(unittest.TestCase):
+    def test_counts_rows_without_parsing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'Order 2024-03-01.csv')
+            with open(path, 'w') as f:
+                f.write('Order Number,Notes\n1,"two\nlines"\n2,"quoted \\" text"\n')
+            self.assertEqual(BookerParser.count_rows(path, escape_char='\\'), 2)
+            # Nothing was quarantined or archived
+            self.assertEqual(os.listdir(directory), ['Order 2024-03-01.csv'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import date
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from archive import ExportArchive
+from parser import BookerParser
+
+
+class NormalizeMoneyTest(unittest.TestCase):
+    values = ['$1,234.56', '', '-$1,234.56', '($5.00)', '$0.99', '12', '$1,000,000.00', '-0.50']
+    # Only dollar signs and separators are stripped, parentheses and missing cents are kept as exported
+    normalized = ['1234.56', '', '-1234.56', '(5.00)', '0.99', '12', '1000000.00', '-0.50']
+
+    def test_orders_blanks_become_zero(self):
+        df = pd.DataFrame({'total_price': self.values, 'tip': list(reversed(self.values))})
+        BookerParser.normalize_money(df, ['total_price', 'tip'], blank='0.00')
+        expected = [value or '0.00' for value in self.normalized]
+        self.assertEqual(df['total_price'].tolist(), expected)
+        self.assertEqual(df['tip'].tolist(), list(reversed(expected)))
+
+    def test_treatments_keep_blanks(self):
+        df = pd.DataFrame({'price': self.values, 'tax': self.values, 'total': self.values})
+        BookerParser.normalize_money(df, ['price', 'tax', 'total'])
+        for column in ['price', 'tax', 'total']:
+            self.assertEqual(df[column].tolist(), self.normalized)
+
+    def test_missing_values(self):
+        # pandas reads blank money cells of the treatments as NaN
+        df = pd.DataFrame({'price': ['$1,234.56', np.nan, '-$2.00'], 'tax': [np.nan, '$0.10', np.nan]})
+        BookerParser.normalize_money(df, ['price', 'tax'])
+        self.assertEqual(df['price'].tolist(), ['1234.56', None, '-2.00'])
+        self.assertEqual(df['tax'].tolist(), [None, '0.10', None])
+
+    def test_numeric_columns_are_left_alone(self):
+        df = pd.DataFrame({'price': [1.5, 2.0], 'total': ['$1,001.50', '$2.00']})
+        BookerParser.normalize_money(df, ['price', 'total'])
+        self.assertEqual(df['price'].dtype, np.float64)
+        self.assertEqual(df['price'].tolist(), [1.5, 2.0])
+        self.assertEqual(df['total'].tolist(), ['1001.50', '2.00'])
+
+
+class NormalizePhonesTest(unittest.TestCase):
+    columns = ['primary_phone', 'mobile_phone']
+
+    def test_local_numbers_get_plus_one(self):
+        phones = ['(208) 555-1234', '', '208.555.0000', '+44 20 7946 0958', '2085550000', None]
+        df = pd.DataFrame({'primary_phone': phones, 'mobile_phone': list(reversed(phones))})
+        BookerParser.normalize_phones(df, self.columns)
+        expected = ['+12085551234', '', '+12085550000', '+1442079460958', '+12085550000', None]
+        self.assertEqual(df['primary_phone'].tolist(), expected)
+        self.assertEqual(df['mobile_phone'].tolist(), list(reversed(expected)))
+
+    def test_country_code(self):
+        # 11 digits starting with 1 already carry the country code and don't get another +1
+        df = pd.DataFrame({'primary_phone': ['12085551111', '+1 (208) 555-1111', '22085551111'],
+                           'mobile_phone': ['208555111', '', None]})
+        BookerParser.normalize_phones(df, self.columns)
+        self.assertEqual(df['primary_phone'].tolist(), ['+12085551111', '+12085551111', '+122085551111'])
+        self.assertEqual(df['mobile_phone'].tolist(), ['+1208555111', '', None])
+
+
+class ExportOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, directory, name, modified):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(name)
+        os.utime(path, (modified, modified))
+        return path
+
+    def test_scraped_files_in_download_order(self):
+        directory = os.path.join(self.directory.name, 'Order', '51309')
+        self.write(directory, 'Order 2024-03-01-2024-03-07.csv', time.time())
+        self.write(directory, 'Order 2024-03-05-2024-03-11.csv', time.time() - 60)
+        self.assertEqual(BookerParser.list_files(directory),
+                         ['Order 2024-03-05-2024-03-11.csv', 'Order 2024-03-01-2024-03-07.csv'])
+
+    def test_replayed_files_in_archive_order(self):
+        # The later export sorts first by name, and staging copies them in name order
+        archive = ExportArchive(os.path.join(self.directory.name, 'archive'))
+        downloads = os.path.join(self.directory.name, 'downloads')
+        for name in ['Order 2024-03-05-2024-03-11.csv', 'Order 2024-03-01-2024-03-07.csv']:
+            archive.archive_raw('Order', '51309', self.write(downloads, name, time.time()), 'date_created')
+            time.sleep(0.01)
+        staged = os.path.join(self.directory.name, 'staged')
+        archive.stage_raw(staged, types=['Order'])
+        for i, file in enumerate(sorted(os.listdir(os.path.join(staged, 'Order', '51309')))):
+            os.utime(os.path.join(staged, 'Order', '51309', file), (time.time() + i, time.time() + i))
+
+        with mock.patch('parser.InvalidFileHandler', side_effect=Exception):
+            parser = BookerParser(staged)
+        dates = [export['start_date'] for export in parser.export_files('Order')]
+        self.assertEqual(dates, [date(2024, 3, 5), date(2024, 3, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
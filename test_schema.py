@@ -0,0 +1,32 @@
+import unittest
+
+import pandas as pd
+
+from schema import apply_schema, cents_to_money, json_records, money_to_cents
+
+
+class MoneyTest(unittest.TestCase):
+    values = ['1234.5', '(5.00)', '12', '0.00', '-0.50', '']
+
+    def orders(self):
+        return pd.DataFrame({'order_number': range(len(self.values)), 'total_price': self.values})
+
+    def test_round_trip(self):
+        cents = money_to_cents(pd.Series(self.values))
+        self.assertEqual(cents.tolist(), [123450, -500, 1200, 0, -50, pd.NA])
+        self.assertEqual(cents_to_money(cents).tolist(), ['1234.50', '-5.00', '12.00', '0.00', '-0.50', None])
+
+    def test_untyped_payload_keeps_the_export_text(self):
+        records = json_records(self.orders(), 'orders')
+        self.assertEqual([record['total_price'] for record in records], self.values)
+
+    def test_typed_payload_is_canonical(self):
+        # The documented difference of TYPED_FRAMES: money is sent as '-1234.50', whatever the export wrote
+        records = json_records(apply_schema(self.orders(), 'orders'), 'orders')
+        self.assertEqual([record['total_price'] for record in records],
+                         ['1234.50', '-5.00', '12.00', '0.00', '-0.50', ''])
+        self.assertEqual([record['order_number'] for record in records], list(range(len(self.values))))
+
+
+if __name__ == '__main__':
+    unittest.main()
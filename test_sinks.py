@@ -0,0 +1,135 @@
+import json
+import os
+import tempfile
+import unittest
+
+from sinks import JsonlSink, PostgresSink
+
+APPOINTMENT_COLUMNS = [
+    ('id', 'text'),
+    ('booking_number', 'bigint'),
+    ('start_date_time', 'timestamp with time zone'),
+    ('status', 'character varying(32)'),
+    ('total', 'numeric(10,2)'),
+    ('order_number', 'text'),
+    ('received_at', 'timestamp with time zone'),
+]
+
+
+class FakeCursor:
+    """Records the statements and the COPY data of a PostgresSink flush"""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.statements = []
+        self.copied = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+
+    def fetchall(self):
+        return self.columns
+
+    def copy_expert(self, statement, buffer):
+        self.statements.append(statement)
+        self.copied.append(buffer.read())
+
+
+class FakeEngine:
+    def __init__(self, cursor):
+        self.fake_cursor = cursor
+        self.committed = False
+
+    def raw_connection(self):
+        return self
+
+    def cursor(self):
+        return self.fake_cursor
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PostgresSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.cursor = FakeCursor(APPOINTMENT_COLUMNS)
+        self.engine = FakeEngine(self.cursor)
+        self.sink = PostgresSink(None, engine=self.engine)
+
+    def statement(self, prefix):
+        return next(statement for statement in self.cursor.statements if statement.startswith(prefix))
+
+    def test_partial_records_stage_only_their_columns(self):
+        self.sink.object('1001', 'appointments', {'order_number': '5001'})
+        self.sink.flush()
+        self.assertEqual(self.statement('CREATE TEMPORARY TABLE'),
+                         'CREATE TEMPORARY TABLE staging ("id" text, "order_number" text, "received_at" text)')
+        self.assertNotIn('LIKE', ' '.join(self.cursor.statements))
+        self.assertTrue(self.engine.committed)
+
+    def test_partial_records_update_existing_rows(self):
+        # An INSERT would fail on the NOT NULL columns the record leaves out, even with ON CONFLICT
+        self.sink.object('1001', 'appointments', {'order_number': '5001'})
+        self.sink.flush()
+        self.assertEqual(self.statement('UPDATE'),
+                         'UPDATE "booker_prod"."appointments" AS t SET "order_number" = s."order_number"::text, '
+                         '"received_at" = NULLIF(s."received_at", \'\')::timestamp with time zone '
+                         'FROM staging AS s WHERE t."id" = s."id"::text')
+        self.assertIn('WHERE NOT EXISTS (SELECT 1 FROM "booker_prod"."appointments" AS t '
+                      'WHERE t."id" = s."id"::text)', self.statement('INSERT INTO'))
+
+    def test_blanks_become_null_outside_text_columns(self):
+        self.sink.object('1001', 'appointments', {
+            'booking_number': 1001, 'start_date_time': '', 'status': '', 'total': '', 'unknown': 'x',
+        })
+        self.sink.flush()
+        insert = self.statement('INSERT INTO')
+        self.assertIn('SELECT s."id"::text, NULLIF(s."booking_number", \'\')::bigint, '
+                      'NULLIF(s."start_date_time", \'\')::timestamp with time zone, '
+                      's."status"::character varying(32), NULLIF(s."total", \'\')::numeric(10,2), '
+                      'NULLIF(s."received_at", \'\')::timestamp with time zone FROM staging AS s', insert)
+        self.assertIn('ON CONFLICT ("id") DO UPDATE SET "booking_number" = EXCLUDED."booking_number"', insert)
+        self.assertNotIn('unknown', insert)
+        self.assertTrue(self.cursor.copied[0].startswith('1001,1001,,,,'))
+
+    def test_missing_properties_are_null(self):
+        self.sink.object('1001', 'appointments', {'status': 'Closed', 'total': None})
+        self.sink.flush()
+        self.assertTrue(self.cursor.copied[0].startswith('1001,Closed,\\N,'))
+
+    def test_missing_table(self):
+        self.cursor.columns = []
+        self.sink.object('1001', 'appointments', {'status': 'Closed'})
+        with self.assertRaises(Exception):
+            self.sink.flush()
+
+
+class JsonlSinkTest(unittest.TestCase):
+    def test_appends_records(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'records', 'sink.jsonl')
+            sink = JsonlSink(path)
+            sink.object('1001', 'orders', {'status': 'Open'})
+            sink.flush()
+            sink.object('1001', 'orders', {'status': 'Closed'})
+            sink.flush()
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([record['properties']['status'] for record in records], ['Open', 'Closed'])
+        self.assertEqual({record['collection'] for record in records}, {'orders'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+import tasks
+from snapshot import CustomerSnapshot
+
+
+def customers(count, name='Jane'):
+    return pd.DataFrame({
+        'guid': [f'guid-{i}' for i in range(count)],
+        'first_name': [f'{name} {i}' for i in range(count)],
+    })
+
+
+class SyncCustomersTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sink_path = os.path.join(self.directory.name, 'sink.jsonl')
+        snapshot_uri = os.path.join(self.directory.name, 'snapshot')
+        env = {'CUSTOMER_SNAPSHOT_URI': snapshot_uri, 'SINK': 'jsonl', 'SINK_PATH': self.sink_path}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+        tasks._sink = None
+        self.snapshot = CustomerSnapshot(snapshot_uri)
+        tasks.sync_customers(customers(20), None)
+        self.sent()
+
+    def sent(self):
+        """Records written to the sink since the last call"""
+        if not os.path.exists(self.sink_path):
+            return []
+        with open(self.sink_path) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(self.sink_path)
+        return records
+
+    def deleted(self, records):
+        return [record['id'] for record in records if record['properties'].get('deleted')]
+
+    def test_missing_customers_are_deleted(self):
+        tasks.sync_customers(customers(19), None)
+        self.assertEqual(self.deleted(self.sent()), ['guid-19'])
+        self.assertEqual(len(self.snapshot.load()), 19)
+
+    def test_empty_export_deletes_nothing(self):
+        tasks.sync_customers(tasks.BookerParser.empty_frame(['guid', 'first_name']), None)
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(len(self.snapshot.load()), 20)
+
+    def test_quarantined_export_deletes_nothing(self):
+        df = customers(10)
+        df.attrs['quarantined'] = ['Customer 2024-03-01.csv']
+        tasks.sync_customers(df, None)
+        self.assertEqual(self.deleted(self.sent()), [])
+        self.assertEqual(len(self.snapshot.load()), 20)
+
+    def test_parser_marks_quarantined_exports(self):
+        manifest = [{'type': 'Customer', 'location': None, 'path': 'Customer 2024-03-01.csv'}]
+        parser = tasks.BookerParser(self.directory.name, manifest=manifest)
+        parser.invalid_file_handler = mock.Mock()
+        with mock.patch.object(parser, 'customer_file_to_df', side_effect=ValueError('duplicate guid')):
+            df = parser.parse_customers()
+        self.assertEqual(df.attrs['quarantined'], ['Customer 2024-03-01.csv'])
+        tasks.sync_customers(df, None)
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(len(self.snapshot.load()), 20)
+
+    def test_delete_ratio_guard(self):
+        tasks.sync_customers(customers(15), None, max_delete_ratio=0.2)
+        self.assertEqual(self.deleted(self.sent()), [])
+        self.assertEqual(len(self.snapshot.load()), 20)
+        tasks.sync_customers(customers(15), None, max_delete_ratio=0.5)
+        self.assertEqual(len(self.deleted(self.sent())), 5)
+        self.assertEqual(len(self.snapshot.load()), 15)
+
+    def test_changed_customers_are_undeleted(self):
+        tasks.sync_customers(customers(20, name='John'), None)
+        records = self.sent()
+        self.assertEqual(len(records), 20)
+        self.assertTrue(all(record['properties']['deleted'] is False for record in records))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import pandas as pd
+
+from metrics import current_run
+from schema import NATURAL_KEYS
+
+# Columns every parsed frame needs before it can be sent
+REQUIRED_COLUMNS = {
+    'appointments': ['booking_number', 'status', 'start_date_time', 'end_date_time', 'location'],
+    'treatments': ['appointment', 'treatment_name', 'appointment_on'],
+    'orders': ['order_number', 'customer', 'status', 'order_date', 'total_price', 'location'],
+    'customers': ['guid', 'email', 'status'],
+}
+# Column of the exports filtered on date_on, its dates have to fall inside the export window
+WINDOW_COLUMNS = {
+    'appointments': 'start_date_time',
+    'orders': 'order_date',
+}
+# Frames with one row per entity, appointment exports repeat the booking for every treatment
+UNIQUE_FRAMES = ['orders', 'customers']
+
+
+class ValidationError(Exception):
+    pass
+
+
+class ExportValidator:
+    """Cheap checks of a parsed export before it is sent. Every check is one vectorized pass over a column and
+    is timed as a validate_<check> phase of the run. A failing export raises ValidationError, BookerParser then
+    quarantines the file with the invalid file handler like a file that didn't parse."""
+    checks = ['columns', 'window', 'keys']
+
+    def validate(self, export, frames):
+        """export is a manifest entry (type, location, start_date, end_date, date_type, path), frames the frames
+        parsed from it"""
+        for check in self.checks:
+            with current_run().phase(f'validate_{check}'):
+                getattr(self, f'check_{check}')(export, frames)
+
+    ###############################
+    # CHECKS
+    ###############################
+    @staticmethod
+    def check_columns(export, frames):
+        for name, df in frames.items():
+            missing = [column for column in REQUIRED_COLUMNS.get(name, []) if column not in df.columns]
+            if missing:
+                raise ValidationError(f'{name} are missing the columns {missing}')
+
+    @staticmethod
+    def check_window(export, frames):
+        start_date, end_date = export.get('start_date'), export.get('end_date')
+        # Exports filtered on the date they were created, like every order export, have no column to check, and
+        # an export without a date type isn't known to be filtered on date_on
+        if start_date is None or end_date is None or export.get('date_type') != 'date_on':
+            return
+        for name, df in frames.items():
+            column = WINDOW_COLUMNS.get(name)
+            if column is None or len(df) == 0:
+                continue
+            # ISO strings and datetimes both order by date, so min and max are enough
+            dates = df[column]
+            min_date, max_date = dates.min(), dates.max()
+            if pd.isna(min_date) or pd.isna(max_date):
+                continue
+            min_date, max_date = pd.Timestamp(min_date).date(), pd.Timestamp(max_date).date()
+            if min_date < start_date or max_date > end_date:
+                raise ValidationError(f'{name} dates {min_date} to {max_date} are outside of the export window '
+                                      f'{start_date} to {end_date}')
+
+    @staticmethod
+    def check_keys(export, frames):
+        for name, df in frames.items():
+            keys = NATURAL_KEYS.get(name, [])
+            if len(df) == 0 or not keys or any(key not in df.columns for key in keys):
+                continue
+            key = df[keys[0]]
+            blank = key.isna()
+            if not pd.api.types.is_numeric_dtype(key):
+                blank |= (key == '').fillna(False).astype(bool)
+            if blank.any():
+                raise ValidationError(f'{name} have rows without {keys[0]}')
+            if name in UNIQUE_FRAMES and df.duplicated(subset=keys).any():
+                raise ValidationError(f'{name} have duplicate {", ".join(keys)}')
@@ -3,12 +3,85 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
 import logging
 import os
+from functools import wraps
+
+from metrics import current_run
 
 logging.getLogger('segment').setLevel('DEBUG')
 
+# Requests the scraper never needs, blocked through DevTools when the lean profile is used
+BLOCKED_RESOURCE_TYPES = ['image', 'font', 'media']
+RESOURCE_TYPE_URL_PATTERNS = {
+    'image': ['*.png*', '*.jpg*', '*.jpeg*', '*.gif*', '*.svg*', '*.ico*', '*.webp*'],
+    'font': ['*.woff*', '*.woff2*', '*.ttf*', '*.otf*', '*.eot*'],
+    'stylesheet': ['*.css*'],
+    'media': ['*.mp4*', '*.webm*', '*.mp3*', '*.ogg*'],
+}
+BLOCKED_URL_PATTERNS = [
+    '*google-analytics.com*',
+    '*googletagmanager.com*',
+    '*doubleclick.net*',
+    '*facebook.net*',
+    '*hotjar.com*',
+    '*nr-data.net*',
+    '*newrelic.com*',
+]
+
+
+def lean_options(options, blocked_resource_types=None):
+    """Don't wait for subresources after DOMContentLoaded and never decode images"""
+    blocked_resource_types = BLOCKED_RESOURCE_TYPES if blocked_resource_types is None else blocked_resource_types
+    options.page_load_strategy = 'eager'
+    if 'image' in blocked_resource_types:
+        options.add_argument('--blink-settings=imagesEnabled=false')
+
+
+def block_requests(driver, blocked_url_patterns=None, blocked_resource_types=None):
+    """Block URL patterns and resource types for every page the driver loads"""
+    blocked_url_patterns = BLOCKED_URL_PATTERNS if blocked_url_patterns is None else blocked_url_patterns
+    blocked_resource_types = BLOCKED_RESOURCE_TYPES if blocked_resource_types is None else blocked_resource_types
+    patterns = list(blocked_url_patterns)
+    for resource_type in blocked_resource_types:
+        patterns.extend(RESOURCE_TYPE_URL_PATTERNS.get(resource_type, []))
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': patterns})
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of a process and all of its descendants, read from /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name can contain spaces, the parent pid is the second field after it
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+        pending.extend(children.get(current, []))
+    return total
+
+
+def chrome_rss(driver):
+    """Resident memory of chromedriver and every Chrome process it started"""
+    return process_tree_rss(driver.service.process.pid)
+
 
 # Define Chrome options to open the browser in headless mode
-def chrome_headless(logger, download_dir=None):
+def chrome_headless(logger, download_dir=None, lean=False, blocked_url_patterns=None, blocked_resource_types=None):
     options = Options()
     options.add_argument('--headless')
     options.add_argument('--no-sandbox')
@@ -19,6 +92,8 @@ def chrome_headless(logger, download_dir=None):
     options.add_argument("--disable-dev-tools")
     options.add_argument("--no-zygote")
     options.binary_location = os.path.join(os.getcwd(), "chrome-linux64", "chrome")
+    if lean:
+        lean_options(options, blocked_resource_types)
 
     # Set download directory
     prefs = {
@@ -40,12 +115,16 @@ def chrome_headless(logger, download_dir=None):
     except Exception as e:
         logger.error(e)
         raise e
+    if lean:
+        block_requests(driver, blocked_url_patterns, blocked_resource_types)
     driver.maximize_window()
     return driver
 
 
-def chrome_testing(download_dir=None):
+def chrome_testing(download_dir=None, lean=False, blocked_url_patterns=None, blocked_resource_types=None):
     options = Options()
+    if lean:
+        lean_options(options, blocked_resource_types)
     prefs = {
         "download.prompt_for_download": False,
         "download.directory_upgrade": True,
@@ -55,5 +134,127 @@ def chrome_testing(download_dir=None):
         prefs["download.default_directory"] = download_dir
     options.add_experimental_option('prefs', prefs)
     driver = webdriver.Chrome(options=options)
+    if lean:
+        block_requests(driver, blocked_url_patterns, blocked_resource_types)
     driver.maximize_window()
     return driver
+
+
+class RecyclingDriver:
+    """Proxy around a Chrome driver that samples Chrome's memory every sample_every navigations and swaps in a
+    fresh driver from factory once a budget is exceeded. Callbacks in on_recycle get the new driver so the
+    session (login, location) can be restored before the next page loads."""
+    def __init__(self, factory, rss_budget_mb=3072, heap_budget_mb=None, sample_every=10):
+        self.factory = factory
+        self.rss_budget = rss_budget_mb * 1024 * 1024
+        self.heap_budget = heap_budget_mb * 1024 * 1024 if heap_budget_mb else None
+        self.sample_every = sample_every
+        self.current_driver = factory()
+        self.on_recycle = []
+        self.navigations = 0
+        self.recycles = 0
+        self.samples = []
+        self.recycling = False
+
+    def __getattr__(self, name):
+        return getattr(self.current_driver, name)
+
+    def get(self, url):
+        self.navigations += 1
+        if not self.recycling and self.navigations % self.sample_every == 0:
+            self.check_memory()
+        return self.current_driver.get(url)
+
+    def sample_memory(self):
+        rss = chrome_rss(self.current_driver)
+        try:
+            heap = self.current_driver.execute_cdp_cmd('Runtime.getHeapUsage', {})['usedSize']
+        except Exception:
+            heap = None
+        sample = {'navigations': self.navigations, 'rss': rss, 'heap': heap}
+        self.samples.append(sample)
+        return sample
+
+    def check_memory(self):
+        sample = self.sample_memory()
+        print(f'Chrome memory after {self.navigations} navigations: RSS {sample["rss"] / 1024 / 1024:.0f} MB'
+              + (f', JS heap {sample["heap"] / 1024 / 1024:.0f} MB' if sample['heap'] is not None else ''))
+        over_rss = sample['rss'] > self.rss_budget
+        over_heap = self.heap_budget is not None and sample['heap'] is not None and sample['heap'] > self.heap_budget
+        if over_rss or over_heap:
+            self.recycle()
+
+    def recycle(self):
+        print('Chrome memory budget exceeded, recycling driver')
+        self.recycling = True
+        try:
+            try:
+                self.current_driver.quit()
+            except Exception as e:
+                print(f'Error quitting driver: {e}')
+            self.current_driver = self.factory()
+            self.recycles += 1
+            for callback in self.on_recycle:
+                callback(self.current_driver)
+        finally:
+            self.recycling = False
+
+    def memory_report(self):
+        rss = [sample['rss'] for sample in self.samples]
+        heap = [sample['heap'] for sample in self.samples if sample['heap'] is not None]
+        return {
+            'navigations': self.navigations,
+            'samples': len(self.samples),
+            'recycles': self.recycles,
+            'peak_rss_mb': round(max(rss) / 1024 / 1024, 1) if rss else None,
+            'peak_heap_mb': round(max(heap) / 1024 / 1024, 1) if heap else None,
+        }
+
+
+class RoundTripCounter:
+    """Counts the commands a driver sends to chromedriver. Every WebDriver call, including the ones made through
+    WebElements, goes through driver.execute, which is wrapped here."""
+    def __init__(self, driver):
+        self.total = 0
+        self.flows = {}
+        # Flows currently running, a flow called from another flow is already part of the outer one's count
+        self.depth = 0
+        self.install(driver)
+
+    def install(self, driver):
+        # Wrap the real driver, WebElements call execute on it directly
+        driver = getattr(driver, 'current_driver', driver)
+        self._execute = driver.execute
+        driver.execute = self._counting_execute
+
+    def _counting_execute(self, driver_command, params=None):
+        self.total += 1
+        return self._execute(driver_command, params)
+
+    def add(self, flow, count):
+        self.flows[flow] = self.flows.get(flow, 0) + count
+
+    def report(self):
+        return {'total': self.total, 'flows': dict(self.flows)}
+
+
+def count_round_trips(func):
+    """Record how many WebDriver round trips a scraper flow used. Every flow gets its own count, the run total
+    only counts the outermost flows so nested flows aren't counted twice."""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        counter = getattr(self, 'round_trips', None)
+        if counter is None:
+            return func(self, *args, **kwargs)
+        start = counter.total
+        counter.depth += 1
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            counter.depth -= 1
+            count = counter.total - start
+            counter.add(func.__name__, count)
+            current_run().add_round_trips(func.__name__, count, nested=counter.depth > 0)
+            print(f'{func.__name__} used {count} WebDriver round trips')
+    return wrapper
+